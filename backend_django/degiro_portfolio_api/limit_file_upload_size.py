@@ -1,14 +1,18 @@
+from django.conf import settings
 from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
 
-class LimitUploadSizeMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
 
-    def __call__(self, request):
+# MiddlewareMixin makes the middleware work for both sync and async requests. A sync-only middleware would make
+# Django run async views through a single thread under ASGI.
+class LimitUploadSizeMiddleware(MiddlewareMixin):
+    """
+    Rejects requests that announce a body larger than settings.MAX_UPLOAD_SIZE before any of it is read. The header
+    is not trusted otherwise: the bytes of the uploaded files are counted by UploadSizeLimitHandler.
+    """
+
+    def process_request(self, request):
         if request.method == 'POST':
-            max_size = 5_000_000  # 2MB
-            content_length = int(request.META.get('CONTENT_LENGTH', 0))
-            if content_length > max_size:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+            if content_length > settings.MAX_UPLOAD_SIZE:
                 return JsonResponse({'error': 'File size too large'}, status=400)
-
-        return self.get_response(request)
@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+from datetime import time, timedelta
 from pathlib import Path
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -42,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Compresses the responses for clients that accept gzip, the analysis results shrink to a fraction of their size
+    'django.middleware.gzip.GZipMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -80,9 +84,35 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Prices are stored from many threads at once (exchange probes, concurrent async analyses), writers wait up to
+        # this many seconds for the write lock instead of the default 5
+        'OPTIONS': {'timeout': 20},
+        # The tests analyze with threads as well, which the in-memory test database does not allow
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Results of analyzed uploads, keyed by the hash of the transactions (see portfolio_analyzer.result_cache).
+    # Every worker process caches the results it analyzed in its own memory. The local memory cache is an LRU cache:
+    # reading an entry marks it as used, and with CULL_FREQUENCY equal to MAX_ENTRIES a full cache evicts only the
+    # least recently used entry to make room for a new one. The file and database backends do not evict by use.
+    'analysis_results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'analysis-results',
+        'OPTIONS': {
+            'MAX_ENTRIES': 500,
+            'CULL_FREQUENCY': 500,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -122,3 +152,88 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 CORS_ALLOW_ALL_ORIGINS = True  # If this
+
+# Largest uploaded export in bytes, counted while it is received (see portfolio_analyzer.uploads) and checked against
+# the size of the request by LimitUploadSizeMiddleware. Compressed exports may not decompress to more than this either.
+# Uploads larger than FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to a temporary file instead of kept in memory.
+MAX_UPLOAD_SIZE = 50_000_000
+FILE_UPLOAD_HANDLERS = [
+    'portfolio_analyzer.uploads.UploadSizeLimitHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# ISIN -> ticker mappings barely ever change, so they are cached in the database (see portfolio_analyzer.models).
+# ISINs that OpenFIGI does not know are cached as well, but for a shorter time.
+TICKER_CACHE_TTL = timedelta(days=30)
+TICKER_CACHE_NEGATIVE_TTL = timedelta(days=1)
+
+# Number of analysis jobs (see portfolio_analyzer.jobs) that run at the same time per process. Every
+# ANALYSIS_JOB_HEARTBEAT_INTERVAL seconds a process marks the jobs it holds as alive. Unfinished jobs that have not been
+# marked for ANALYSIS_JOB_STALE_AFTER were lost with their process (e.g. a restarted worker) and are reported as failed.
+ANALYSIS_JOB_WORKERS = 4
+ANALYSIS_JOB_HEARTBEAT_INTERVAL = 15
+ANALYSIS_JOB_STALE_AFTER = timedelta(minutes=1)
+
+# The async calculate endpoint (see portfolio_analyzer.async_analysis) runs the blocking parts of all analyses of a
+# process on a pool of ASYNC_ANALYSIS_THREADS threads, and prices up to ASYNC_ANALYSIS_STOCK_CONCURRENCY stocks of an
+# upload at the same time
+ASYNC_ANALYSIS_THREADS = 32
+ASYNC_ANALYSIS_STOCK_CONCURRENCY = 8
+
+# Callers that miss the cache for the same ISINs or tickers wait for the one already fetching them (see
+# portfolio_analyzer.stockdata_fetchers.SingleFlight). Across the worker processes of a host that is done with lock
+# files in this directory, set it to None to only do so within a process.
+SINGLE_FLIGHT_LOCK_DIR = Path(tempfile.gettempdir()) / 'degiro-portfolio-locks'
+
+# The warm_cache command refreshes the prices and ticker mappings of the CACHE_WARM_UP_LIMIT listings used most by
+# analyses in the last CACHE_WARM_UP_DAYS days, downloading CACHE_WARM_UP_WORKERS listings at a time. With --loop it
+# does so every day at CACHE_WARM_UP_TIME (in TIME_ZONE), after the European and American markets have closed.
+CACHE_WARM_UP_DAYS = 7
+CACHE_WARM_UP_LIMIT = 500
+CACHE_WARM_UP_WORKERS = 4
+CACHE_WARM_UP_TIME = time(22, 30)
+
+# Calls to OpenFIGI and Yahoo Finance (see portfolio_analyzer.stockdata_fetchers.create_market_data_session).
+# The timeout is a (connect, read) tuple in seconds, retries back off exponentially from MARKET_DATA_BACKOFF seconds.
+MARKET_DATA_TIMEOUT = (3.05, 20)
+MARKET_DATA_RETRIES = 3
+MARKET_DATA_BACKOFF = 0.5
+MARKET_DATA_MAX_RETRY_AFTER = 60
+MARKET_DATA_POOL_SIZE = 20
+# A host is not called for MARKET_DATA_CIRCUIT_RESET_TIMEOUT seconds after this many failed calls in a row
+MARKET_DATA_CIRCUIT_FAILURE_THRESHOLD = 5
+MARKET_DATA_CIRCUIT_RESET_TIMEOUT = 30
+
+# Euro reference rates used to convert prices of listings in other currencies (see portfolio_analyzer.exchange_rates)
+# are read from the database once per process and kept this long, so rates loaded with the load_exchange_rates command
+# (from EXCHANGE_RATES_FILE unless another file is given) reach running worker processes within this time.
+EXCHANGE_RATES_CACHE_TTL = timedelta(hours=1)
+EXCHANGE_RATES_FILE = BASE_DIR / 'eurofxref-hist.zip'
+
+# Directory the cProfile stats of requests made with ?profile=1 are written to. Profiling is disabled when not set.
+ANALYSIS_PROFILE_DIR = None
+
+# Replaces OpenFIGI and Yahoo Finance with the deterministic providers of portfolio_analyzer.benchmarks, each call
+# sleeping SYNTHETIC_MARKET_DATA_LATENCY seconds. Only for servers that are load tested (see settings_load_test).
+SYNTHETIC_MARKET_DATA = False
+SYNTHETIC_MARKET_DATA_LATENCY = 0.0
+
+# The metrics/ endpoint (see portfolio_analyzer.instrumentation) is only served to staff users, unless this is set for
+# servers whose metrics/ path can only be reached by Prometheus
+METRICS_ENABLED = False
+
+# The timings of every analysis are logged as a JSON line (see portfolio_analyzer.instrumentation)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '{message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'message'},
+    },
+    'loggers': {
+        'portfolio_analyzer': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
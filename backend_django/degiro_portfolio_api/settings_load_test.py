@@ -0,0 +1,23 @@
+import os
+from .settings_production import *
+
+# Settings of the server the load_test command starts (or that is started by hand to be load tested): the production
+# settings, with synthetic market data instead of OpenFIGI and Yahoo Finance and a database of its own.
+
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', 'load-test-secret-key')
+
+ALLOWED_HOSTS = ['localhost', '127.0.0.1', '[::1]']
+
+DATABASES = {
+    'default': {
+        **DATABASES['default'],
+        'NAME': os.environ.get('LOAD_TEST_DATABASE', BASE_DIR / 'load_test.sqlite3'),
+    }
+}
+
+# Seconds every synthetic OpenFIGI and Yahoo Finance call takes, to include the network in the measurements
+SYNTHETIC_MARKET_DATA = True
+SYNTHETIC_MARKET_DATA_LATENCY = float(os.environ.get('SYNTHETIC_MARKET_DATA_LATENCY', '0'))
+
+# The load_test command waits for metrics/ to answer before it starts
+METRICS_ENABLED = True
@@ -14,6 +14,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Prices are stored from many threads at once (exchange probes, concurrent async analyses), writers wait up to
+        # this many seconds for the write lock instead of the default 5
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -0,0 +1,11 @@
+from .settings import *
+
+# Settings of the tests, which manage.py test runs with: the development settings, without the timings every analysis
+# logs between the test results. Tests that check what is logged capture it with assertLogs.
+
+LOGGING = {
+    **LOGGING,
+    'loggers': {
+        'portfolio_analyzer': {'handlers': ['console'], 'level': 'WARNING'},
+    },
+}
@@ -0,0 +1,60 @@
+"""
+Gunicorn configuration of the API, read by gunicorn from the working directory:
+
+    gunicorn
+    gunicorn --workers 4 --threads 8
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn
+
+Every setting can be overridden on the command line or with the environment variables below. Analyses spend their
+time in pandas (holding the GIL) and waiting for the database and the market data providers, so every worker process
+serves a few requests at a time with threads.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+workers = int(os.environ.get('GUNICORN_WORKERS', max(multiprocessing.cpu_count(), 2)))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# With GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker the workers serve the ASGI application instead, on which the
+# async calculate endpoint (see portfolio_analyzer.async_analysis) does not hold a thread while it waits for OpenFIGI
+# and Yahoo Finance. The other, synchronous endpoints then run one at a time per worker process, so such workers are
+# best used for a server that only serves calculate_multi_year_gain_async/.
+if worker_class.startswith('uvicorn.'):
+    wsgi_app = 'degiro_portfolio_api.asgi:application'
+else:
+    wsgi_app = 'degiro_portfolio_api.wsgi:application'
+
+# Django and pandas are imported once by the master instead of by every worker, which speeds up starting workers and
+# shares the memory of the imported modules between them
+preload_app = True
+
+# Big portfolios with prices that are not cached yet take longer than the default of 30 seconds
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Workers can be restarted after this many requests (spread by the jitter, so they do not restart at the same time) to
+# keep the memory of long-running workers in check. It is off by default: a restarted worker loses the analysis jobs
+# it runs in the background (see portfolio_analyzer.jobs) once graceful_timeout has passed, and the analysis results
+# and exchange rates it holds in memory.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+# The heartbeat files of the workers, a tmpfs so a slow disk can not make the master kill busy workers
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def post_fork(server, worker):
+    # Connections opened by the master while loading the application must not be shared by the workers
+    from django.db import connections
+    connections.close_all()
+
+
+def worker_exit(server, worker):
+    # A stopping worker finishes the analysis jobs it queued before it exits, as long as graceful_timeout allows
+    from portfolio_analyzer.jobs import job_executor
+    job_executor.shutdown(wait=True)
@@ -1,3 +1,9 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import TickerMapping
+
+
+@admin.register(TickerMapping)
+class TickerMappingAdmin(admin.ModelAdmin):
+    list_display = ('isin', 'ticker', 'exchange_code', 'fetched_at')
+    search_fields = ('isin', 'ticker')
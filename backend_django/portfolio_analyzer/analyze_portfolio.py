@@ -1,10 +1,20 @@
 from datetime import date, datetime, timezone
+import logging
+import threading
 import time
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Callable, Optional, Tuple, Iterator
 import pandas as pd
 
-from .stockdata_fetchers import fetch_yearly_stock_prices, isin_to_ticker, check_and_convert_csv_headers, \
-    open_figi_api_key
+from .cache_warming import record_ticker_usage
+from .exchange_rates import account_currency, listing_currency, convert_price_index, MissingExchangeRates
+from .instrumentation import timed_stage
+from .stockdata_fetchers import cached_isins_to_tickers, check_and_convert_csv_headers, open_figi_api_key, \
+    candidate_exchange_codes, find_listing, remembered_exchange_codes, remembered_currencies, remember_exchange_code, \
+    fetch_price_histories, price_history_range, yearly_prices_from_history, PriceIndex
+from .worth_series import series_dates, calculate_worth_series, total_worth_series, downsample_lttb, \
+    series_to_timestamps
+
+logger = logging.getLogger(__name__)
 
 
 def populate_unique_years(stock_df: pd.DataFrame) -> List[int]:
@@ -20,55 +30,87 @@ def populate_unique_years(stock_df: pd.DataFrame) -> List[int]:
     return sorted(set(all_years + unique_years))
 
 
-def calculate_total_stocks_owned(stock_df: pd.DataFrame) -> float:
+@timed_stage('compute')
+def calculate_stock_aggregates(df: pd.DataFrame) -> Dict[str, Dict[str, float]]:
     """
-    Calculates the total number of stocks owned today.
-    :param stock_df: CSV file contents for a specific stock in dataframe format
-    :return: Total stocks owned today (float)
+    Aggregates the transactions of every product in a single groupby pass.
+    :param df: CSV file contents in dataframe format
+    :return: Dictionary with the product as key and a dictionary with the stocks owned today, the total invested, the
+    money received from sales and dividends (positive cash flow) and the realized gain as value
     """
-    return stock_df['Aantal'].sum()
-
-
-def calculate_total_gain_value(stock_df: pd.DataFrame, final_stock_price: float) -> float:
+    products = df.groupby('Product', sort=False, observed=True)
+    sales = df[df['Aantal'] < 0].groupby('Product', sort=False, observed=True)
+
+    # Every group is summed like Series.sum does, so the floats come out exactly the same as when summing a filtered
+    # frame per product
+    aggregates = pd.DataFrame({
+        'stocks_owned': products['Aantal'].agg(lambda aantal: aantal.sum()),
+        'total_invested': products['Waarde'].agg(lambda waarde: waarde[waarde < 0].sum()) * -1,
+        'positive_cash_flow': products['Waarde'].agg(lambda waarde: waarde[waarde > 0].sum()),
+        'realized_gain': sales['Waarde'].agg(lambda waarde: waarde.sum()).round(3),
+    })
+    aggregates['realized_gain'] = aggregates['realized_gain'].fillna(0.0)
+    return aggregates.to_dict('index')
+
+
+def calculate_total_gain_value(stock_aggregates: Dict[str, float], final_stock_price: float) -> float:
     """
     Calculates the total gain value for a specific stock.
-    :param stock_df: CSV file contents for a specific stock in dataframe format
+    :param stock_aggregates: Aggregated transactions of a specific stock, see calculate_stock_aggregates
     :param final_stock_price: Stock price at the point we are calculating for
     :return: Total gain value (float)
     """
-    all_stocks_owned_today = calculate_total_stocks_owned(stock_df)
-    final_worth = final_stock_price * all_stocks_owned_today
-    total_invested_all_time = stock_df[stock_df['Waarde'] < 0]['Waarde'].sum() * -1
-    realized_gain = stock_df[stock_df['Waarde'] > 0]['Waarde'].sum()
-    return final_worth + realized_gain - total_invested_all_time
+    final_worth = calculate_final_worth(stock_aggregates, final_stock_price)
+    return final_worth + stock_aggregates['positive_cash_flow'] - stock_aggregates['total_invested']
 
 
-def calculate_total_gain_percent(stock_df: pd.DataFrame, final_stock_price: float) -> float:
+def calculate_total_gain_percent(stock_aggregates: Dict[str, float], final_stock_price: float) -> float:
     """
     Calculates the total gain percentage for a specific stock.
-    :param stock_df: CSV file contents for a specific stock in dataframe format
+    :param stock_aggregates: Aggregated transactions of a specific stock, see calculate_stock_aggregates
     :param final_stock_price: Stock price at the point we are calculating for
     :return: Total gain percent (float)
     """
-    all_stocks_owned_today = calculate_total_stocks_owned(stock_df)
-    final_worth = final_stock_price * all_stocks_owned_today
-    total_invested_all_time = stock_df[stock_df['Waarde'] < 0]['Waarde'].sum() * -1
-    realized_gain = stock_df[stock_df['Waarde'] > 0]['Waarde'].sum()
+    final_worth = calculate_final_worth(stock_aggregates, final_stock_price)
+    total_invested_all_time = stock_aggregates['total_invested']
     if total_invested_all_time != 0:
-        return (((final_worth + realized_gain) / total_invested_all_time) - 1) * 100
+        return (((final_worth + stock_aggregates['positive_cash_flow']) / total_invested_all_time) - 1) * 100
     else:
         return 0
 
 
-def calculate_final_worth(stock_df: pd.DataFrame, final_stock_price: float) -> float:
+def calculate_final_worth(stock_aggregates: Dict[str, float], final_stock_price: float) -> float:
     """
     Calculates the final worth for a specific stock.
-    :param stock_df: CSV file contents for a specific stock in dataframe format
+    :param stock_aggregates: Aggregated transactions of a specific stock, see calculate_stock_aggregates
     :param final_stock_price: Stock price at the point we are calculating for
     :return: Final worth of the stock (float)
     """
-    all_stocks_owned_today = calculate_total_stocks_owned(stock_df)
-    return final_stock_price * all_stocks_owned_today
+    return final_stock_price * stock_aggregates['stocks_owned']
+
+
+def calculate_yearly_holdings(stock_df: pd.DataFrame, unique_years: List[int]) -> pd.DataFrame:
+    """
+    Calculates, in one pass over the transactions, the number of stocks held at the start and at the end of every
+    year and the money spent on the stock during that year.
+    :param stock_df: CSV file contents for a specific stock in dataframe format
+    :param unique_years: Years for which to calculate
+    :return: DataFrame indexed by year with the columns stocks_at_start_of_year, stocks_at_end_of_year and cash_flow
+    """
+    transactions_per_year = stock_df.groupby(stock_df['Datum'].dt.year)
+    all_years = sorted(set(transactions_per_year.groups) | set(unique_years))
+
+    stocks_bought = transactions_per_year['Aantal'].sum().reindex(all_years, fill_value=0)
+    # Summed like Series.sum does, so the floats come out exactly the same as when summing a filtered frame
+    cash_flow = transactions_per_year['Waarde'].agg(lambda waarde: waarde.sum()).reindex(all_years, fill_value=0.0)
+
+    stocks_at_end_of_year = stocks_bought.cumsum()
+    holdings = pd.DataFrame({
+        'stocks_at_start_of_year': stocks_at_end_of_year.shift(1, fill_value=0),
+        'stocks_at_end_of_year': stocks_at_end_of_year,
+        'cash_flow': cash_flow,
+    })
+    return holdings.loc[unique_years]
 
 
 def calculate_yearly_gains(stock_df: pd.DataFrame, yearly_prices: Dict[int, Dict[str, Union[float, None]]],
@@ -82,25 +124,19 @@ def calculate_yearly_gains(stock_df: pd.DataFrame, yearly_prices: Dict[int, Dict
     :return: A dictionary contain the unrealized gain in percent and value per year
     """
     yearly_gains = {}
+    holdings = calculate_yearly_holdings(stock_df, unique_years)
     for year in unique_years:
         start_of_year_value = yearly_prices[year]['start_price']
         end_of_year_stock_price = yearly_prices[year]['end_price']
 
-        # Filter the DataFrame for records up to the end of the previous year
-        previous_year_df = stock_df[stock_df['Datum'].dt.year < year]
-
-        # Calculate the total number of stocks owned up to the end of the previous year
-        total_stocks_previous_year = previous_year_df['Aantal'].sum()
+        # The total number of stocks owned up to the end of the previous year
+        total_stocks_previous_year = holdings.at[year, 'stocks_at_start_of_year']
         start_of_year_worth = total_stocks_previous_year * start_of_year_value
 
-        # Filter the DataFrame for records only for the current year
-        current_year_df = stock_df[stock_df['Datum'].dt.year == year]
-
-        # Calculate the total purchase price for the current year
-        total_purchase_price_this_year = current_year_df['Waarde'].sum() * -1
+        # The total purchase price for the current year
+        total_purchase_price_this_year = holdings.at[year, 'cash_flow'] * -1
 
-        all_years_upto_current_df = stock_df[stock_df['Datum'].dt.year <= year]
-        total_stocks_at_end_of_year = all_years_upto_current_df['Aantal'].sum()
+        total_stocks_at_end_of_year = holdings.at[year, 'stocks_at_end_of_year']
 
         # Skip if no stocks are held for a full year
         if total_stocks_previous_year == 0 and total_stocks_at_end_of_year == 0:
@@ -135,14 +171,14 @@ def calculate_yearly_worth(stock_df: pd.DataFrame, yearly_prices: Dict[int, Dict
     """
     yearly_worth = {}
     current_year = pd.to_datetime(date.today()).year
+    holdings = calculate_yearly_holdings(stock_df, unique_years)
 
     for year in unique_years:
         # Handle end of year
         end_of_year_timestamp = int(
             time.mktime(datetime(year, 1, 1, 12, 0, tzinfo=timezone.utc).timetuple()))
         end_of_year_stock_price = yearly_prices[year]['end_price']
-        all_years_upto_current_df = stock_df[stock_df['Datum'].dt.year <= year]
-        total_stocks_at_end_of_year = all_years_upto_current_df['Aantal'].sum()
+        total_stocks_at_end_of_year = holdings.at[year, 'stocks_at_end_of_year']
         end_of_year_worth = total_stocks_at_end_of_year * end_of_year_stock_price
         yearly_worth[end_of_year_timestamp] = int(end_of_year_worth)
 
@@ -152,17 +188,16 @@ def calculate_yearly_worth(stock_df: pd.DataFrame, yearly_prices: Dict[int, Dict
         mid_of_year_timestamp = int(
             time.mktime(datetime(year, 6, 30, 12, 0, tzinfo=timezone.utc).timetuple()))
         mid_of_year_stock_price = yearly_prices[year]['mid_price']
-        total_stocks_at_mid_of_year = all_years_upto_current_df['Aantal'].sum()
-        mid_of_year_worth = total_stocks_at_mid_of_year * mid_of_year_stock_price
-        yearly_worth[mid_of_year_timestamp] = int(mid_of_year_worth)
+        if mid_of_year_stock_price is not None:
+            mid_of_year_worth = total_stocks_at_end_of_year * mid_of_year_stock_price
+            yearly_worth[mid_of_year_timestamp] = int(mid_of_year_worth)
 
         # Handle end of Q1
         q1_end_of_year_timestamp = int(
             time.mktime(datetime(year, 3, 1, 12, 0, tzinfo=timezone.utc).timetuple()))
         q1_end_of_year_stock_price = yearly_prices[year]['Q1_end']
         if q1_end_of_year_stock_price:
-            total_stocks_at_q1_end_of_year = all_years_upto_current_df['Aantal'].sum()
-            q1_end_of_year_worth = total_stocks_at_q1_end_of_year * q1_end_of_year_stock_price
+            q1_end_of_year_worth = total_stocks_at_end_of_year * q1_end_of_year_stock_price
             yearly_worth[q1_end_of_year_timestamp] = int(q1_end_of_year_worth) if q1_end_of_year_stock_price else None
 
         # Handle end of Q3
@@ -170,8 +205,7 @@ def calculate_yearly_worth(stock_df: pd.DataFrame, yearly_prices: Dict[int, Dict
             time.mktime(datetime(year, 10, 1, 12, 0, tzinfo=timezone.utc).timetuple()))
         q3_end_of_year_stock_price = yearly_prices[year]['Q3_end']
         if q3_end_of_year_stock_price:
-            total_stocks_at_q3_end_of_year = all_years_upto_current_df['Aantal'].sum()
-            q3_end_of_year_worth = total_stocks_at_q3_end_of_year * q3_end_of_year_stock_price
+            q3_end_of_year_worth = total_stocks_at_end_of_year * q3_end_of_year_stock_price
             yearly_worth[q3_end_of_year_timestamp] = int(q3_end_of_year_worth) if q3_end_of_year_stock_price else None
 
     return yearly_worth
@@ -195,105 +229,374 @@ def calculate_total_portfolio_yearly_growth(yearly_worths_list: list) -> Dict[in
     return yearly_growth
 
 
-def calculate_realized_gain(stock_df: pd.DataFrame) -> float:
+def year_of_timestamp(timestamp: int) -> int:
+    return datetime.fromtimestamp(int(timestamp), tz=timezone.utc).year
+
+
+@timed_stage('compute')
+def calculate_stock_result(stock: str, stock_df: pd.DataFrame, stock_aggregates: Dict[str, float],
+                           yearly_prices: Dict[int, Dict[str, Union[float, None]]], unique_years: List[int]) -> dict:
     """
-    Calculates the realized gain for a given stock.
+    Calculates all results for a specific stock.
+    :param stock: name of the stock (the Product column)
     :param stock_df: CSV file contents for a specific stock in dataframe format
-    :return: A float representing the realized gain
+    :param stock_aggregates: Aggregated transactions of the stock, see calculate_stock_aggregates
+    :param yearly_prices: Open and close prices per year dictionary for the stock
+    :param unique_years: Years for which to calculate the yearly gains and worth, the last one being the current year
+    :return: Dictionary with the results of the stock
     """
-    # Filter out selling transactions, identified by a negative 'Aantal'
-    sell_df = stock_df[stock_df['Aantal'] < 0]
+    stock_result = {}  # Dictionary to store results for the current stock
 
-    # Calculate realized gain
-    realized_gain = sell_df['Waarde'].sum()
-    return round(realized_gain, 3)
+    final_stock_price = yearly_prices[unique_years[-1]]['end_price']  # stock price today
 
+    total_gain_percent = calculate_total_gain_percent(stock_aggregates, final_stock_price)
+    total_gain_value = calculate_total_gain_value(stock_aggregates, final_stock_price)
+    final_worth = calculate_final_worth(stock_aggregates, final_stock_price)
 
-def calculate_multi_year_gain(csv_file) -> dict:
-    df = check_and_convert_csv_headers(csv_file)
+    realized_gain = stock_aggregates['realized_gain']
+    yearly_gains = calculate_yearly_gains(stock_df, yearly_prices, unique_years)
+
+    all_stocks_owned_today = stock_aggregates['stocks_owned']
+    total_invested = stock_aggregates['total_invested']
+
+    stock_result['stock_name'] = stock
+    stock_result['total_gain_percent'] = total_gain_percent
+    stock_result['total_gain_value'] = total_gain_value
+    stock_result['total_invested'] = total_invested
+    stock_result['currently_invested'] = total_invested - realized_gain if (
+                                                                                   total_invested - realized_gain > 0 and all_stocks_owned_today) > 0 else 0
+    stock_result['final_worth'] = final_worth
+    stock_result['stocks_in_possession'] = all_stocks_owned_today
+    stock_result['yearly_gains'] = yearly_gains
+    stock_result['yearly_worth'] = calculate_yearly_worth(stock_df, yearly_prices, unique_years)
+    stock_result['realized_gain'] = realized_gain
+    stock_result['realized_profit_loss'] = realized_gain - total_invested
+    stock_result['profit_loss'] = round(realized_gain + final_worth - total_invested, 2)
+    return stock_result
+
+
+def merge_earlier_years(stock_result: dict, previous_result: dict, first_recomputed_year: int) -> dict:
+    """
+    Completes a stock result that was only calculated from first_recomputed_year onward with the yearly gains and
+    worth of the earlier years from a previous result.
+    """
+    stock_result['yearly_gains'] = {
+        **{year: gains for year, gains in previous_result['yearly_gains'].items() if year < first_recomputed_year},
+        **stock_result['yearly_gains']}
+    stock_result['yearly_worth'] = {
+        **{timestamp: worth for timestamp, worth in previous_result['yearly_worth'].items()
+           if year_of_timestamp(timestamp) < first_recomputed_year},
+        **stock_result['yearly_worth']}
+    return stock_result
+
+
+@timed_stage('summarize')
+def summarize_results(results: List[dict]) -> dict:
+    """
+    Calculates the totals of the whole portfolio.
+    :param results: the results per stock, see calculate_stock_result. Stocks that could not be analyzed (the ones
+    with an error) are left out
+    :return: Dictionary with the summary of the portfolio
+    """
+    results = [stock for stock in results if 'error' not in stock]
+    yearly_worths_list = [stock['yearly_worth'] for stock in results]
 
-    df['Datum'] = pd.to_datetime(df['Datum'], format='%d-%m-%Y')
-    unique_stocks = df['Product'].unique()
+    total_invested_all_stocks = sum(stock['total_invested'] for stock in results if stock['total_invested'] > 0)
+    total_gain_all_stocks = sum(stock['total_gain_value'] for stock in results)
+    if total_invested_all_stocks != 0:
+        total_gain_percentage = round((total_gain_all_stocks / total_invested_all_stocks) * 100, 2)
+    else:
+        # Nothing was invested in the stocks that could be analyzed, e.g. when none of them could
+        total_gain_percentage = 0
+    total_realized_gain = sum(stock['realized_gain'] for stock in results)
 
-    exchange_codes = ['AS', 'DE', 'XC', 'MI', 'XD', 'AQ', 'L']
+    total_worth_all_stocks = sum(stock['final_worth'] for stock in results)
+
+    return {
+        'total_worth': round(total_worth_all_stocks, 2),
+        'total_gain': round(total_gain_all_stocks, 2),
+        'total_gain_percentage': total_gain_percentage,
+        'total_invested_all_stocks': round(total_invested_all_stocks, 3),
+        'total_realized_gain': round(total_realized_gain, 3),
+        'yearly_worths_whole_portfolio': calculate_total_portfolio_yearly_growth(yearly_worths_list),
+        'total_realized_profit_loss': round(total_realized_gain - total_invested_all_stocks, 3),
+    }
 
-    results = []  # List to store results for each stock
 
-    for stock in unique_stocks:
-        stock_result = {}  # Dictionary to store results for the current stock
+class PortfolioAnalysis:
+    """
+    The analysis of the transactions of a portfolio, split in steps so the stocks can either be analyzed one after
+    the other (analyze_transactions) or concurrently (see portfolio_analyzer.async_analysis): the tickers are
+    resolved and passed to use_tickers, the prices of the known listings are fetched with fetch_known_listings,
+    analyze_stock is called for every stock of stocks() (or analyze_stocks is iterated) and the outcomes are combined
+    with summarize.
+    """
 
-        stock_df = df[df['Product'] == stock]
+    def __init__(self, df: pd.DataFrame, progress: Optional[Callable[[str, int, int], None]] = None,
+                 reusable_results: Optional[Dict[str, Tuple[dict, Optional[int]]]] = None,
+                 resolution: Optional[str] = None, points: Optional[int] = None):
+        """
+        See analyze_transactions for the parameters.
+        """
+        self.df = df
+        self.progress = progress
+        self.reusable_results = reusable_results or {}
+        self.resolution = resolution
+        self.points = points
+        self.aggregates = calculate_stock_aggregates(df)
+        self.stocks_total = len(self.aggregates)
+        self.stocks_done = {'resolved': 0, 'priced': 0, 'computed': 0}
+        self.progress_lock = threading.Lock()
+
+        # Stocks whose earlier result can be used as is do not have to be resolved and priced again
+        reused_stocks = [stock for stock, (_, first_year) in self.reusable_results.items() if first_year is None]
+        self.analyzed_df = df[~df['Product'].isin(reused_stocks)]
+        self.dates = series_dates(df['Datum'].min(), resolution) if resolution is not None else None
+
+        self.tickers: Dict[str, Optional[str]] = {}
+        self.exchange_codes_by_isin: Dict[str, str] = {}
+        self.currencies_by_isin: Dict[str, str] = {}
+        self.known_listings: Dict[str, str] = {}
+        self.price_indexes: Dict[str, PriceIndex] = {}
+        # The listing used for every priced stock with its ISIN, see record_usage
+        self.used_listings: Dict[str, str] = {}
+
+    def report_progress(self, stage: str, stocks: int = 1):
+        """
+        Counts stocks that passed a stage and calls the progress callback. Safe to call from multiple threads.
+        """
+        with self.progress_lock:
+            self.stocks_done[stage] += stocks
+            if self.progress is not None:
+                self.progress(stage, self.stocks_done[stage], self.stocks_total)
+
+    def isins_to_resolve(self) -> List[str]:
+        return list(self.analyzed_df['ISIN'].unique())
+
+    def use_tickers(self, tickers: Dict[str, Optional[str]]):
+        """
+        :param tickers: the ticker of every ISIN of isins_to_resolve, see cached_isins_to_tickers
+        """
+        self.tickers = tickers
+        self.report_progress('resolved', self.stocks_total)
+
+    def fetch_known_listings(self):
+        """
+        Downloads the prices of all products whose listing is known from earlier uploads at once.
+        """
+        self.exchange_codes_by_isin = remembered_exchange_codes(self.tickers)
+        self.currencies_by_isin = remembered_currencies(self.tickers)
+        self.known_listings = {isin: f"{self.tickers[isin]}.{exchange_code}"
+                               for isin, exchange_code in self.exchange_codes_by_isin.items()
+                               if self.tickers[isin] is not None}
+        start_date, end_date = price_history_range(populate_unique_years(self.analyzed_df))
+        self.price_indexes = {ticker: PriceIndex(price_history) for ticker, price_history in
+                              fetch_price_histories(list(self.known_listings.values()), start_date, end_date).items()}
+
+    def stocks(self):
+        """
+        :return: the name and the transactions of every stock, in the order of the results
+        """
+        return self.df.groupby('Product', sort=False, observed=True)
+
+    def analyze_stocks(self) -> Iterator[Tuple[Optional[dict], Optional[pd.Series]]]:
+        """
+        Analyzes the stocks one after the other.
+        :return: iterator over what analyze_stock returns for every stock, in the order of stocks()
+        """
+        for stock, stock_df in self.stocks():
+            yield self.analyze_stock(stock, stock_df)
+
+    def worth_series_to_timestamps(self, series: pd.Series) -> Dict[int, int]:
+        return series_to_timestamps(downsample_lttb(series, self.points) if self.points else series)
+
+    def analyze_stock(self, stock: str, stock_df: pd.DataFrame) -> Tuple[Optional[dict], Optional[pd.Series]]:
+        """
+        Prices a stock (looking for its listing when it is new) and calculates its result.
+        :param stock: name of the stock (the Product column)
+        :param stock_df: the transactions of the stock
+        :return: tuple of the result of the stock and its worth series. The result is None for a stock without any
+        prices, the worth series is None when no resolution was asked for or the result is not recalculated
+        """
+        previous_result, first_recomputed_year = self.reusable_results.get(stock, (None, None))
+        if previous_result is not None and first_recomputed_year is None:
+            self.report_progress('priced')
+            self.report_progress('computed')
+            return previous_result, None
 
         isin = stock_df['ISIN'].iloc[0]
-        ticker = isin_to_ticker(open_figi_api_key, isin)
-        print(ticker)
+        ticker = self.tickers[isin]
+        logger.debug("Analyzing %s (%s) as %s", stock, isin, ticker)
 
         if ticker is None:
-            stock_result['stock_name'] = stock
-            stock_result['error'] = f"Unable to find data for {isin}"
-            results.append(stock_result)
-            continue
+            self.report_progress('priced')
+            self.report_progress('computed')
+            return {'stock_name': stock, 'error': f"Unable to find data for {isin}"}, None
 
         unique_years = populate_unique_years(stock_df)
+        if previous_result is not None:
+            unique_years = [year for year in unique_years if year >= first_recomputed_year]
+
+        exchange_code = self.exchange_codes_by_isin.get(isin)
         yearly_prices = {}
-        for exchange_code in exchange_codes:
-            complete_ticker = f"{ticker}.{exchange_code}"
-            yearly_prices = fetch_yearly_stock_prices(complete_ticker, unique_years)
-            if yearly_prices:
-                break
+        if isin in self.known_listings:
+            price_index = self.price_indexes[self.known_listings[isin]]
+            yearly_prices = yearly_prices_from_history(price_index, unique_years)
 
+        # Look for another listing when the product is new or the known listing no longer has data
         if not yearly_prices:
-            continue
+            exchange_codes = candidate_exchange_codes(pd.concat([stock_df['Beurs'], stock_df['Uitvoeringsplaats']]))
+            exchange_codes = [code for code in exchange_codes if code != self.exchange_codes_by_isin.get(isin)]
+            exchange_code, price_history = find_listing(ticker, unique_years, exchange_codes)
+            price_index = PriceIndex(price_history)
+            yearly_prices = yearly_prices_from_history(price_index, unique_years)
 
-        final_stock_price = yearly_prices[unique_years[-1]]['end_price']  # stock price today
+        self.report_progress('priced')
 
-        total_gain_percent = calculate_total_gain_percent(stock_df, final_stock_price)
-        total_gain_value = calculate_total_gain_value(stock_df, final_stock_price)
-        final_worth = calculate_final_worth(stock_df, final_stock_price)
+        if not yearly_prices:
+            self.report_progress('computed')
+            return None, None
+
+        # The currency is remembered with the exchange code, it is only looked up for listings that are new
+        listing = f"{ticker}.{exchange_code}"
+        remembered_exchange_code = self.exchange_codes_by_isin.get(isin)
+        currency = self.currencies_by_isin.get(isin) if exchange_code == remembered_exchange_code else None
+        if currency is None:
+            currency = listing_currency(listing, exchange_code)
+        if exchange_code != remembered_exchange_code or currency != self.currencies_by_isin.get(isin):
+            remember_exchange_code(isin, exchange_code, currency)
+        self.used_listings[listing] = isin
+
+        if currency is None:
+            self.report_progress('computed')
+            return {'stock_name': stock, 'error': f"Unable to find the currency of {listing}"}, None
+
+        # The prices are in the currency of the listing, the transactions in the currency of the account
+        if currency != account_currency:
+            try:
+                price_index = convert_price_index(price_index, currency)
+            except MissingExchangeRates as e:
+                self.report_progress('computed')
+                return {'stock_name': stock, 'error': str(e)}, None
+            yearly_prices = yearly_prices_from_history(price_index, unique_years)
+
+        stock_result = calculate_stock_result(stock, stock_df, self.aggregates[stock], yearly_prices, unique_years)
+        if previous_result is not None:
+            stock_result = merge_earlier_years(stock_result, previous_result, first_recomputed_year)
+        worth_series = None
+        if self.resolution is not None:
+            worth_series = calculate_worth_series(stock_df, price_index, self.dates)
+            stock_result['worth_series'] = self.worth_series_to_timestamps(worth_series)
+
+        self.report_progress('computed')
+        return stock_result, worth_series
+
+    def record_usage(self):
+        """
+        Counts the use of the listings that were priced, so the most used ones are kept warm (see warm_cache).
+        """
+        record_ticker_usage(self.used_listings)
+
+    def summarize(self, stock_outcomes: List[Tuple[Optional[dict], Optional[pd.Series]]]) -> dict:
+        """
+        :param stock_outcomes: what analyze_stock returned for every stock, in the order of stocks()
+        :return: dictionary with the results per stock and a summary of the whole portfolio
+        """
+        results = [stock_result for stock_result, _ in stock_outcomes if stock_result is not None]
+        return {'results': results, 'summary': self.summary(stock_outcomes)}
+
+    def summary(self, stock_outcomes: List[Tuple[Optional[dict], Optional[pd.Series]]]) -> dict:
+        """
+        :param stock_outcomes: what analyze_stock returned for every stock, in the order of stocks()
+        :return: dictionary with the summary of the whole portfolio, see summarize_results
+        """
+        summary = summarize_results([stock_result for stock_result, _ in stock_outcomes if stock_result is not None])
+        if self.resolution is not None:
+            summary['worth_series_whole_portfolio'] = self.worth_series_to_timestamps(
+                total_worth_series([series for _, series in stock_outcomes if series is not None]))
+        return summary
+
+
+def analyze_transactions(df: pd.DataFrame, progress: Optional[Callable[[str, int, int], None]] = None,
+                         reusable_results: Optional[Dict[str, Tuple[dict, Optional[int]]]] = None,
+                         resolution: Optional[str] = None, points: Optional[int] = None) -> dict:
+    """
+    Analyzes the transactions of a portfolio.
+    :param df: CSV file contents in dataframe format, see check_and_convert_csv_headers
+    :param progress: optional callback that is called with the stage ('resolved', 'priced' or 'computed'), the number
+    of products that passed that stage and the total number of products whenever a product passes a stage
+    :param reusable_results: optional results of an earlier analysis per stock, together with the first year that has
+    to be recalculated. When that year is None the earlier result is used as is, otherwise only the yearly gains and
+    worth from that year onward are recalculated
+    :param resolution: optional 'daily', 'weekly' or 'monthly'. When given, the worth of every recalculated stock and
+    of the whole portfolio is also calculated at that resolution, as worth_series in the results and
+    worth_series_whole_portfolio in the summary
+    :param points: optional maximum number of points per worth series, longer series are downsampled
+    :return: dictionary with the results per stock and a summary of the whole portfolio
+    """
+    analysis = {'results': []}
+    for record_type, record in stream_transactions(df, progress, reusable_results, resolution, points):
+        if record_type == 'result':
+            analysis['results'].append(record)
+        else:
+            analysis['summary'] = record
+    return analysis
 
-        realized_gain = calculate_realized_gain(stock_df)
-        yearly_gains = calculate_yearly_gains(stock_df, yearly_prices, unique_years)
 
-        all_stocks_owned_today = stock_df['Aantal'].sum()
-        total_invested = stock_df[stock_df['Waarde'] < 0]['Waarde'].sum() * -1
+def stream_transactions(df: pd.DataFrame, progress: Optional[Callable[[str, int, int], None]] = None,
+                        reusable_results: Optional[Dict[str, Tuple[dict, Optional[int]]]] = None,
+                        resolution: Optional[str] = None,
+                        points: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Analyzes the transactions of a portfolio like analyze_transactions, but yields the result of every stock as soon
+    as it is calculated. The tickers are resolved and the prices of the known listings fetched before the first result.
+    See analyze_transactions for the parameters.
+    :return: iterator over ('result', result of a stock) for every stock with a result, in the order of the results,
+    followed by ('summary', summary of the whole portfolio)
+    """
+    analysis = PortfolioAnalysis(df, progress, reusable_results, resolution, points)
 
-        stock_result['stock_name'] = stock
-        stock_result['total_gain_percent'] = total_gain_percent
-        stock_result['total_gain_value'] = total_gain_value
-        stock_result['total_invested'] = total_invested
-        stock_result['currently_invested'] = total_invested - realized_gain if (
-                                                                                       total_invested - realized_gain > 0 and all_stocks_owned_today) > 0 else 0
-        stock_result['final_worth'] = final_worth
-        stock_result['stocks_in_possession'] = all_stocks_owned_today
-        stock_result['yearly_gains'] = yearly_gains
-        stock_result['yearly_worth'] = calculate_yearly_worth(stock_df, yearly_prices, unique_years)
-        stock_result['realized_gain'] = realized_gain
-        stock_result['realized_profit_loss'] = realized_gain - total_invested
-        stock_result['profit_loss'] = round(realized_gain + final_worth - total_invested, 2)
+    # Resolve the tickers of all products in as few OpenFIGI requests as possible
+    analysis.use_tickers(cached_isins_to_tickers(open_figi_api_key, analysis.isins_to_resolve()))
+    analysis.fetch_known_listings()
 
-        results.append(stock_result)
+    stock_outcomes = []
+    for stock_result, worth_series in analysis.analyze_stocks():
+        stock_outcomes.append((stock_result, worth_series))
+        if stock_result is not None:
+            yield 'result', stock_result
+    analysis.record_usage()
+    yield 'summary', analysis.summary(stock_outcomes)
 
-    # --- Total Stats
-    yearly_worths_list = [stock['yearly_worth'] for stock in results]
 
-    total_invested_all_stocks = sum(stock['total_invested'] for stock in results if stock['total_invested'] > 0)
-    total_gain_all_stocks = sum(stock['total_gain_value'] for stock in results)
-    total_gain_percentage = round((total_gain_all_stocks / total_invested_all_stocks) * 100, 2)
-    total_realized_gain = sum(stock['realized_gain'] for stock in results)
-
-    total_worth_all_stocks = sum(stock['final_worth'] for stock in results)
+def calculate_multi_year_gain(csv_file, progress: Optional[Callable[[str, int, int], None]] = None,
+                              resolution: Optional[str] = None, points: Optional[int] = None) -> dict:
+    """
+    Analyzes a DeGiro transactions export.
+    :param csv_file: the exported CSV file
+    :param progress: optional callback that is called with the stage ('resolved', 'priced' or 'computed'), the number
+    of products that passed that stage and the total number of products whenever a product passes a stage
+    :param resolution: optional resolution of the worth series, see analyze_transactions
+    :param points: optional maximum number of points per worth series
+    :return: dictionary with the results per stock and a summary of the whole portfolio
+    """
+    df = check_and_convert_csv_headers(csv_file)
+    return analyze_transactions(df, progress=progress, resolution=resolution, points=points)
 
-    summary = {
-        'total_worth': round(total_worth_all_stocks, 2),
-        'total_gain': round(total_gain_all_stocks, 2),
-        'total_gain_percentage': total_gain_percentage,
-        'total_invested_all_stocks': round(total_invested_all_stocks, 3),
-        'total_realized_gain': round(total_realized_gain, 3),
-        'yearly_worths_whole_portfolio': calculate_total_portfolio_yearly_growth(yearly_worths_list),
-        'total_realized_profit_loss': round(total_realized_gain - total_invested_all_stocks, 3),
-    }
 
-    return {'results': results, 'summary': summary}
+def stream_multi_year_gain(csv_file, resolution: Optional[str] = None,
+                           points: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Same as calculate_multi_year_gain, but yields the result of every stock as soon as it is calculated, see
+    stream_transactions. The export is read before the first record is asked for, so an invalid export raises the
+    ValueError right away.
+    :param csv_file: the exported CSV file
+    :param resolution: optional resolution of the worth series, see analyze_transactions
+    :param points: optional maximum number of points per worth series
+    :return: iterator over ('result', result of a stock) records followed by a ('summary', summary) record
+    """
+    df = check_and_convert_csv_headers(csv_file)
+    return stream_transactions(df, resolution=resolution, points=points)
 
 
 if __name__ == "__main__":
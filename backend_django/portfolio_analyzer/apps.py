@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def enable_sqlite_write_ahead_log(sender, connection, **kwargs):
+    """
+    Switches SQLite to write-ahead logging. With the default rollback journal a write has to wait until no thread is
+    reading, which with many analyses reading and storing prices at the same time can take longer than the timeout.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
 
 
 class PortfolioAnalyzerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'portfolio_analyzer'
+
+    def ready(self):
+        connection_created.connect(enable_sqlite_write_ahead_log)
+        if settings.SYNTHETIC_MARKET_DATA:
+            from .benchmarks.providers import install_synthetic_market_data
+            install_synthetic_market_data(latency=settings.SYNTHETIC_MARKET_DATA_LATENCY)
@@ -0,0 +1,183 @@
+import asyncio
+import contextvars
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Iterable
+
+import httpx
+import pandas as pd
+from django.conf import settings
+from django.db import connection
+
+from .analyze_portfolio import PortfolioAnalysis
+from .instrumentation import timed_stage, external_call, external_call_failed, registry
+from .stockdata_fetchers import check_and_convert_csv_headers, open_figi_api_key, open_figi_mapping_url, \
+    open_figi_rate_limiter, openfigi_chunks, openfigi_headers, openfigi_mapping_payload, \
+    tickers_from_openfigi_mapping, fresh_cached_tickers, store_fetched_tickers, market_data_session, CircuitOpen, \
+    is_host_failure
+
+# Threads that run the blocking parts of the async analyses (pandas, yfinance and the database), shared by all
+# requests of the process so the number of threads stays bounded however many uploads are analyzed at once
+analysis_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_ANALYSIS_THREADS, thread_name_prefix='async-analysis')
+
+# Statuses that are retried, like the market data session does (see create_market_data_session)
+retried_statuses = {429, 500, 502, 503, 504}
+
+
+def close_connection_after(function, *args):
+    try:
+        return function(*args)
+    finally:
+        # The executor threads are not request threads, Django would not close their database connections
+        connection.close()
+
+
+async def run_blocking(function, *args):
+    """
+    Runs a blocking function on analysis_executor without blocking the event loop. It runs in a copy of the current
+    context, so its timings count towards the running analysis.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        analysis_executor, context.run, close_connection_after, function, *args)
+
+
+def create_market_data_client() -> httpx.AsyncClient:
+    """
+    Creates an async HTTP client with the same timeout and pool size as the market data session. Its connections can
+    only be used from the event loop that opened them, and under WSGI every request runs on an event loop of its own,
+    so the client has to be closed (async with) before the loop ends.
+    """
+    connect_timeout, read_timeout = settings.MARKET_DATA_TIMEOUT
+    return httpx.AsyncClient(timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                             limits=httpx.Limits(max_connections=settings.MARKET_DATA_POOL_SIZE))
+
+
+def retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    """
+    Same policy as MarketDataRetry: a Retry-After or ratelimit-reset header is honoured up to
+    settings.MARKET_DATA_MAX_RETRY_AFTER seconds, otherwise the backoff is exponential and fully jittered.
+    :param attempt: number of the attempt that failed, starting at 0
+    """
+    if response is not None:
+        for header in ('Retry-After', 'ratelimit-reset'):
+            try:
+                return min(float(response.headers[header]), settings.MARKET_DATA_MAX_RETRY_AFTER)
+            except (KeyError, ValueError):
+                continue
+    return random.uniform(0, settings.MARKET_DATA_BACKOFF * 2 ** attempt)
+
+
+async def post_market_data(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """
+    Async counterpart of market_data_session.post: transport errors, 429s and 5xx responses are retried, and the call
+    goes through the same circuit breaker of the host as the calls of the session.
+    :param client: client to post with, see create_market_data_client
+    :raises CircuitOpen: when the host is failing
+    :raises httpx.TransportError: when the last attempt failed
+    """
+    circuit_breaker = market_data_session.get_adapter(url).circuit_breaker(httpx.URL(url).host)
+    circuit_breaker.before_call()
+    recorded = False
+    try:
+        for attempt in range(settings.MARKET_DATA_RETRIES + 1):
+            last_attempt = attempt == settings.MARKET_DATA_RETRIES
+            response = None
+            try:
+                response = await client.post(url, **kwargs)
+            except httpx.TransportError:
+                if last_attempt:
+                    recorded = True
+                    circuit_breaker.record_failure()
+                    raise
+            else:
+                if response.status_code not in retried_statuses or last_attempt:
+                    recorded = True
+                    if is_host_failure(response.status_code):
+                        circuit_breaker.record_failure()
+                    else:
+                        circuit_breaker.record_success()
+                    return response
+
+            registry.increment('external_call_retries_total')
+            await asyncio.sleep(retry_delay(attempt, response))
+    finally:
+        if not recorded:
+            # Cancelled (e.g. the client went away) or failed before the host answered, a trial call must not leave
+            # the circuit open for good
+            circuit_breaker.record_abandoned()
+
+
+async def fetch_tickers_from_openfigi_async(openfigi_apikey: str, isins: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Same as fetch_tickers_from_openfigi, but the mapping requests are sent at the same time (as far as the rate
+    limiter allows) without blocking the event loop.
+    """
+    async def fetch_chunk(client: httpx.AsyncClient, chunk: List[str]) -> Dict[str, Optional[str]]:
+        await open_figi_rate_limiter.acquire_async()
+        try:
+            with external_call('openfigi'):
+                response = await post_market_data(client, open_figi_mapping_url,
+                                                  headers=openfigi_headers(openfigi_apikey),
+                                                  content=openfigi_mapping_payload(chunk))
+        except (httpx.TransportError, CircuitOpen):
+            return {}
+        open_figi_rate_limiter.update_from_headers(response.headers)
+
+        if response.status_code != 200:
+            external_call_failed('openfigi')
+            return {}
+        return tickers_from_openfigi_mapping(chunk, response.json())
+
+    async with create_market_data_client() as client:
+        chunk_results = await asyncio.gather(*(fetch_chunk(client, chunk)
+                                               for chunk in openfigi_chunks(openfigi_apikey, isins)))
+    tickers = {}
+    for chunk_tickers in chunk_results:
+        tickers.update(chunk_tickers)
+    return tickers
+
+
+@timed_stage('resolve')
+async def cached_isins_to_tickers_async(openfigi_apikey: str, isins: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Same as cached_isins_to_tickers, with the lookups at OpenFIGI made by fetch_tickers_from_openfigi_async.
+    """
+    isins = list(dict.fromkeys(isins))
+    tickers, mappings = await run_blocking(fresh_cached_tickers, isins)
+    missing_isins = [isin for isin in isins if isin not in tickers]
+    if missing_isins:
+        fetched_tickers = await fetch_tickers_from_openfigi_async(openfigi_apikey, missing_isins)
+        tickers.update(await run_blocking(store_fetched_tickers, missing_isins, fetched_tickers, mappings))
+    return tickers
+
+
+async def analyze_transactions_async(df: pd.DataFrame, resolution: Optional[str] = None,
+                                     points: Optional[int] = None) -> dict:
+    """
+    Same as analyze_transactions, but the stocks are priced and calculated concurrently, up to
+    settings.ASYNC_ANALYSIS_STOCK_CONCURRENCY at the same time. Only the OpenFIGI lookups run on the event loop, all
+    blocking work runs on analysis_executor.
+    """
+    analysis = await run_blocking(PortfolioAnalysis, df, None, None, resolution, points)
+    analysis.use_tickers(await cached_isins_to_tickers_async(open_figi_api_key, analysis.isins_to_resolve()))
+    await run_blocking(analysis.fetch_known_listings)
+
+    concurrency = asyncio.Semaphore(settings.ASYNC_ANALYSIS_STOCK_CONCURRENCY)
+
+    async def analyze_stock(stock: str, stock_df: pd.DataFrame):
+        async with concurrency:
+            return await run_blocking(analysis.analyze_stock, stock, stock_df)
+
+    stock_outcomes = await asyncio.gather(*(analyze_stock(stock, stock_df) for stock, stock_df in analysis.stocks()))
+    await run_blocking(analysis.record_usage)
+    return await run_blocking(analysis.summarize, list(stock_outcomes))
+
+
+async def calculate_multi_year_gain_async(csv_file, resolution: Optional[str] = None,
+                                          points: Optional[int] = None) -> dict:
+    """
+    Same as calculate_multi_year_gain, see analyze_transactions_async.
+    """
+    df = await run_blocking(check_and_convert_csv_headers, csv_file)
+    return await analyze_transactions_async(df, resolution=resolution, points=points)
@@ -0,0 +1,172 @@
+import json
+import logging
+import sys
+from typing import Dict, List, Optional, Iterable
+
+from django.db import connection
+from rest_framework.utils.encoders import JSONEncoder
+
+from .analyze_portfolio import calculate_multi_year_gain, populate_unique_years
+from .instrumentation import collect_metrics
+from .stockdata_fetchers import check_and_convert_csv_headers, cached_isins_to_tickers, open_figi_api_key, \
+    remembered_exchange_codes, fetch_price_histories, price_history_range
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+
+def scan_file(path: str) -> Optional[dict]:
+    """
+    Reads the ISINs and the years of the transactions of an export, used to fill the shared caches before the exports
+    are analyzed. Runs in a worker process.
+    :return: dictionary with the isins and years, None if the file cannot be read (analyze_file reports the error)
+    """
+    try:
+        with open(path, 'rb') as f:
+            df = check_and_convert_csv_headers(f)
+        return {'isins': df['ISIN'].unique().tolist(), 'years': populate_unique_years(df)}
+    except Exception:
+        return None
+    finally:
+        connection.close()
+
+
+def warm_shared_caches(scans: Iterable[Optional[dict]]):
+    """
+    Resolves the tickers of all exports and downloads the prices of the listings that are already known before the
+    exports are analyzed. The ticker and price caches live in the database, so the worker processes find them there
+    instead of each calling OpenFIGI and Yahoo Finance for the same products (the rate limiter of OpenFIGI only works
+    within a process).
+    :param scans: results of scan_file
+    """
+    isins, years = set(), set()
+    for scan in scans:
+        if scan is not None:
+            isins.update(scan['isins'])
+            years.update(scan['years'])
+    if not isins:
+        return
+
+    tickers = cached_isins_to_tickers(open_figi_api_key, sorted(isins))
+    exchange_codes_by_isin = remembered_exchange_codes(tickers)
+    known_listings = [f"{tickers[isin]}.{exchange_code}"
+                      for isin, exchange_code in exchange_codes_by_isin.items() if tickers[isin] is not None]
+    start_date, end_date = price_history_range(sorted(years))
+    fetch_price_histories(known_listings, start_date, end_date)
+
+
+def analyze_file(path: str, resolution: Optional[str] = None, points: Optional[int] = None) -> dict:
+    """
+    Runs calculate_multi_year_gain for an export. Runs in a worker process, an export that fails does not stop the
+    others: the error is returned instead of raised.
+    :return: dictionary with the file, the status ('ok' or 'error'), the result or the error, the duration and the time
+    spent per stage
+    """
+    record = {'file': path}
+    try:
+        with collect_metrics('batch_file') as metrics:
+            metrics.fields['file'] = path
+            try:
+                with open(path, 'rb') as f:
+                    record['result'] = calculate_multi_year_gain(f, resolution=resolution, points=points)
+                record['status'] = metrics.fields['status'] = 'ok'
+            except ValueError as e:
+                record['status'] = metrics.fields['status'] = 'error'
+                record['error'] = str(e)
+            except Exception as e:
+                logger.exception("Analysis of %s failed", path)
+                record['status'] = metrics.fields['status'] = 'error'
+                record['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        connection.close()
+
+    record['seconds'] = metrics.duration
+    record['stages'] = dict(metrics.stages)
+    return record
+
+
+class JsonLinesWriter:
+    """
+    Writes every record as a line of JSON as soon as it is done, to a file or to stdout ('-').
+    """
+
+    def __init__(self, path: str):
+        self.file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8')
+
+    def write(self, record: dict):
+        self.file.write(json.dumps({key: value for key, value in record.items() if key != 'stages'},
+                                   cls=JSONEncoder) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ParquetWriter:
+    """
+    Writes a row per stock (or a single row for an export that failed) to a Parquet file, with the file and its
+    status on every row. The dictionaries per year and the worth series are stored as JSON. Rows are written in a
+    row group every row_group_files exports, so the whole batch is never held in memory.
+    """
+    numeric_columns = ['total_gain_percent', 'total_gain_value', 'total_invested', 'final_worth']
+    json_columns = ['yearly_gains', 'yearly_worth', 'worth_series']
+
+    def __init__(self, path: str, row_group_files: int = 100):
+        if pq is None:
+            raise ValueError("Parquet output needs pyarrow, install it or write JSON lines instead")
+        self.schema = pa.schema(
+            [('file', pa.string()), ('status', pa.string()), ('error', pa.string()), ('seconds', pa.float64()),
+             ('stock_name', pa.string())] +
+            [(column, pa.float64()) for column in self.numeric_columns] +
+            [('stocks_in_possession', pa.int64())] +
+            [(column, pa.string()) for column in self.json_columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_files = row_group_files
+        self.rows: List[Dict] = []
+        self.files = 0
+
+    def write(self, record: dict):
+        file_fields = {'file': record['file'], 'status': record['status'], 'seconds': record['seconds']}
+        if record['status'] != 'ok':
+            self.rows.append({**file_fields, 'error': record['error']})
+        for stock in record.get('result', {}).get('results', []):
+            row = {**file_fields, 'stock_name': stock['stock_name'], 'error': stock.get('error'),
+                   'stocks_in_possession': stock.get('stocks_in_possession')}
+            row.update({column: stock.get(column) for column in self.numeric_columns})
+            row.update({column: json.dumps(stock[column], cls=JSONEncoder) if column in stock else None
+                        for column in self.json_columns})
+            self.rows.append(row)
+
+        self.files += 1
+        if self.files % self.row_group_files == 0:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_writer(path: str, output_format: Optional[str] = None):
+    """
+    :param path: file to write to, '-' for stdout
+    :param output_format: 'jsonl' or 'parquet', by default derived from the extension of the path
+    :return: JsonLinesWriter or ParquetWriter
+    """
+    if output_format is None:
+        output_format = 'parquet' if path.endswith('.parquet') else 'jsonl'
+    if output_format == 'parquet':
+        if path == '-':
+            raise ValueError("Parquet output cannot be written to stdout")
+        return ParquetWriter(path)
+    return JsonLinesWriter(path)
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from contextlib import contextmanager, ExitStack
+from typing import Dict, Iterable, Optional, List
+from unittest import mock
+
+import pandas as pd
+
+from .synthetic import synthetic_closes, synthetic_ticker
+
+
+class SyntheticMarketData:
+    """
+    Deterministic, offline stand-in for OpenFIGI and Yahoo Finance. Every ISIN maps to a synthetic ticker that is
+    only listed on one exchange, its prices come from synthetic_price_history.
+    """
+
+    def __init__(self, exchange_code: str = 'AS', latency: float = 0.0):
+        """
+        :param exchange_code: Yahoo Finance suffix of the only exchange that has prices
+        :param latency: seconds every call sleeps, to simulate the network
+        """
+        self.exchange_code = exchange_code
+        self.latency = latency
+        self.calls = {'openfigi': 0, 'download': 0, 'history': 0}
+
+    def _call(self, name: str):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def closes(self, ticker: str, start, end) -> pd.Series:
+        if not ticker.endswith(f".{self.exchange_code}"):
+            return pd.Series(dtype=float, name='Close')
+        return synthetic_closes(ticker, start, end)
+
+    def fetch_tickers_from_openfigi(self, openfigi_apikey: str, isins: Iterable[str]) -> Dict[str, Optional[str]]:
+        self._call('openfigi')
+        return {isin: synthetic_ticker(isin) for isin in isins}
+
+    async def fetch_tickers_from_openfigi_async(self, openfigi_apikey: str,
+                                                isins: Iterable[str]) -> Dict[str, Optional[str]]:
+        self.calls['openfigi'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {isin: synthetic_ticker(isin) for isin in isins}
+
+    def download(self, tickers, start=None, end=None, **kwargs) -> pd.DataFrame:
+        """
+        Mimics yf.download: flat columns for a single ticker, (field, ticker) columns for a list of tickers.
+        """
+        self._call('download')
+        if isinstance(tickers, str):
+            return self.closes(tickers, start, end).to_frame('Close')
+
+        closes = pd.DataFrame({ticker: self.closes(ticker, start, end) for ticker in tickers})
+        if closes.dropna(how='all').empty:
+            return pd.DataFrame()
+        closes.columns = pd.MultiIndex.from_product([['Close'], closes.columns])
+        return closes
+
+    def ticker(self, ticker: str, session=None):
+        market_data = self
+
+        class SyntheticTicker:
+            def history(self, start=None, end=None, **kwargs) -> pd.DataFrame:
+                market_data._call('history')
+                return market_data.closes(ticker, start, end).to_frame('Close')
+
+            def get_history_metadata(self) -> dict:
+                market_data._call('history')
+                # The synthetic prices are in euro, like the synthetic exports
+                return {'currency': 'EUR'}
+
+        return SyntheticTicker()
+
+
+def market_data_patches(market_data: SyntheticMarketData) -> List:
+    return [mock.patch('portfolio_analyzer.stockdata_fetchers.fetch_tickers_from_openfigi',
+                       market_data.fetch_tickers_from_openfigi),
+            mock.patch('portfolio_analyzer.async_analysis.fetch_tickers_from_openfigi_async',
+                       market_data.fetch_tickers_from_openfigi_async),
+            mock.patch('yfinance.download', market_data.download),
+            mock.patch('yfinance.Ticker', market_data.ticker)]
+
+
+@contextmanager
+def synthetic_market_data(exchange_code: str = 'AS', latency: float = 0.0):
+    """
+    Replaces the OpenFIGI and Yahoo Finance calls in stockdata_fetchers with SyntheticMarketData while active.
+    :return: the SyntheticMarketData, whose calls attribute counts the calls per provider
+    """
+    market_data = SyntheticMarketData(exchange_code=exchange_code, latency=latency)
+    with ExitStack() as stack:
+        for patch in market_data_patches(market_data):
+            stack.enter_context(patch)
+        yield market_data
+
+
+def install_synthetic_market_data(exchange_code: str = 'AS', latency: float = 0.0) -> SyntheticMarketData:
+    """
+    Replaces the OpenFIGI and Yahoo Finance calls with SyntheticMarketData for the rest of the process, for servers
+    that are load tested (see settings.SYNTHETIC_MARKET_DATA). The synthetic uploads of generate_degiro_csv can then
+    be analyzed without reaching the real providers.
+    """
+    market_data = SyntheticMarketData(exchange_code=exchange_code, latency=latency)
+    for patch in market_data_patches(market_data):
+        patch.start()
+    return market_data
@@ -0,0 +1,85 @@
+import random
+import zlib
+from datetime import date, timedelta
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Header of a (Dutch) DeGiro transactions export, see check_and_convert_csv_headers
+degiro_csv_header = ("Datum,Tijd,Product,ISIN,Beurs,Uitvoeringsplaats,Aantal,Koers,,Lokale waarde,,Waarde,,"
+                     "Wisselkoers,Transactiekosten en/of,,Totaal,,Order ID")
+
+# Synthetic prices exist from this day onward
+price_epoch = date(2000, 1, 1)
+
+
+def synthetic_isin(product_number: int) -> str:
+    return f"XS{product_number:010d}"
+
+
+def synthetic_ticker(isin: str) -> str:
+    return f"SYN{isin[-4:]}"
+
+
+@lru_cache(maxsize=None)
+def synthetic_price_history(ticker: str) -> pd.Series:
+    """
+    A deterministic random walk of daily closes from price_epoch until today, seeded by the ticker. Like a real
+    exchange there are only closes on weekdays.
+    :param ticker: ticker + exchange code (SYN0001.AS)
+    :return: Series with the close per trading day
+    """
+    days = pd.bdate_range(price_epoch, date.today())
+    rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+    returns = rng.normal(0.0003, 0.012, len(days))
+    return pd.Series(np.round(rng.uniform(20, 200) * np.exp(np.cumsum(returns)), 4), index=days, name='Close')
+
+
+def synthetic_closes(ticker: str, start, end) -> pd.Series:
+    """
+    :return: the synthetic closes of a ticker in the range [start, end)
+    """
+    history = synthetic_price_history(ticker)
+    return history[(history.index >= pd.Timestamp(start)) & (history.index < pd.Timestamp(end))]
+
+
+def generate_degiro_csv(products: int = 10, transactions: int = 200, years: int = 5, seed: int = 0,
+                        exchange_code: str = 'AS') -> bytes:
+    """
+    Generates a DeGiro transactions export in the exact column layout of the real export: newest transaction first,
+    trade prices taken from the synthetic price history and sales never exceeding the number of stocks held.
+    :param products: number of different products
+    :param transactions: total number of transactions
+    :param years: number of years the transactions are spread over, ending today
+    :param seed: seed of the random generator, the same arguments and seed always give the same file
+    :param exchange_code: Yahoo Finance suffix of the listing the synthetic prices are taken from
+    :return: contents of the CSV file
+    """
+    rng = random.Random(seed)
+    first_day = date.today() - timedelta(days=365 * years)
+    trading_days = pd.bdate_range(first_day, date.today() - timedelta(days=1))
+
+    trades = sorted((trading_days[rng.randrange(len(trading_days))], rng.randrange(products))
+                    for _ in range(transactions))
+
+    holdings = [0] * products
+    rows = []
+    for order_number, (day, product) in enumerate(trades):
+        isin = synthetic_isin(product)
+        price = float(synthetic_price_history(f"{synthetic_ticker(isin)}.{exchange_code}").asof(day))
+
+        if holdings[product] > 0 and rng.random() < 0.15:
+            amount = -rng.randint(1, holdings[product])
+        else:
+            amount = rng.randint(1, 20)
+        holdings[product] += amount
+
+        value = round(-amount * price, 2)
+        costs = -2.0
+        order_id = f"{rng.getrandbits(32):08x}-{order_number:04x}-synthetic"
+        rows.append(f"{day:%d-%m-%Y},{rng.randint(9, 17):02d}:{rng.randint(0, 59):02d},SYNTHETIC PRODUCT {product},"
+                    f"{isin},EAM,XAMS,{amount},{price:.4f},EUR,{value:.2f},EUR,{value:.2f},EUR,,{costs:.2f},EUR,"
+                    f"{value + costs:.2f},EUR,{order_id}")
+
+    return "\n".join([degiro_csv_header] + rows[::-1]).encode('utf-8') + b"\n"
@@ -0,0 +1,117 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Dict, List
+
+from django.db import connection, transaction
+from django.db.models import F, Max, Sum
+from django.utils import timezone
+
+from .instrumentation import submit_with_context
+from .models import TickerMapping, TickerUsage
+from .stockdata_fetchers import fetch_tickers_from_openfigi, store_fetched_tickers, fetch_price_history, \
+    open_figi_api_key
+
+logger = logging.getLogger(__name__)
+
+
+def record_ticker_usage(isins_by_listing: Dict[str, str]):
+    """
+    Counts a request on the current day for every listing an analysis used the prices of. The transaction starts with a
+    write, see store_close_prices.
+    :param isins_by_listing: dictionary with the listing (ticker + exchange code, VUSA.AS) as key and its ISIN as value
+    """
+    if not isins_by_listing:
+        return
+
+    today = timezone.localdate()
+    with transaction.atomic():
+        TickerUsage.objects.filter(ticker__in=list(isins_by_listing), date=today).update(
+            request_count=F('request_count') + 1)
+        # Listings that were not used yet today, the ones updated above are left alone
+        TickerUsage.objects.bulk_create(
+            [TickerUsage(ticker=listing, isin=isin, date=today, request_count=1)
+             for listing, isin in isins_by_listing.items()], ignore_conflicts=True)
+
+
+def hot_tickers(days: int, limit: int) -> Dict[str, str]:
+    """
+    :param days: only the requests of the last this many days (including today) are counted
+    :param limit: maximum number of listings to return
+    :return: dictionary with the listings requested most within the last days as key and their ISIN as value, most
+    requested first
+    """
+    usages = (TickerUsage.objects.filter(date__gt=timezone.localdate() - timedelta(days=days))
+              .values('ticker')
+              .annotate(recent_request_count=Sum('request_count'), listing_isin=Max('isin'))
+              .order_by('-recent_request_count', 'ticker')[:limit])
+    return {usage['ticker']: usage['listing_isin'] for usage in usages}
+
+
+def forget_ticker_usage(days: int) -> int:
+    """
+    Deletes the usage counted before the last days, which no longer decides which listings are hot.
+    :return: the number of deleted days of listings
+    """
+    deleted, _ = TickerUsage.objects.filter(date__lte=timezone.localdate() - timedelta(days=days)).delete()
+    return deleted
+
+
+def refresh_ticker_mappings(isins: List[str]) -> int:
+    """
+    Looks up the ISINs whose ticker mapping is missing or expires within a day at OpenFIGI again, so analyses during
+    the next day find a fresh mapping.
+    :return: the number of mappings that were refreshed
+    """
+    mappings = {mapping.isin: mapping for mapping in TickerMapping.objects.filter(isin__in=isins)}
+    expires_before = timezone.now() + timedelta(days=1)
+    expiring_isins = [isin for isin in isins if isin not in mappings or mappings[isin].expires_at < expires_before]
+    if not expiring_isins:
+        return 0
+
+    fetched_tickers = fetch_tickers_from_openfigi(open_figi_api_key, expiring_isins)
+    store_fetched_tickers(expiring_isins, fetched_tickers, mappings)
+    return len(fetched_tickers)
+
+
+def refresh_price_histories(tickers: List[str], workers: int) -> List[str]:
+    """
+    Downloads the closes of the listings that are not held yet, up to and including today, with at most workers
+    downloads at the same time. Analyses on the next day then only read the closes from the database.
+    :param tickers: listings (ticker + exchange code, VUSA.AS)
+    :param workers: number of listings downloaded at the same time
+    :return: the listings that could not be refreshed
+    """
+    today = date.today()
+    # The analyses of the current year need its first close as well, analyses fetch prices up to today (exclusive)
+    start, end = date(today.year, 1, 1), today + timedelta(days=1)
+
+    def refresh(ticker: str) -> bool:
+        try:
+            fetch_price_history(ticker, start, end)
+            return True
+        except Exception:
+            logger.exception("Refreshing the prices of %s failed", ticker)
+            return False
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='warm-cache') as executor:
+        refreshes = {ticker: submit_with_context(executor, refresh, ticker) for ticker in tickers}
+    return [ticker for ticker, refreshed in refreshes.items() if not refreshed.result()]
+
+
+def warm_caches(days: int, limit: int, workers: int) -> Dict[str, int]:
+    """
+    Refreshes the ticker mappings and prices of the listings used most within the last days. The usage counted before
+    those days is deleted.
+    :param days: only the requests of the last this many days are counted
+    :param limit: maximum number of listings to refresh
+    :param workers: number of listings downloaded at the same time
+    :return: dictionary with the number of listings, of refreshed ticker mappings and of listings that failed
+    """
+    forget_ticker_usage(days)
+    isins_by_listing = hot_tickers(days, limit)
+    refreshed_mappings = refresh_ticker_mappings(list(dict.fromkeys(isins_by_listing.values())))
+    failed = refresh_price_histories(list(isins_by_listing), workers)
+    return {'tickers': len(isins_by_listing), 'mappings': refreshed_mappings, 'failed': len(failed)}
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from .models import ExchangeRate
+from .stockdata_fetchers import PriceIndex, fetch_listing_currency, market_data_session
+
+# Currency of the DeGiro account, the Waarde column is in this currency
+account_currency = 'EUR'
+
+# Daily euro reference rates of the ECB since 1999, updated every working day around 16:00 CET
+ecb_exchange_rates_url = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+
+# Currencies that are quoted in a fraction of another currency, like London prices in pence
+minor_currency_units = {'GBX': ('GBP', 100), 'GBp': ('GBP', 100)}
+
+# Currency of the Yahoo Finance suffixes that only list in one currency. For the exchanges that list in multiple
+# currencies (London, Cboe Europe, Aquis) and US listings without a suffix the currency Yahoo Finance reports for the
+# listing is used.
+yahoo_suffix_currencies = {
+    'AS': 'EUR', 'DE': 'EUR', 'F': 'EUR', 'MI': 'EUR', 'PA': 'EUR', 'BR': 'EUR',
+    'SW': 'CHF',
+}
+
+
+class MissingExchangeRates(Exception):
+    """
+    Raised when prices have to be converted from a currency there are no exchange rates for.
+    """
+
+
+def listing_currency(listing: str, exchange_code: Optional[str]) -> Optional[str]:
+    """
+    :param listing: ticker + exchange code (VUSA.L) the prices come from
+    :param exchange_code: Yahoo Finance suffix of the listing
+    :return: the currency the prices of the listing are in, None if Yahoo Finance could not tell
+    """
+    if exchange_code in yahoo_suffix_currencies:
+        return yahoo_suffix_currencies[exchange_code]
+    return fetch_listing_currency(listing)
+
+
+def load_exchange_rates_file(path) -> int:
+    """
+    Stores the exchange rates of a file in the ECB euro reference rate format (a Date column and a column of rates per
+    currency, like eurofxref-hist.csv or its zip file) in the ExchangeRate table, replacing the rates that were held
+    for the same days.
+    :param path: path of the CSV or zipped CSV file
+    :return: the number of rates stored
+    """
+    rates = pd.read_csv(path, na_values=['N/A'], parse_dates=['Date'])
+    rates = rates.loc[:, ~rates.columns.str.startswith('Unnamed')]
+    rates = rates.melt(id_vars='Date', var_name='currency', value_name='rate').dropna(subset=['rate'])
+
+    ExchangeRate.objects.bulk_create(
+        [ExchangeRate(currency=currency.strip(), date=day.date(), rate=rate)
+         for day, currency, rate in rates[['Date', 'currency', 'rate']].itertuples(index=False)],
+        update_conflicts=True, unique_fields=['currency', 'date'], update_fields=['rate'], batch_size=5000)
+    rate_indexes.clear()
+    return len(rates)
+
+
+def download_exchange_rates_file(path):
+    """
+    Downloads the euro reference rates of the ECB to a file, which is only replaced once the download is complete.
+    :param path: path of the zip file to write
+    :raises requests.RequestException: when the download failed
+    """
+    response = market_data_session.get(ecb_exchange_rates_url)
+    response.raise_for_status()
+    downloading_path = f"{path}.download"
+    with open(downloading_path, 'wb') as f:
+        f.write(response.content)
+    os.replace(downloading_path, path)
+
+
+# The exchange rates per currency as loaded from the database, with the time they were loaded
+rate_indexes: Dict[str, Tuple[float, PriceIndex]] = {}
+rate_indexes_lock = threading.Lock()
+
+
+def exchange_rate_index(currency: str) -> Optional[PriceIndex]:
+    """
+    Returns the daily euro reference rates of a currency as a PriceIndex (the rates take the place of the closes).
+    They are read from the database once and kept for settings.EXCHANGE_RATES_CACHE_TTL. Currencies without rates are
+    looked up again every time, so rates loaded later are used right away.
+    :return: the rates, None if there are none for the currency
+    """
+    with rate_indexes_lock:
+        loaded_at, rate_index = rate_indexes.get(currency, (None, None))
+        if loaded_at is not None and time.monotonic() - loaded_at < settings.EXCHANGE_RATES_CACHE_TTL.total_seconds():
+            return rate_index
+
+    rates = pd.DataFrame.from_records(ExchangeRate.objects.filter(currency=currency).order_by('date')
+                                      .values_list('date', 'rate'), columns=['Date', 'Close'])
+    if rates.empty:
+        return None
+
+    rate_index = PriceIndex(rates.set_index(pd.to_datetime(rates['Date'])))
+    with rate_indexes_lock:
+        rate_indexes[currency] = (time.monotonic(), rate_index)
+    return rate_index
+
+
+def convert_price_index(price_index: PriceIndex, currency: str) -> PriceIndex:
+    """
+    Converts all closes of a listing to the account currency at once, using the reference rate of each day (or of
+    the last day before it that has a rate). Closes from before the first known rate are left out.
+    :param price_index: the closes of the listing
+    :param currency: the currency the closes are in, see listing_currency
+    :return: the closes in the account currency
+    :raises MissingExchangeRates: when there are no rates for the currency
+    """
+    if currency == account_currency or price_index.empty:
+        return price_index
+
+    rate_currency, units = minor_currency_units.get(currency, (currency, 1))
+    rate_index = exchange_rate_index(rate_currency)
+    if rate_index is None:
+        raise MissingExchangeRates(f"No exchange rates for {rate_currency}, load them with the load_exchange_rates "
+                                   f"command")
+
+    rates = rate_index.closes_on_or_before(price_index.dates)
+    known = ~np.isnan(rates)
+    closes = price_index.closes[known] / units / rates[known]
+    return PriceIndex(pd.DataFrame({'Close': closes}, index=pd.DatetimeIndex(price_index.dates[known])))
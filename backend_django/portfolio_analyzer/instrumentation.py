@@ -0,0 +1,349 @@
+import asyncio
+import cProfile
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# The stages of an analysis, in the order they run. Functions are assigned to a stage with the timed_stage decorator.
+# Reading and storing the listings of the stocks happens in between the other stages and is counted as 'db'.
+analysis_stages = ('parse', 'resolve', 'fetch', 'db', 'compute', 'summarize')
+
+# Upper bounds in seconds of the buckets of the duration histograms
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metric_prefix = 'portfolio_analyzer_'
+
+metric_descriptions = {
+    'requests_total': ('counter', "Analyses by operation and response status"),
+    'request_duration_seconds': ('histogram', "Duration of an analysis by operation"),
+    'stage_duration_seconds': ('histogram', "Time spent in a stage per analysis"),
+    'external_calls_total': ('counter', "Calls to OpenFIGI and Yahoo Finance"),
+    'external_call_errors_total': ('counter', "Calls to OpenFIGI and Yahoo Finance that failed"),
+    'external_call_duration_seconds': ('histogram', "Duration of a call to OpenFIGI or Yahoo Finance"),
+    'external_call_retries_total': ('counter', "Retries of calls to OpenFIGI and Yahoo Finance"),
+    'circuit_breaker_opened_total': ('counter', "Times the circuit breaker of a host opened"),
+    'circuit_breaker_rejections_total': ('counter', "Calls not made because the circuit breaker of the host was open"),
+    'cache_lookups_total': ('counter', "Lookups in the ticker, price and result caches by result (hit or miss)"),
+    'single_flight_waits_total': ('counter', "Lookups that waited for another caller fetching the same ISIN or ticker"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """
+    Counters and duration histograms of the process, rendered in the Prometheus text format by the metrics endpoint.
+    Every worker process has a registry of its own, Prometheus adds them up when scraping the workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # Per histogram the count per bucket (the last one being +Inf), the sum and the count
+        self.histograms: Dict[Tuple[str, Labels], list] = {}
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(duration_buckets) + 1) + [0.0, 0])
+            for bucket, upper_bound in enumerate(duration_buckets):
+                if seconds <= upper_bound:
+                    histogram[bucket] += 1
+                    break
+            else:
+                histogram[len(duration_buckets)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name: str):
+            if name not in described and name in metric_descriptions:
+                metric_type, description = metric_descriptions[name]
+                lines.append(f"# HELP {metric_prefix}{name} {description}")
+                lines.append(f"# TYPE {metric_prefix}{name} {metric_type}")
+                described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{metric_prefix}{name}{format_labels(labels)} {format_value(value)}")
+
+        for (name, labels), values in histograms:
+            describe(name)
+            cumulative = 0
+            for upper_bound, bucket_count in zip(duration_buckets + (float('inf'),), values):
+                cumulative += bucket_count
+                le = '+Inf' if upper_bound == float('inf') else format_value(upper_bound)
+                lines.append(f"{metric_prefix}{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{metric_prefix}{name}_sum{format_labels(labels)} {format_value(values[-2])}")
+            lines.append(f"{metric_prefix}{name}_count{format_labels(labels)} {values[-1]}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetrics:
+    """
+    The stage timings and counters of a single analysis, see collect_metrics.
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.started = time.perf_counter()
+        self.duration = None
+        self.stages: Dict[str, float] = {}
+        self.external_calls: Dict[str, Tuple[int, float]] = {}
+        self.counters: Dict[str, float] = {}
+        # Extra fields that are added to the log line, like the response status
+        self.fields = {}
+        self.lock = threading.Lock()
+
+    def add_stage_time(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_external_call(self, service: str, seconds: float):
+        with self.lock:
+            calls, total = self.external_calls.get(service, (0, 0.0))
+            self.external_calls[service] = (calls + 1, total + seconds)
+
+    def increment(self, name: str, amount: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def server_timing(self) -> str:
+        """
+        :return: value for the Server-Timing header. The stages do not overlap, the external calls overlap the stages
+        and each other (exchanges are probed at the same time), their time is the sum of all calls. The async view
+        analyzes stocks concurrently, its stage times are summed over the stocks as well.
+        """
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries += [f'{service};desc="{calls} calls";dur={seconds * 1000:.1f}'
+                    for service, (calls, seconds) in self.external_calls.items()]
+        if self.duration is not None:
+            entries.append(f"total;dur={self.duration * 1000:.1f}")
+        return ', '.join(entries)
+
+    def as_log_record(self) -> dict:
+        return {
+            'event': 'analysis_metrics',
+            'operation': self.operation,
+            'duration_ms': round((self.duration or 0.0) * 1000, 1),
+            'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+            'external_calls': {service: {'calls': calls, 'ms': round(seconds * 1000, 1)}
+                               for service, (calls, seconds) in self.external_calls.items()},
+            'counters': dict(self.counters),
+            **self.fields,
+        }
+
+
+current_metrics: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar('current_metrics',
+                                                                                          default=None)
+current_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('current_stage', default=None)
+
+
+@contextmanager
+def collect_metrics(operation: str):
+    """
+    Collects the stage timings and counters of everything that runs inside the with block. When the block ends, they
+    are added to the registry and logged as a single JSON line.
+    :param operation: name of what is measured, e.g. the view
+    :return: the RequestMetrics the timings are collected in
+    """
+    metrics = RequestMetrics(operation)
+    metrics_token = current_metrics.set(metrics)
+    stage_token = current_stage.set(None)
+    try:
+        yield metrics
+    except Exception:
+        metrics.fields.setdefault('status', 'error')
+        raise
+    finally:
+        current_stage.reset(stage_token)
+        current_metrics.reset(metrics_token)
+        metrics.duration = time.perf_counter() - metrics.started
+
+        registry.increment('requests_total', operation=operation, status=str(metrics.fields.get('status', 'ok')))
+        registry.observe('request_duration_seconds', metrics.duration, operation=operation)
+        for stage, seconds in metrics.stages.items():
+            registry.observe('stage_duration_seconds', seconds, stage=stage)
+        logger.info(json.dumps(metrics.as_log_record(), default=str))
+
+
+def timed_stage(stage: str):
+    """
+    Decorator that adds the time spent in the function to the given stage of the running analysis. Calls made while
+    already in a stage (like a fetch started from another fetch) are not counted twice. Works for coroutine functions
+    as well, their time includes the time spent waiting.
+    """
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_async(*args, **kwargs):
+                with stage_timer(stage):
+                    return await function(*args, **kwargs)
+            return timed_async
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with stage_timer(stage):
+                return function(*args, **kwargs)
+        return timed
+    return decorator
+
+
+@contextmanager
+def stage_timer(stage: str):
+    metrics = current_metrics.get()
+    if metrics is None or current_stage.get() is not None:
+        yield
+        return
+
+    token = current_stage.set(stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_stage_time(stage, time.perf_counter() - started)
+        current_stage.reset(token)
+
+
+@contextmanager
+def external_call(service: str):
+    """
+    Counts and times a call to an external service ('openfigi' or 'yahoo'). An exception counts as an error, other
+    failures can be counted with external_call_failed.
+    """
+    registry.increment('external_calls_total', service=service)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        external_call_failed(service)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        registry.observe('external_call_duration_seconds', seconds, service=service)
+        metrics = current_metrics.get()
+        if metrics is not None:
+            metrics.add_external_call(service, seconds)
+
+
+def external_call_failed(service: str):
+    registry.increment('external_call_errors_total', service=service)
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.increment(f"{service}_errors")
+
+
+def count_cache_lookups(cache: str, hits: int, misses: int):
+    """
+    Counts the hits and misses of a lookup in the 'ticker', 'price' or 'result' cache.
+    """
+    for result, counter, amount in (('hit', 'hits', hits), ('miss', 'misses', misses)):
+        if amount:
+            registry.increment('cache_lookups_total', amount, cache=cache, result=result)
+            metrics = current_metrics.get()
+            if metrics is not None:
+                metrics.increment(f"{cache}_cache_{counter}", amount)
+
+
+def submit_with_context(executor, function, *args):
+    """
+    Submits a function to an executor so that it runs in a copy of the current context and is counted as part of the
+    running analysis.
+    """
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def profiling_requested(request) -> bool:
+    """
+    A request is profiled when it asks for it with ?profile=1 and profiling is enabled by setting
+    settings.ANALYSIS_PROFILE_DIR.
+    """
+    return bool(settings.ANALYSIS_PROFILE_DIR) and request.GET.get('profile') == '1'
+
+
+def profile_call(operation: str, function, *args, **kwargs):
+    """
+    Runs the function under cProfile and dumps the stats to settings.ANALYSIS_PROFILE_DIR, they can be inspected with
+    python -m pstats or snakeviz.
+    :return: tuple of the result of the function and the name of the stats file
+    """
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(function, *args, **kwargs)
+    finally:
+        os.makedirs(settings.ANALYSIS_PROFILE_DIR, exist_ok=True)
+        file_name = f"{operation}-{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.prof"
+        profiler.dump_stats(os.path.join(settings.ANALYSIS_PROFILE_DIR, file_name))
+        logger.info(json.dumps({'event': 'profile_written', 'operation': operation, 'file': file_name}))
+    return result, file_name
+
+
+class InstrumentedViewMixin:
+    """
+    Mixin for APIViews that collects the metrics of every request (see collect_metrics) and reports the stage timings
+    in the Server-Timing header. Requests can be profiled, see profiling_requested. Async views are supported too,
+    but are not profiled.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if getattr(self, 'view_is_async', False):
+            return self.dispatch_async(request, *args, **kwargs)
+
+        with collect_metrics(type(self).__name__) as metrics:
+            metrics.fields['method'] = request.method
+            if profiling_requested(request):
+                response, profile_file = profile_call(type(self).__name__, super().dispatch, request, *args,
+                                                      **kwargs)
+                response['X-Profile-File'] = profile_file
+            else:
+                response = super().dispatch(request, *args, **kwargs)
+            metrics.fields['status'] = response.status_code
+        response['Server-Timing'] = metrics.server_timing()
+        return response
+
+    async def dispatch_async(self, request, *args, **kwargs):
+        with collect_metrics(type(self).__name__) as metrics:
+            metrics.fields['method'] = request.method
+            response = await super().dispatch(request, *args, **kwargs)
+            metrics.fields['status'] = response.status_code
+        response['Server-Timing'] = metrics.server_timing()
+        return response
@@ -0,0 +1,117 @@
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .analyze_portfolio import calculate_multi_year_gain
+from .instrumentation import collect_metrics
+from .models import AnalysisJob
+
+logger = logging.getLogger(__name__)
+
+# Local worker pool that runs the analysis jobs, so no external broker is needed. Jobs that are queued or running
+# when the process stops are lost, they are reported as failed once their heartbeat stopped (see fail_stale_job).
+job_executor = ThreadPoolExecutor(max_workers=settings.ANALYSIS_JOB_WORKERS, thread_name_prefix='analysis-job')
+
+# Ids of the jobs queued or running in this process, see beat_heartbeats
+held_job_ids = set()
+held_job_ids_lock = threading.Lock()
+heartbeat_thread = None
+
+stale_job_error = "The analysis was interrupted, please upload the file again"
+
+
+def submit_analysis_job(csv_data: bytes) -> AnalysisJob:
+    """
+    Creates an analysis job for an uploaded CSV and queues it on the worker pool.
+    :param csv_data: contents of the uploaded CSV file
+    :return: the created job
+    """
+    global heartbeat_thread
+
+    job = AnalysisJob.objects.create()
+    with held_job_ids_lock:
+        held_job_ids.add(job.id)
+        if heartbeat_thread is None:
+            heartbeat_thread = threading.Thread(target=beat_heartbeats, name='analysis-job-heartbeat', daemon=True)
+            heartbeat_thread.start()
+    job_executor.submit(run_analysis_job, job.id, csv_data)
+    return job
+
+
+def beat_heartbeats():
+    """
+    Marks the jobs held by this process as alive every settings.ANALYSIS_JOB_HEARTBEAT_INTERVAL seconds, for as long
+    as the process runs.
+    """
+    while True:
+        time.sleep(settings.ANALYSIS_JOB_HEARTBEAT_INTERVAL)
+        with held_job_ids_lock:
+            job_ids = list(held_job_ids)
+        if not job_ids:
+            continue
+        try:
+            AnalysisJob.objects.filter(id__in=job_ids).update(heartbeat_at=timezone.now())
+        except Exception:
+            logger.exception("Updating the heartbeat of the analysis jobs failed")
+        finally:
+            connection.close()
+
+
+def fail_stale_job(job: AnalysisJob) -> AnalysisJob:
+    """
+    Reports a queued or running job whose heartbeat stopped for settings.ANALYSIS_JOB_STALE_AFTER as failed: the
+    process that held it stopped (e.g. a worker that was restarted) and the job will never finish.
+    :param job: the job as read from the database
+    :return: the job, failed when it was stale
+    """
+    unfinished = [AnalysisJob.QUEUED, AnalysisJob.RUNNING]
+    stale_before = timezone.now() - settings.ANALYSIS_JOB_STALE_AFTER
+    if job.status not in unfinished or job.heartbeat_at >= stale_before:
+        return job
+
+    # Unless it finished or beat its heartbeat in the meantime
+    AnalysisJob.objects.filter(id=job.id, status__in=unfinished, heartbeat_at__lt=stale_before).update(
+        status=AnalysisJob.FAILED, error=stale_job_error, finished_at=timezone.now())
+    job.refresh_from_db()
+    return job
+
+
+def run_analysis_job(job_id, csv_data: bytes):
+    """
+    Runs calculate_multi_year_gain for a job and stores the progress and finally the result on the job.
+    """
+    progress_fields = {'resolved': 'stocks_resolved', 'priced': 'stocks_priced', 'computed': 'stocks_computed'}
+
+    def update_progress(stage: str, done: int, total: int):
+        AnalysisJob.objects.filter(id=job_id).update(**{progress_fields[stage]: done, 'stocks_total': total})
+
+    try:
+        AnalysisJob.objects.filter(id=job_id).update(status=AnalysisJob.RUNNING)
+        with collect_metrics('analysis_job') as metrics:
+            metrics.fields['job_id'] = str(job_id)
+            try:
+                result = calculate_multi_year_gain(io.BytesIO(csv_data), progress=update_progress)
+            except ValueError as e:
+                metrics.fields['status'] = AnalysisJob.FAILED
+                finish_analysis_job(job_id, status=AnalysisJob.FAILED, error=str(e))
+            except Exception:
+                metrics.fields['status'] = AnalysisJob.FAILED
+                finish_analysis_job(job_id, status=AnalysisJob.FAILED, error="Internal server error")
+            else:
+                metrics.fields['status'] = AnalysisJob.DONE
+                finish_analysis_job(job_id, status=AnalysisJob.DONE, result=result)
+    finally:
+        with held_job_ids_lock:
+            held_job_ids.discard(job_id)
+        # Every worker thread gets its own database connection, which Django only closes for request threads
+        connection.close()
+
+
+def finish_analysis_job(job_id, **fields):
+    AnalysisJob.objects.filter(id=job_id).update(finished_at=timezone.now(), **fields)
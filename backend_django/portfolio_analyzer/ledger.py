@@ -0,0 +1,122 @@
+from datetime import date
+from typing import Dict
+
+import pandas as pd
+from django.db import transaction
+from django.utils import timezone
+
+from .analyze_portfolio import analyze_transactions
+from .models import Portfolio, LedgerTransaction, StockResult
+from .stockdata_fetchers import check_and_convert_csv_headers, csv_column_dtypes
+
+# LedgerTransaction fields and the CSV columns they hold
+ledger_columns = {
+    'datum': 'Datum',
+    'product': 'Product',
+    'isin': 'ISIN',
+    'beurs': 'Beurs',
+    'uitvoeringsplaats': 'Uitvoeringsplaats',
+    'aantal': 'Aantal',
+    'waarde': 'Waarde',
+    'koers_valuta': 'Koers valuta',
+    'order_id': 'Order ID',
+}
+
+
+def transaction_keys(df: pd.DataFrame) -> pd.Series:
+    """
+    Creates a key per transaction that is the same in every export. An order that is filled in parts has a row per
+    part with the same Order ID, so the key also holds the date, amount and value of the row and a counter for
+    parts that are identical in all of those.
+    :param df: CSV file contents in dataframe format
+    :return: Series with the key of every row
+    """
+    key_columns = ['Order ID', 'Datum', 'Aantal', 'Waarde']
+    occurrence = df.groupby(key_columns, dropna=False, observed=True, sort=False).cumcount()
+    return (df['Order ID'].astype(str) + '/' + df['Datum'].dt.strftime('%Y-%m-%d') + '/' + df['Aantal'].astype(str)
+            + '/' + df['Waarde'].astype(str) + '/' + occurrence.astype(str))
+
+
+def update_ledger(portfolio: Portfolio, df: pd.DataFrame) -> Dict[str, int]:
+    """
+    Adds the transactions of an upload that are not in the ledger of the portfolio yet.
+    :param portfolio: the portfolio the upload belongs to
+    :param df: CSV file contents in dataframe format
+    :return: Dictionary with the products that got new transactions as key and the year of their earliest new
+    transaction as value
+    """
+    keys = transaction_keys(df)
+    stored_keys = set(portfolio.transactions.values_list('transaction_key', flat=True))
+    is_new = ~keys.isin(stored_keys)
+    new_rows = df[is_new].astype(object).where(df[is_new].notna(), None).to_dict('records')
+
+    LedgerTransaction.objects.bulk_create([
+        LedgerTransaction(portfolio=portfolio, transaction_key=key,
+                          **{field: row[column] for field, column in ledger_columns.items()})
+        for key, row in zip(keys[is_new], new_rows)])
+
+    return df[is_new].groupby('Product', observed=True)['Datum'].min().dt.year.to_dict()
+
+
+def ledger_dataframe(portfolio: Portfolio) -> pd.DataFrame:
+    """
+    :param portfolio: the portfolio to return the transactions of
+    :return: all transactions in the ledger of the portfolio, in the same format as check_and_convert_csv_headers
+    """
+    rows = portfolio.transactions.order_by('-datum', 'id').values_list(*ledger_columns)
+    df = pd.DataFrame.from_records(rows, columns=list(ledger_columns.values()))
+    return df.astype(csv_column_dtypes)
+
+
+def load_stock_result(stored_result: dict) -> dict:
+    """
+    Restores the integer keys of the yearly gains and worth, which JSON turned into strings.
+    """
+    result = dict(stored_result)
+    for field in ('yearly_gains', 'yearly_worth'):
+        if field in result:
+            result[field] = {int(key): value for key, value in result[field].items()}
+    return result
+
+
+def analyze_portfolio_upload(portfolio: Portfolio, csv_file) -> dict:
+    """
+    Merges an upload into the ledger of a portfolio and analyzes the portfolio, reusing the stored result of every
+    stock that is still valid:
+    - stocks without new transactions that were priced today are not recalculated at all
+    - for the other stocks only the years from the earliest new transaction onward are recalculated, or from the
+      year the stock was last priced in, as the prices of that year may have changed since
+    :param portfolio: the portfolio the upload belongs to
+    :param csv_file: the exported CSV file
+    :return: dictionary with the results per stock and a summary of the whole portfolio
+    """
+    df = check_and_convert_csv_headers(csv_file)
+    today = date.today()
+
+    with transaction.atomic():
+        # Writing first takes the write lock up front, so uploads to the same portfolio wait for each other. On SQLite
+        # a transaction that reads first and writes later fails right away when another thread is writing.
+        Portfolio.objects.filter(id=portfolio.id).update(updated_at=timezone.now())
+        first_changed_years = update_ledger(portfolio, df)
+        stored_results = list(portfolio.stock_results.all())
+        ledger_df = ledger_dataframe(portfolio)
+
+    reusable_results = {}
+    for stored_result in stored_results:
+        if 'error' in stored_result.result:
+            continue
+        first_recomputed_year = first_changed_years.get(stored_result.product)
+        if stored_result.priced_on < today:
+            first_recomputed_year = min(first_recomputed_year or today.year, stored_result.priced_on.year)
+        reusable_results[stored_result.product] = (load_stock_result(stored_result.result), first_recomputed_year)
+
+    analysis = analyze_transactions(ledger_df, reusable_results=reusable_results)
+
+    with transaction.atomic():
+        StockResult.objects.bulk_create(
+            [StockResult(portfolio=portfolio, product=result['stock_name'], result=result, priced_on=today)
+             for result in analysis['results']],
+            update_conflicts=True, unique_fields=['portfolio', 'product'], update_fields=['result', 'priced_on'])
+        portfolio.save()
+
+    return analysis
@@ -0,0 +1,115 @@
+import glob
+import logging
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from portfolio_analyzer.batch import scan_file, warm_shared_caches, analyze_file, open_writer
+from portfolio_analyzer.instrumentation import analysis_stages
+from portfolio_analyzer.stockdata_fetchers import market_data_session
+from portfolio_analyzer.worth_series import series_frequencies
+
+
+class Command(BaseCommand):
+    help = ("Analyzes many DeGiro exports at once in a pool of worker processes and writes the result of every export "
+            "to a JSON lines or Parquet file as soon as it is done. An export that fails is written as an error record "
+            "and does not stop the others.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+',
+                            help="CSV files, directories (all *.csv files in them) or glob patterns")
+        parser.add_argument('--output', '-o', default='-', help="File to write the results to (default: stdout)")
+        parser.add_argument('--format', choices=['jsonl', 'parquet'],
+                            help="Output format (default: parquet for a .parquet output file, jsonl otherwise)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes")
+        parser.add_argument('--recursive', action='store_true', help="Also look for CSV files in subdirectories")
+        parser.add_argument('--resolution', choices=list(series_frequencies),
+                            help="Also calculate the worth series at this resolution")
+        parser.add_argument('--points', type=int, help="Maximum number of points per worth series")
+
+    def handle(self, *args, **options):
+        paths = self.find_csv_files(options['paths'], options['recursive'])
+        if not paths:
+            raise CommandError("No CSV files found")
+        if options['points'] is not None and (options['resolution'] is None or options['points'] < 3):
+            raise CommandError("--points needs a --resolution and has to be at least 3")
+        if options['verbosity'] < 2:
+            # Every analysis would otherwise log its timings
+            logging.getLogger('portfolio_analyzer').setLevel(logging.WARNING)
+
+        try:
+            writer = open_writer(options['output'], options['format'])
+        except ValueError as e:
+            raise CommandError(e)
+        # The summary goes to stderr when the results are written to stdout
+        report = self.stderr if options['output'] == '-' else self.stdout
+
+        # The worker processes are forked, they must not share the database connection and the pooled HTTP
+        # connections of this process
+        connections.close_all()
+        market_data_session.close()
+
+        started = time.perf_counter()
+        records = []
+        try:
+            with ProcessPoolExecutor(max_workers=options['workers'],
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                warm_shared_caches(executor.map(scan_file, paths, chunksize=16))
+                futures = {executor.submit(analyze_file, path, options['resolution'], options['points']): path
+                           for path in paths}
+                for future in as_completed(futures):
+                    # Dropping the future frees the result once it has been written
+                    path = futures.pop(future)
+                    try:
+                        record = future.result()
+                    except BrokenProcessPool as e:
+                        # A worker died (e.g. out of memory), the exports it had not finished all fail
+                        record = {'file': path, 'status': 'error', 'error': f"Worker process died: {e}",
+                                  'seconds': None, 'stages': {}}
+                    writer.write(record)
+                    # Only what the summary needs is kept
+                    record['stocks'] = len(record.pop('result', {}).get('results', []))
+                    records.append(record)
+                    if options['verbosity'] >= 2:
+                        report.write(f"{record['status']:<5} {record['file']}")
+        finally:
+            writer.close()
+
+        self.report_throughput(report, records, time.perf_counter() - started, options['workers'])
+
+    @staticmethod
+    def find_csv_files(patterns, recursive: bool):
+        paths = []
+        for pattern in patterns:
+            if os.path.isdir(pattern):
+                pattern = os.path.join(pattern, '**', '*.csv') if recursive else os.path.join(pattern, '*.csv')
+            paths += glob.glob(pattern, recursive=recursive)
+        return sorted(dict.fromkeys(path for path in paths if os.path.isfile(path)))
+
+    def report_throughput(self, report, records, seconds: float, workers: int):
+        analyzed = [record for record in records if record['status'] == 'ok']
+        failed = len(records) - len(analyzed)
+        stocks = sum(record['stocks'] for record in analyzed)
+        report.write(f"Analyzed {len(analyzed)} of {len(records)} file(s) with {stocks} stock(s) in {seconds:.1f}s "
+                     f"using {workers} worker(s): {len(records) / seconds:.2f} files/s, "
+                     f"{stocks / seconds:.1f} stocks/s")
+
+        durations = sorted(record['seconds'] for record in records if record['seconds'] is not None)
+        if durations:
+            slowest = max((record for record in records if record['seconds'] is not None),
+                          key=lambda record: record['seconds'])
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            report.write(f"Per file: median {statistics.median(durations):.2f}s, p95 {p95:.2f}s, "
+                         f"slowest {slowest['seconds']:.2f}s ({slowest['file']})")
+
+        stage_totals = {stage: sum(record['stages'].get(stage, 0.0) for record in records) for stage in analysis_stages}
+        report.write("Time per stage, summed over the files: " +
+                     ", ".join(f"{stage} {total:.1f}s" for stage, total in stage_totals.items()))
+        if failed:
+            report.write(self.style.WARNING(f"{failed} file(s) failed, see the error records in the output"))
@@ -0,0 +1,119 @@
+import io
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from portfolio_analyzer.analyze_portfolio import calculate_multi_year_gain
+from portfolio_analyzer.benchmarks.providers import synthetic_market_data
+from portfolio_analyzer.benchmarks.synthetic import generate_degiro_csv
+from portfolio_analyzer.instrumentation import collect_metrics, analysis_stages
+from portfolio_analyzer.models import TickerMapping, PriceHistory, PriceHistoryCoverage
+
+
+class Command(BaseCommand):
+    help = ("Times every stage of calculate_multi_year_gain on synthetic DeGiro exports. OpenFIGI and Yahoo Finance "
+            "are replaced by deterministic local providers and a throwaway database is used, so it runs offline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help="products:transactions:years, can be given multiple times "
+                                 "(default: 10:200:5, 50:2000:10 and 100:10000:15)")
+        parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs per scenario")
+        parser.add_argument('--cold', action='store_true',
+                            help="Empty the ticker and price caches before every run instead of warming them up")
+        parser.add_argument('--latency-ms', type=float, default=0.0,
+                            help="Simulated latency of every OpenFIGI and Yahoo Finance call")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save', help="Write the results to this JSON file")
+        parser.add_argument('--compare', help="Compare the results with an earlier --save file")
+        parser.add_argument('--threshold', type=float, default=0.20,
+                            help="Relative slowdown of a stage that counts as a regression in --compare")
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'] or ['10:200:5', '50:2000:10', '100:10000:15']
+        if options['verbosity'] < 2:
+            # Every run would otherwise log its timings
+            logging.getLogger('portfolio_analyzer').setLevel(logging.WARNING)
+
+        with tempfile.TemporaryDirectory() as directory:
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                timings = {scenario: self.run_scenario(scenario, options) for scenario in scenarios}
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+        report = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'options': {option: options[option] for option in ('repeat', 'cold', 'latency_ms', 'seed')},
+            'scenarios': timings,
+        }
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['save']}")
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), report, options['threshold'])
+
+    def run_scenario(self, scenario: str, options) -> dict:
+        try:
+            products, transactions, years = (int(part) for part in scenario.split(':'))
+        except ValueError:
+            raise CommandError(f"Invalid scenario '{scenario}', expected products:transactions:years")
+
+        csv_data = generate_degiro_csv(products=products, transactions=transactions, years=years,
+                                       seed=options['seed'])
+        latency = options['latency_ms'] / 1000
+
+        if not options['cold']:
+            self.run_once(csv_data, latency)
+
+        runs = []
+        for _ in range(options['repeat']):
+            if options['cold']:
+                for model in (TickerMapping, PriceHistory, PriceHistoryCoverage):
+                    model.objects.all().delete()
+            runs.append(self.run_once(csv_data, latency))
+
+        # Median per stage in milliseconds
+        timing = {stage: round(statistics.median(run[stage] for run in runs) * 1000, 3) for stage in runs[0]}
+        self.stdout.write(f"{scenario:>16}  " + "  ".join(f"{stage} {ms:9.1f}ms" for stage, ms in timing.items()))
+        return timing
+
+    def run_once(self, csv_data: bytes, latency: float) -> dict:
+        with synthetic_market_data(latency=latency), collect_metrics('benchmark') as metrics:
+            started = time.perf_counter()
+            calculate_multi_year_gain(io.BytesIO(csv_data))
+            total = time.perf_counter() - started
+        return {**{stage: metrics.stages.get(stage, 0.0) for stage in analysis_stages}, 'total': total}
+
+    def compare(self, baseline: dict, report: dict, threshold: float):
+        regressions = []
+        self.stdout.write(f"Compared with {baseline['created_at']}:")
+        for scenario, timing in report['scenarios'].items():
+            if scenario not in baseline['scenarios']:
+                continue
+            for stage in list(analysis_stages) + ['total']:
+                before, after = baseline['scenarios'][scenario].get(stage), timing.get(stage)
+                if not before or after is None:
+                    continue
+                change = (after - before) / before
+                # Stages that take about a millisecond are too noisy to compare relatively
+                regressed = change > threshold and after - before > 1.0
+                self.stdout.write(f"{scenario:>16}  {stage:<10} {before:9.1f}ms -> {after:9.1f}ms "
+                                  f"({change:+.1%}){'  REGRESSION' if regressed else ''}")
+                if regressed:
+                    regressions.append(f"{scenario} {stage}")
+
+        if regressions:
+            raise CommandError(f"Slower than {threshold:.0%} over the baseline: {', '.join(regressions)}")
@@ -0,0 +1,42 @@
+import os
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max, Min
+
+from portfolio_analyzer.exchange_rates import load_exchange_rates_file, download_exchange_rates_file, \
+    ecb_exchange_rates_url
+from portfolio_analyzer.models import ExchangeRate
+
+
+class Command(BaseCommand):
+    help = ("Load euro reference rates from a local file in the ECB format (eurofxref-hist.csv or .zip), used to "
+            "convert the prices of listings that are not in euro. With --download the file is fetched from the ECB "
+            "first. Analyses report the stocks of listings in other currencies as errors until rates are loaded.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?', help="File to load (default: settings.EXCHANGE_RATES_FILE)")
+        parser.add_argument('--download', action='store_true',
+                            help=f"Download the rates from {ecb_exchange_rates_url} to the file first")
+
+    def handle(self, *args, **options):
+        path = options['file'] or settings.EXCHANGE_RATES_FILE
+        if options['download']:
+            try:
+                download_exchange_rates_file(path)
+            except requests.RequestException as e:
+                raise CommandError(f"Could not download the exchange rates: {e}")
+        if not path or not os.path.exists(path):
+            raise CommandError(f"Exchange rates file {path} does not exist")
+
+        try:
+            loaded = load_exchange_rates_file(path)
+        except (ValueError, KeyError) as e:
+            raise CommandError(f"Could not read {path}: {e}")
+
+        for currency in (ExchangeRate.objects.values('currency').order_by('currency')
+                         .annotate(days=Count('id'), first=Min('date'), last=Max('date'))):
+            self.stdout.write(f"{currency['currency']}  {currency['days']:>6} days  "
+                              f"{currency['first']} - {currency['last']}")
+        self.stdout.write(self.style.SUCCESS(f"Loaded {loaded} exchange rate(s) from {path}"))
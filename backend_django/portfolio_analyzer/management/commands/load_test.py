@@ -0,0 +1,259 @@
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio_analyzer.benchmarks.synthetic import generate_degiro_csv
+
+# Path of the analysis endpoint, relative to the server
+analysis_path = '/calculate_multi_year_gain/'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class UploadMix:
+    """
+    Picks the uploads of a load test: a scenario drawn by weight, made unique by giving its transactions new order
+    IDs, so the server analyzes it instead of serving the result of an earlier upload from its result cache. A
+    fraction of the uploads is sent unchanged instead, like users that upload the same export again.
+    """
+
+    def __init__(self, scenarios: List[Tuple[str, bytes, float]], repeat_fraction: float, seed: int):
+        """
+        :param scenarios: tuples of the name, the CSV and the weight of every scenario
+        :param repeat_fraction: fraction of the uploads that are sent unchanged
+        :param seed: seed of the random generator
+        """
+        self.scenarios = scenarios
+        self.repeat_fraction = repeat_fraction
+        self.rng = random.Random(seed)
+        self.uploads = 0
+
+    def next(self) -> Tuple[str, bytes]:
+        name, csv_data, _ = self.rng.choices(self.scenarios, weights=[weight for _, _, weight in self.scenarios])[0]
+        if self.rng.random() < self.repeat_fraction:
+            return name, csv_data
+        self.uploads += 1
+        return name, csv_data.replace(b'-synthetic', f"-load-test-{self.uploads:08x}".encode())
+
+
+class Command(BaseCommand):
+    help = ("Load tests calculate_multi_year_gain/ with a mix of synthetic DeGiro exports and reports the throughput "
+            "and the p50/p95/p99 latency per concurrency level. Without --url a gunicorn server (see gunicorn.conf.py) "
+            "is started with the settings_load_test settings, which replace OpenFIGI and Yahoo Finance with local "
+            "synthetic providers and use a throwaway database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="Base URL of a running server to load test, for example one started with "
+                                          "DJANGO_SETTINGS_MODULE=degiro_portfolio_api.settings_load_test gunicorn")
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                            help="Numbers of uploads sent at the same time, every level is tested in turn")
+        parser.add_argument('--duration', type=float, default=30.0, help="Seconds every concurrency level lasts")
+        parser.add_argument('--mix', action='append', dest='mix',
+                            help="products:transactions:years:weight, can be given multiple times "
+                                 "(default: 10:200:5:6, 50:2000:10:3 and 100:10000:15:1)")
+        parser.add_argument('--repeat-fraction', type=float, default=0.0,
+                            help="Fraction of the uploads sent unchanged, which the result cache of the server serves")
+        parser.add_argument('--no-warm-up', action='store_true',
+                            help="Do not upload every scenario once before the test, so the first uploads fetch the "
+                                 "tickers and prices")
+        parser.add_argument('--timeout', type=float, default=120.0, help="Seconds after which an upload fails")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, help="Worker processes of the started server")
+        parser.add_argument('--threads', type=int, help="Threads per worker process of the started server")
+        parser.add_argument('--latency-ms', type=float, default=0.0,
+                            help="Simulated latency of every OpenFIGI and Yahoo Finance call of the started server")
+        parser.add_argument('--save', help="Write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        if not options['concurrency'] or min(options['concurrency']) < 1 or options['duration'] <= 0:
+            raise CommandError("--concurrency has to be at least 1 and --duration positive")
+        if not 0 <= options['repeat_fraction'] <= 1:
+            raise CommandError("--repeat-fraction has to be between 0 and 1")
+
+        scenarios = [self.parse_scenario(scenario, options['seed'])
+                     for scenario in options['mix'] or ['10:200:5:6', '50:2000:10:3', '100:10000:15:1']]
+
+        with self.server(options) as url:
+            levels = asyncio.run(self.run(url, scenarios, options))
+
+        report = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'url': options['url'],
+            'options': {option: options[option] for option in
+                        ('duration', 'repeat_fraction', 'seed', 'workers', 'threads', 'latency_ms')},
+            'mix': [f"{name}:{weight:g}" for name, _, weight in scenarios],
+            'levels': levels,
+        }
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['save']}")
+
+    @staticmethod
+    def parse_scenario(scenario: str, seed: int) -> Tuple[str, bytes, float]:
+        try:
+            products, transactions, years, weight = scenario.split(':')
+            csv_data = generate_degiro_csv(products=int(products), transactions=int(transactions), years=int(years),
+                                           seed=seed)
+            return f"{products}:{transactions}:{years}", csv_data, float(weight)
+        except ValueError:
+            raise CommandError(f"Invalid mix '{scenario}', expected products:transactions:years:weight")
+
+    @contextmanager
+    def server(self, options) -> Iterator[str]:
+        """
+        Starts a gunicorn server with the settings_load_test settings and a database in a temporary directory, unless
+        --url is given.
+        :return: base URL of the server
+        """
+        if options['url']:
+            yield options['url'].rstrip('/')
+            return
+        if importlib.util.find_spec('gunicorn') is None:
+            raise CommandError("gunicorn is not installed, install it (see requirements.txt) or pass --url")
+
+        with tempfile.TemporaryDirectory() as directory:
+            environment = {
+                **os.environ,
+                'DJANGO_SETTINGS_MODULE': 'degiro_portfolio_api.settings_load_test',
+                'LOAD_TEST_DATABASE': os.path.join(directory, 'load_test.sqlite3'),
+                'SYNTHETIC_MARKET_DATA_LATENCY': str(options['latency_ms'] / 1000),
+            }
+            subprocess.run([sys.executable, 'manage.py', 'migrate', '--no-input'], cwd=settings.BASE_DIR,
+                           env=environment, stdout=subprocess.DEVNULL, check=True)
+
+            url = f"http://127.0.0.1:{free_port()}"
+            command = [sys.executable, '-m', 'gunicorn', '--bind', url.removeprefix('http://')]
+            for option in ('workers', 'threads'):
+                if options[option]:
+                    command += [f"--{option}", str(options[option])]
+
+            log_path = os.path.join(directory, 'server.log')
+            with open(log_path, 'wb') as log:
+                server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=environment, stdout=log,
+                                          stderr=subprocess.STDOUT)
+                try:
+                    self.wait_until_ready(url, server, log_path)
+                    yield url
+                finally:
+                    server.terminate()
+                    server.wait(timeout=60)
+
+    def wait_until_ready(self, url: str, server: subprocess.Popen, log_path: str, timeout: float = 60.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                with open(log_path) as log:
+                    raise CommandError(f"The server stopped while starting:\n{log.read()}")
+            try:
+                if httpx.get(f"{url}/metrics/", timeout=1).status_code == 200:
+                    self.stdout.write(f"Server started at {url}")
+                    return
+            except httpx.TransportError:
+                pass
+            time.sleep(0.2)
+        raise CommandError(f"The server did not start within {timeout:.0f}s")
+
+    async def run(self, url: str, scenarios: List[Tuple[str, bytes, float]], options) -> List[dict]:
+        mix = UploadMix(scenarios, options['repeat_fraction'], options['seed'])
+        limits = httpx.Limits(max_connections=max(options['concurrency']))
+        async with httpx.AsyncClient(base_url=url, timeout=options['timeout'], limits=limits) as client:
+            if not options['no_warm_up']:
+                started = time.perf_counter()
+                for name, csv_data, _ in scenarios:
+                    status, _ = await self.upload(client, csv_data)
+                    if status != 200:
+                        raise CommandError(f"Warming up with {name} failed with status {status}")
+                self.stdout.write(f"Warmed up in {time.perf_counter() - started:.1f}s")
+
+            self.stdout.write(f"{'concurrency':>11} {'requests':>9} {'errors':>7} {'throughput':>13} "
+                              f"{'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+            levels = []
+            for concurrency in options['concurrency']:
+                level = await self.run_level(client, mix, concurrency, options['duration'])
+                self.stdout.write(
+                    f"{concurrency:>11} {level['requests']:>9} {level['errors']:>7} "
+                    f"{level['throughput']:>7.2f} req/s " +
+                    " ".join(f"{level['latency_ms'][key]:>7.0f}ms" for key in ('p50', 'p95', 'p99', 'max')))
+                levels.append(level)
+            return levels
+
+    @staticmethod
+    async def upload(client: httpx.AsyncClient, csv_data: bytes) -> Tuple[Optional[int], float]:
+        """
+        :return: tuple of the status of the response (None when the upload failed) and its latency in seconds
+        """
+        started = time.perf_counter()
+        try:
+            response = await client.post(analysis_path, files={'csv_file': ('Transactions.csv', csv_data, 'text/csv')})
+            # The latency includes reading the whole response
+            await response.aread()
+            status = response.status_code
+        except httpx.HTTPError:
+            status = None
+        return status, time.perf_counter() - started
+
+    async def run_level(self, client: httpx.AsyncClient, mix: UploadMix, concurrency: int, duration: float) -> dict:
+        """
+        Keeps concurrency uploads in flight until duration seconds have passed, every upload is sent as soon as the
+        previous one of its sender finished. Uploads still in flight at the end are waited for and counted.
+        :return: dictionary with the number of requests and errors, the throughput in requests per second and the
+        latencies of all requests (also the failed ones) in milliseconds, in total and per scenario
+        """
+        latencies: Dict[str, List[float]] = {}
+        errors = 0
+        deadline = time.perf_counter() + duration
+
+        async def sender():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                name, csv_data = mix.next()
+                status, latency = await self.upload(client, csv_data)
+                latencies.setdefault(name, []).append(latency)
+                if status != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        all_latencies = [latency for scenario_latencies in latencies.values() for latency in scenario_latencies]
+        return {
+            'concurrency': concurrency,
+            'requests': len(all_latencies),
+            'errors': errors,
+            'throughput': len(all_latencies) / elapsed,
+            'latency_ms': latency_percentiles(all_latencies),
+            'latency_ms_per_scenario': {name: latency_percentiles(scenario_latencies)
+                                        for name, scenario_latencies in latencies.items()},
+        }
+
+
+def latency_percentiles(latencies: List[float]) -> Dict[str, float]:
+    """
+    :param latencies: latencies in seconds
+    :return: the mean, p50, p95, p99 and maximum latency in milliseconds
+    """
+    milliseconds = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return {'mean': round(float(milliseconds.mean()), 1), 'p50': round(float(p50), 1), 'p95': round(float(p95), 1),
+            'p99': round(float(p99), 1), 'max': round(float(milliseconds.max()), 1)}
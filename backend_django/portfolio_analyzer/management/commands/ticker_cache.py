@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from portfolio_analyzer.models import TickerMapping
+
+
+class Command(BaseCommand):
+    help = "Inspect or purge the cached ISIN -> ticker mappings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', choices=['list', 'purge'], default='list')
+        parser.add_argument('--isin', action='append', help="Only act on this ISIN (can be given multiple times)")
+        parser.add_argument('--expired', action='store_true', help="Only act on mappings whose TTL has passed")
+        parser.add_argument('--negative', action='store_true', help="Only act on ISINs OpenFIGI could not map")
+
+    def handle(self, *args, **options):
+        mappings = TickerMapping.objects.order_by('isin')
+        if options['isin']:
+            mappings = mappings.filter(isin__in=options['isin'])
+        if options['negative']:
+            mappings = mappings.filter(ticker__isnull=True)
+        if options['expired']:
+            mappings = [mapping for mapping in mappings if not mapping.is_fresh()]
+        else:
+            mappings = list(mappings)
+
+        if options['action'] == 'purge':
+            deleted, _ = TickerMapping.objects.filter(pk__in=[mapping.pk for mapping in mappings]).delete()
+            self.stdout.write(self.style.SUCCESS(f"Purged {deleted} ticker mapping(s)"))
+            return
+
+        now = timezone.now()
+        for mapping in mappings:
+            state = 'fresh' if mapping.is_fresh() else 'expired'
+            self.stdout.write(f"{mapping.isin}  {mapping.ticker or '-':<12} {mapping.exchange_code or '-':<4} "
+                              f"fetched {mapping.fetched_at:%Y-%m-%d %H:%M} "
+                              f"({state}, expires in {mapping.expires_at - now})")
+        self.stdout.write(f"{len(mappings)} ticker mapping(s)")
@@ -0,0 +1,68 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from portfolio_analyzer.cache_warming import warm_caches
+from portfolio_analyzer.instrumentation import collect_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Refreshes the prices and ticker mappings of the listings analyses used most recently, so the first "
+            "analyses of the next day find them in the cache. Run it from cron after the markets have closed, or "
+            "keep it running with --loop.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CACHE_WARM_UP_DAYS,
+                            help="Rank the listings by their use in this many days")
+        parser.add_argument('--limit', type=int, default=settings.CACHE_WARM_UP_LIMIT,
+                            help="Maximum number of listings to refresh, the most used first")
+        parser.add_argument('--workers', type=int, default=settings.CACHE_WARM_UP_WORKERS,
+                            help="Number of listings downloaded at the same time")
+        parser.add_argument('--loop', action='store_true', help="Keep running and warm the caches every day at --at")
+        parser.add_argument('--at', default=settings.CACHE_WARM_UP_TIME.strftime('%H:%M'),
+                            help="Time of day (HH:MM in TIME_ZONE) to warm the caches at with --loop")
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['limit'] < 1 or options['workers'] < 1:
+            raise CommandError("--days, --limit and --workers have to be at least 1")
+        if not options['loop']:
+            self.warm(options)
+            return
+
+        try:
+            run_at = datetime.strptime(options['at'], '%H:%M').time()
+        except ValueError:
+            raise CommandError("--at has to be a time of day like 22:30")
+        while True:
+            next_run = self.next_run(run_at)
+            self.stdout.write(f"Next warm-up at {next_run:%Y-%m-%d %H:%M %Z}")
+            time.sleep(max((next_run - timezone.now()).total_seconds(), 0))
+            try:
+                self.warm(options)
+            except Exception:
+                # A failed warm-up (e.g. the database being unavailable) should not end the loop
+                logger.exception("Warming the caches failed")
+            finally:
+                connection.close()
+
+    @staticmethod
+    def next_run(run_at) -> datetime:
+        now = timezone.localtime()
+        next_run = now.replace(hour=run_at.hour, minute=run_at.minute, second=0, microsecond=0)
+        return next_run if next_run > now else next_run + timedelta(days=1)
+
+    def warm(self, options):
+        with collect_metrics('warm_cache') as metrics:
+            refreshed = warm_caches(options['days'], options['limit'], options['workers'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Refreshed the prices of {refreshed['tickers'] - refreshed['failed']} of {refreshed['tickers']} "
+            f"listing(s) and {refreshed['mappings']} ticker mapping(s) in {metrics.duration:.1f}s"))
+        if refreshed['failed']:
+            self.stdout.write(self.style.WARNING(f"{refreshed['failed']} listing(s) failed, see the log"))
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=32)),
+                ('date', models.DateField()),
+                ('close', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PriceHistoryCoverage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=32, unique=True)),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pricehistory',
+            constraint=models.UniqueConstraint(fields=('ticker', 'date'), name='unique_price_per_ticker_per_day'),
+        ),
+    ]
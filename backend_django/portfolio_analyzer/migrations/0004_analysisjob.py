@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:45
+
+from django.db import migrations, models
+import rest_framework.utils.encoders
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0003_tickermapping_exchange_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=8)),
+                ('stocks_total', models.PositiveIntegerField(default=0)),
+                ('stocks_resolved', models.PositiveIntegerField(default=0)),
+                ('stocks_priced', models.PositiveIntegerField(default=0)),
+                ('stocks_computed', models.PositiveIntegerField(default=0)),
+                ('result', models.JSONField(blank=True, encoder=rest_framework.utils.encoders.JSONEncoder, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import rest_framework.utils.encoders
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0004_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Portfolio',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.CharField(max_length=255)),
+                ('result', models.JSONField(encoder=rest_framework.utils.encoders.JSONEncoder)),
+                ('priced_on', models.DateField()),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_results', to='portfolio_analyzer.portfolio')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LedgerTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_key', models.CharField(max_length=128)),
+                ('order_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('datum', models.DateField()),
+                ('product', models.CharField(max_length=255)),
+                ('isin', models.CharField(max_length=12)),
+                ('beurs', models.CharField(blank=True, max_length=16, null=True)),
+                ('uitvoeringsplaats', models.CharField(blank=True, max_length=16, null=True)),
+                ('aantal', models.BigIntegerField()),
+                ('waarde', models.FloatField()),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transactions', to='portfolio_analyzer.portfolio')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stockresult',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'product'), name='unique_result_per_stock'),
+        ),
+        migrations.AddConstraint(
+            model_name='ledgertransaction',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'transaction_key'), name='unique_transaction_per_portfolio'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0005_portfolio_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('date', models.DateField()),
+                ('rate', models.FloatField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ledgertransaction',
+            name='koers_valuta',
+            field=models.CharField(blank=True, max_length=8, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='exchangerate',
+            constraint=models.UniqueConstraint(fields=('currency', 'date'), name='unique_rate_per_currency_per_day'),
+        ),
+    ]
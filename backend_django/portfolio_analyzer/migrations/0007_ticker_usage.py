@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:29
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0006_exchange_rates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TickerUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=32, unique=True)),
+                ('isin', models.CharField(max_length=12)),
+                ('request_count', models.PositiveIntegerField(default=0)),
+                ('last_requested_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
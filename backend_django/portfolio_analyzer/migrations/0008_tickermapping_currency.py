@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0007_ticker_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tickermapping',
+            name='currency',
+            field=models.CharField(blank=True, max_length=8, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-17 02:16
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.utils.timezone
+
+
+def count_last_use(apps, schema_editor):
+    # Only the day a listing was last used is known, its lifetime count would outweigh the recent usage of others
+    TickerUsage = apps.get_model('portfolio_analyzer', 'TickerUsage')
+    for usage in TickerUsage.objects.all():
+        usage.date = timezone.localdate(usage.last_requested_at)
+        usage.request_count = 1
+        usage.save(update_fields=['date', 'request_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_analyzer', '0009_analysisjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tickerusage',
+            name='date',
+            field=models.DateField(default=django.utils.timezone.localdate),
+        ),
+        migrations.RunPython(count_last_use, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='tickerusage',
+            name='last_requested_at',
+        ),
+        migrations.AlterField(
+            model_name='tickerusage',
+            name='ticker',
+            field=models.CharField(max_length=32),
+        ),
+        migrations.AddConstraint(
+            model_name='tickerusage',
+            constraint=models.UniqueConstraint(fields=('ticker', 'date'), name='unique_usage_per_ticker_per_day'),
+        ),
+    ]
@@ -1,3 +1,179 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class TickerMapping(models.Model):
+    """
+    Cached result of an ISIN to ticker lookup at OpenFIGI. A mapping without a ticker is a negative result
+    (OpenFIGI did not know the ISIN) and expires sooner than a positive one.
+    """
+    isin = models.CharField(max_length=12, unique=True)
+    ticker = models.CharField(max_length=32, null=True, blank=True)
+    fetched_at = models.DateTimeField(default=timezone.now)
+    # Yahoo Finance suffix of the listing that had price data for the ticker the last time (e.g. AS for VUSA.AS)
+    exchange_code = models.CharField(max_length=8, null=True, blank=True)
+    # Currency Yahoo Finance quotes the prices of that listing in (e.g. GBp for London listings in pence)
+    currency = models.CharField(max_length=8, null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.isin} -> {self.ticker}"
+
+    @property
+    def ttl(self):
+        return settings.TICKER_CACHE_TTL if self.ticker else settings.TICKER_CACHE_NEGATIVE_TTL
+
+    @property
+    def expires_at(self):
+        return self.fetched_at + self.ttl
+
+    def is_fresh(self) -> bool:
+        return timezone.now() < self.expires_at
+
+
+class PriceHistory(models.Model):
+    """
+    Daily close of a ticker (including the exchange suffix, e.g. VUSA.AS) as downloaded from Yahoo Finance.
+    """
+    ticker = models.CharField(max_length=32)
+    date = models.DateField()
+    close = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['ticker', 'date'], name='unique_price_per_ticker_per_day')]
+
+    def __str__(self):
+        return f"{self.ticker} {self.date}: {self.close}"
+
+
+class PriceHistoryCoverage(models.Model):
+    """
+    The date range [start, end) for which the PriceHistory of a ticker has been downloaded. Days in this range without
+    a PriceHistory row were not trading days, so they do not have to be downloaded again.
+    """
+    ticker = models.CharField(max_length=32, unique=True)
+    start = models.DateField()
+    end = models.DateField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.ticker}: {self.start} - {self.end}"
+
+
+class TickerUsage(models.Model):
+    """
+    How often analyses used the prices of a listing on a day. The warm_cache command refreshes the prices and ticker
+    mappings of the listings used most in the last days before the next day starts (see
+    portfolio_analyzer.cache_warming).
+    """
+    ticker = models.CharField(max_length=32)
+    isin = models.CharField(max_length=12)
+    date = models.DateField(default=timezone.localdate)
+    request_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['ticker', 'date'], name='unique_usage_per_ticker_per_day')]
+
+    def __str__(self):
+        return f"{self.ticker}: {self.request_count} request(s) on {self.date}"
+
+
+class ExchangeRate(models.Model):
+    """
+    Euro reference rate of a currency on a day: the number of units of the currency one euro buys. Loaded from a local
+    file with the load_exchange_rates command, see portfolio_analyzer.exchange_rates.
+    """
+    currency = models.CharField(max_length=3)
+    date = models.DateField()
+    rate = models.FloatField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['currency', 'date'], name='unique_rate_per_currency_per_day')]
+
+    def __str__(self):
+        return f"{self.date} EUR/{self.currency}: {self.rate}"
+
+
+class AnalysisJob(models.Model):
+    """
+    An analysis of an uploaded CSV that runs in the background (see portfolio_analyzer.jobs). The progress counters
+    are updated while the job runs so clients can poll them.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=QUEUED)
+    stocks_total = models.PositiveIntegerField(default=0)
+    stocks_resolved = models.PositiveIntegerField(default=0)
+    stocks_priced = models.PositiveIntegerField(default=0)
+    stocks_computed = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True, encoder=JSONEncoder)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Kept up to date by the process that queued the job until it is finished, see portfolio_analyzer.jobs
+    heartbeat_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+
+class Portfolio(models.Model):
+    """
+    A portfolio whose transactions are kept between uploads, so a new upload only has to recalculate the stocks
+    with new transactions (see portfolio_analyzer.ledger).
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class LedgerTransaction(models.Model):
+    """
+    A row of an uploaded DeGiro export. transaction_key is derived from the Order ID and identifies the row across
+    uploads.
+    """
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='transactions')
+    transaction_key = models.CharField(max_length=128)
+    order_id = models.CharField(max_length=64, null=True, blank=True)
+    datum = models.DateField()
+    product = models.CharField(max_length=255)
+    isin = models.CharField(max_length=12)
+    beurs = models.CharField(max_length=16, null=True, blank=True)
+    uitvoeringsplaats = models.CharField(max_length=16, null=True, blank=True)
+    aantal = models.BigIntegerField()
+    waarde = models.FloatField()
+    koers_valuta = models.CharField(max_length=8, null=True, blank=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['portfolio', 'transaction_key'],
+                                               name='unique_transaction_per_portfolio')]
+
+    def __str__(self):
+        return f"{self.datum} {self.product} {self.aantal}"
+
+
+class StockResult(models.Model):
+    """
+    The result of the last analysis of a stock in a portfolio, see calculate_stock_result.
+    """
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='stock_results')
+    product = models.CharField(max_length=255)
+    result = models.JSONField(encoder=JSONEncoder)
+    priced_on = models.DateField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['portfolio', 'product'], name='unique_result_per_stock')]
 
-# Create your models here.
+    def __str__(self):
+        return f"{self.product} ({self.priced_on})"
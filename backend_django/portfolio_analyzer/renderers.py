@@ -0,0 +1,85 @@
+from typing import Dict, List
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Series in the results that are dictionaries with the timestamp of noon (UTC) of a date as key and the worth as value
+timestamp_series_keys = ['yearly_worth', 'worth_series']
+summary_timestamp_series_keys = ['yearly_worths_whole_portfolio', 'worth_series_whole_portfolio']
+
+
+class AnalysisResultRenderer(BaseRenderer):
+    """
+    Renders the results of an analysis with orjson, which serializes the NumPy scalars that pandas leaves in the
+    results itself and is several times faster than the json module DRF uses. Other types orjson does not know (e.g.
+    Decimal) are converted like DRF does. Falls back to the JSONRenderer of DRF when orjson is not installed.
+    """
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        if data is None:
+            return b''
+        if orjson is None:
+            return JSONRenderer().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=JSONEncoder().default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+class ColumnarAnalysisResultRenderer(AnalysisResultRenderer):
+    """
+    Renders the results of an analysis with the series as arrays instead of dictionaries keyed by timestamp or year,
+    which makes the response smaller and faster to parse for big portfolios. Selected with ?format=columnar:
+    - yearly_worth, worth_series and the series of the whole portfolio become {"timestamps": [...], "values": [...]}
+    - yearly_gains becomes {"years": [...], "virtual_gain_value": [...], "virtual_gain_percentage": [...]}
+    Responses without results (errors) are rendered as is.
+    """
+    format = 'columnar'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None) -> bytes:
+        if isinstance(data, dict) and 'results' in data:
+            data = to_columnar(data)
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+def series_to_columns(series: Dict) -> Dict[str, List]:
+    return {'timestamps': [int(timestamp) for timestamp in series], 'values': list(series.values())}
+
+
+def yearly_gains_to_columns(yearly_gains: Dict) -> Dict[str, List]:
+    return {
+        'years': [int(year) for year in yearly_gains],
+        'virtual_gain_value': [gains['virtual_gain_value'] for gains in yearly_gains.values()],
+        'virtual_gain_percentage': [gains['virtual_gain_percentage'] for gains in yearly_gains.values()],
+    }
+
+
+def to_columnar(data: dict) -> dict:
+    """
+    :param data: the results of an analysis, see analyze_transactions, which is left unchanged
+    :return: a copy of the results with the series as arrays, see ColumnarAnalysisResultRenderer
+    """
+    results = []
+    for stock in data['results']:
+        stock = dict(stock)
+        for key in timestamp_series_keys:
+            if key in stock:
+                stock[key] = series_to_columns(stock[key])
+        if 'yearly_gains' in stock:
+            stock['yearly_gains'] = yearly_gains_to_columns(stock['yearly_gains'])
+        results.append(stock)
+
+    columnar = {**data, 'results': results}
+    if 'summary' in data:
+        summary = dict(data['summary'])
+        for key in summary_timestamp_series_keys:
+            if key in summary:
+                summary[key] = series_to_columns(summary[key])
+        columnar['summary'] = summary
+    return columnar
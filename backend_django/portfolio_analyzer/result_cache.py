@@ -0,0 +1,103 @@
+import hashlib
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Iterator, Tuple
+
+from django.core.cache import caches
+
+from .analyze_portfolio import calculate_multi_year_gain, stream_multi_year_gain
+from .async_analysis import calculate_multi_year_gain_async
+from .instrumentation import count_cache_lookups
+
+result_cache = caches['analysis_results']
+
+
+def csv_content_hash(csv_file) -> str:
+    """
+    Hashes the transactions in an uploaded CSV. The header row is left out since its language depends on the settings
+    of the DeGiro app, and line endings are normalized, so the same transactions always give the same hash.
+    :param csv_file: the uploaded CSV file, it is rewound afterwards
+    :return: hex digest of the transactions
+    """
+    digest = hashlib.sha256()
+    csv_file.seek(0)
+    csv_file.readline()
+    for line in csv_file:
+        digest.update(line.rstrip(b'\r\n') + b'\n')
+    csv_file.seek(0)
+    return digest.hexdigest()
+
+
+def seconds_until_midnight() -> int:
+    tomorrow = datetime.combine(date.today() + timedelta(days=1), time.min)
+    return max(int((tomorrow - datetime.now()).total_seconds()), 1)
+
+
+def cached_multi_year_gain(csv_file, resolution: Optional[str] = None, points: Optional[int] = None) -> dict:
+    """
+    Same as calculate_multi_year_gain, but serves the result from the analysis_results cache when the same
+    transactions were analyzed before on the same day. Results expire at midnight, when the prices of a new day are
+    used.
+    :param csv_file: the uploaded CSV file
+    :param resolution: optional resolution of the worth series, see analyze_transactions
+    :param points: optional maximum number of points per worth series
+    :return: dictionary with the results per stock and a summary of the whole portfolio
+    """
+    cache_key = result_cache_key(csv_file, resolution, points)
+    result = result_cache.get(cache_key)
+    count_cache_lookups('result', hits=int(result is not None), misses=int(result is None))
+    if result is None:
+        result = calculate_multi_year_gain(csv_file, resolution=resolution, points=points)
+        result_cache.set(cache_key, result, timeout=seconds_until_midnight())
+    return result
+
+
+async def cached_multi_year_gain_async(csv_file, resolution: Optional[str] = None,
+                                       points: Optional[int] = None) -> dict:
+    """
+    Same as cached_multi_year_gain, but analyzes with calculate_multi_year_gain_async.
+    """
+    cache_key = result_cache_key(csv_file, resolution, points)
+    result = await result_cache.aget(cache_key)
+    count_cache_lookups('result', hits=int(result is not None), misses=int(result is None))
+    if result is None:
+        result = await calculate_multi_year_gain_async(csv_file, resolution=resolution, points=points)
+        await result_cache.aset(cache_key, result, timeout=seconds_until_midnight())
+    return result
+
+
+def streamed_multi_year_gain(csv_file, resolution: Optional[str] = None,
+                             points: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Same as stream_multi_year_gain, but streams the cached result when the same transactions were analyzed before on
+    the same day, and caches the result once all its records have been streamed.
+    """
+    cache_key = result_cache_key(csv_file, resolution, points)
+    result = result_cache.get(cache_key)
+    count_cache_lookups('result', hits=int(result is not None), misses=int(result is None))
+    if result is not None:
+        return result_records(result)
+    return caching_records(cache_key, stream_multi_year_gain(csv_file, resolution=resolution, points=points))
+
+
+def result_records(result: dict) -> Iterator[Tuple[str, dict]]:
+    for stock_result in result['results']:
+        yield 'result', stock_result
+    yield 'summary', result['summary']
+
+
+def caching_records(cache_key: str, records: Iterator[Tuple[str, dict]]) -> Iterator[Tuple[str, dict]]:
+    result = {'results': []}
+    for record_type, record in records:
+        if record_type == 'result':
+            result['results'].append(record)
+        else:
+            result['summary'] = record
+        yield record_type, record
+    result_cache.set(cache_key, result, timeout=seconds_until_midnight())
+
+
+def result_cache_key(csv_file, resolution: Optional[str], points: Optional[int]) -> str:
+    cache_key = f"analysis-result:{csv_content_hash(csv_file)}:{date.today().isoformat()}"
+    if resolution is not None:
+        cache_key += f":{resolution}:{points}"
+    return cache_key
@@ -1,111 +1,963 @@
-from datetime import date
-import io
-from typing import Optional, Dict, Union, List, IO
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from datetime import date, timedelta
+import hashlib
+import os
+import random
+import threading
+import time
+from typing import Optional, Dict, Union, List, IO, Iterable, Tuple
+from urllib.parse import urlsplit
 import requests
 import json
+import logging
+import numpy as np
 import pandas as pd
 import yfinance as yf
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .instrumentation import timed_stage, external_call, external_call_failed, count_cache_lookups, \
+    submit_with_context, registry
+from .models import TickerMapping, PriceHistory, PriceHistoryCoverage
+
 open_figi_api_key = "paste_open_figi_api_key_here"
+open_figi_mapping_url = "https://api.openfigi.com/v2/mapping"
+
+# Names of the 19 columns of a DeGiro transactions export. The export leaves the currency columns without a header,
+# those are named after the column they belong to.
+csv_column_names = ['Datum', 'Tijd', 'Product', 'ISIN', 'Beurs', 'Uitvoeringsplaats', 'Aantal', 'Koers', 'Koers valuta',
+                    'Lokale waarde', 'Lokale waarde valuta', 'Waarde', 'Waarde valuta', 'Wisselkoers',
+                    'Transactiekosten en/of', 'Transactiekosten valuta', 'Totaal', 'Totaal valuta', 'Order ID']
+
+# The columns the analyzer uses and their types, the other columns are not read at all
+csv_column_dtypes = {
+    'Datum': 'datetime64[ns]',
+    'Product': 'category',
+    'ISIN': 'category',
+    'Beurs': 'category',
+    'Uitvoeringsplaats': 'category',
+    'Aantal': 'int64',
+    'Koers valuta': 'category',
+    'Waarde': 'float64',
+    'Order ID': 'object',
+}
+
+logger = logging.getLogger(__name__)
+
+# Yahoo Finance suffixes that are tried, in this order, when the CSV gives no hint about where a product is listed
+default_exchange_codes = ['AS', 'DE', 'XC', 'MI', 'XD', 'AQ', 'L']
+
+# Yahoo Finance suffixes for the exchange codes DeGiro uses in the Beurs and Uitvoeringsplaats columns
+degiro_exchange_to_yahoo_suffix = {
+    'EAM': 'AS', 'XAMS': 'AS',
+    'XET': 'DE', 'XETA': 'DE', 'XETR': 'DE', 'TDG': 'DE',
+    'FRA': 'F', 'XFRA': 'F',
+    'LSE': 'L', 'XLON': 'L',
+    'MIL': 'MI', 'MTAA': 'MI', 'ETFP': 'MI',
+    'EPA': 'PA', 'XPAR': 'PA',
+    'EBR': 'BR', 'XBRU': 'BR',
+    'SWX': 'SW', 'XSWX': 'SW',
+    'CHIX': 'XC', 'BATE': 'XC',
+    'CEUX': 'XD',
+    'AQEU': 'AQ', 'AQXE': 'AQ',
+}
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket used to stay within the OpenFIGI rate limits. Every request takes a token, tokens are
+    refilled at a constant rate. The bucket is emptied when the API tells us (through its rate limit headers) that we
+    are out of requests, so the next request waits until the limit resets.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        """
+        :param capacity: number of requests allowed per period
+        :param period: length of the period in seconds
+        """
+        self.capacity = capacity
+        self.refill_rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def _take(self) -> float:
+        """
+        Takes a token if one is available.
+        :return: 0 when a token was taken, otherwise the number of seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.blocked_until - now, (1 - self.tokens) / self.refill_rate)
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while (wait := self._take()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """
+        Same as acquire, but waits without blocking the event loop.
+        """
+        while (wait := self._take()) > 0:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """
+        Syncs the bucket with the ratelimit-remaining and ratelimit-reset headers OpenFIGI sends along.
+        """
+        remaining = headers.get('ratelimit-remaining')
+        reset = headers.get('ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, float(remaining))
+            if int(remaining) <= 0:
+                self.blocked_until = max(self.blocked_until, now + float(reset))
+
+
+# OpenFIGI allows 25 requests per 6 seconds with an API key and 25 per minute without one
+open_figi_rate_limiter = TokenBucket(capacity=25, period=6 if open_figi_api_key else 60)
+
+# yf.download keeps its results in a module level dictionary, so only one download can run at a time
+yf_download_lock = threading.Lock()
+
+
+class SingleFlight:
+    """
+    Makes callers that miss the cache for the same keys at the same time wait for the one that is already fetching
+    them, instead of all calling OpenFIGI or Yahoo Finance for the same data. A caller holds the locks of the keys it
+    fetches and stores the result in the cache before releasing them. The callers that waited check the cache again
+    and only fetch what is still missing, so they get the shared result from the cache. Results that are not cached
+    (like exchanges without data) are shared with share instead.
+    The keys are locked across the threads of a process and, when settings.SINGLE_FLIGHT_LOCK_DIR is set (and the
+    platform has fcntl), across the processes of the host with a lock file per key.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        # Per key its lock and the number of callers holding or waiting for it
+        self.key_locks: Dict[str, list] = {}
+        # Per key the future of the call that is running, see share
+        self.calls: Dict[str, Future] = {}
+
+    def share(self, key: str, function, *args):
+        """
+        Calls function(*args), unless another thread of the process is calling it for the same key already. Then that
+        call is waited for and its result is returned (or its exception raised) instead. Across processes the calls
+        for the key are made one at a time.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leading = call is None
+            if leading:
+                call = self.calls[key] = Future()
+        if not leading:
+            registry.increment('single_flight_waits_total', flight=self.name)
+            return call.result()
+
+        try:
+            with self.file_lock(key):
+                result = function(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    @contextmanager
+    def flight(self, keys: Iterable[str]):
+        """
+        Holds the locks of the keys. They are taken in sorted order, so callers with overlapping keys can not
+        deadlock. Flights of the same SingleFlight must not be nested.
+        """
+        with ExitStack() as stack:
+            for key in sorted(set(keys)):
+                stack.enter_context(self.key_lock(key))
+            yield
+
+    @contextmanager
+    def key_lock(self, key: str):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            if not key_lock[0].acquire(blocking=False):
+                registry.increment('single_flight_waits_total', flight=self.name)
+                key_lock[0].acquire()
+            try:
+                with self.file_lock(key):
+                    yield
+            finally:
+                key_lock[0].release()
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self.key_locks[key]
+
+    @contextmanager
+    def file_lock(self, key: str):
+        if fcntl is None or settings.SINGLE_FLIGHT_LOCK_DIR is None:
+            yield
+            return
+
+        os.makedirs(settings.SINGLE_FLIGHT_LOCK_DIR, exist_ok=True)
+        file_name = f"{self.name}-{hashlib.sha1(key.encode()).hexdigest()}.lock"
+        with open(os.path.join(settings.SINGLE_FLIGHT_LOCK_DIR, file_name), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                registry.increment('single_flight_waits_total', flight=self.name)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+openfigi_flight = SingleFlight('openfigi')
+yahoo_flight = SingleFlight('yahoo')
+listing_flight = SingleFlight('listing')
+
+
+class CircuitOpen(requests.ConnectionError):
+    """
+    Raised instead of calling a host that failed too often in a row, see CircuitBreaker.
+    """
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker for the calls to a single host. After failure_threshold consecutive failures the
+    circuit opens and calls fail immediately with CircuitOpen, rather than every request waiting for timeouts. Once
+    reset_timeout seconds have passed a single trial call is let through, its success closes the circuit again.
+    """
+
+    def __init__(self, host: str, failure_threshold: int, reset_timeout: float):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """
+        :raises CircuitOpen: when the circuit is open and it is not yet time for a trial call
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if not self.trial_running and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial_running = True
+                return
+        registry.increment('circuit_breaker_rejections_total', host=self.host)
+        raise CircuitOpen(f"{self.host} is failing, not calling it for now")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    registry.increment('circuit_breaker_opened_total', host=self.host)
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def record_abandoned(self):
+        """
+        Records a call that ended without an answer of the host, e.g. because it was cancelled. It counts neither as a
+        success nor as a failure, but when it was the trial call the next call may be the trial instead.
+        """
+        with self.lock:
+            self.trial_running = False
+
+
+def is_host_failure(status_code: int) -> bool:
+    """
+    :return: whether a response (after all retries) counts as a failure of the host for its circuit breaker: server
+    errors, and rate limiting that outlasted the retries
+    """
+    return status_code >= 500 or status_code == 429
 
 
+class MarketDataRetry(Retry):
+    """
+    Retry policy of the market data session. The exponential backoff is fully jittered, so clients that failed at the
+    same moment do not retry at the same moment. A Retry-After header (or, from OpenFIGI, ratelimit-reset) is
+    honoured up to settings.MARKET_DATA_MAX_RETRY_AFTER seconds.
+    """
 
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
 
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            try:
+                retry_after = float(response.headers.get('ratelimit-reset'))
+            except (TypeError, ValueError):
+                return None
+        return min(retry_after, settings.MARKET_DATA_MAX_RETRY_AFTER)
 
-def check_and_convert_csv_headers(csv_file: IO[str]) -> pd.DataFrame:
+    def sleep(self, response=None):
+        # Only called before an actual retry
+        registry.increment('external_call_retries_total')
+        super().sleep(response)
+
+
+class MarketDataAdapter(HTTPAdapter):
+    """
+    Transport adapter that keeps a pool of connections per host, applies a default timeout and runs every call
+    through the circuit breaker of its host. Retries happen within the adapter, so a call only counts as a single
+    failure for the circuit breaker after all retries failed.
+    """
+
+    def __init__(self, timeout, failure_threshold: int, reset_timeout: float, **kwargs):
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.circuit_breakers = {}
+        self.circuit_breakers_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def circuit_breaker(self, host: str) -> CircuitBreaker:
+        with self.circuit_breakers_lock:
+            if host not in self.circuit_breakers:
+                self.circuit_breakers[host] = CircuitBreaker(host, self.failure_threshold, self.reset_timeout)
+            return self.circuit_breakers[host]
+
+    def send(self, request, timeout=None, **kwargs):
+        circuit_breaker = self.circuit_breaker(urlsplit(request.url).hostname)
+        circuit_breaker.before_call()
+        try:
+            response = super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+        except BaseException:
+            circuit_breaker.record_failure()
+            raise
+
+        if is_host_failure(response.status_code):
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        return response
+
+
+def create_market_data_session() -> requests.Session:
+    """
+    Creates the session that is used for all calls to OpenFIGI and Yahoo Finance. Connections are kept alive between
+    calls, so only the first call to a host pays for the TLS handshake. Connection errors, read timeouts, 429s and 5xx
+    responses are retried with backoff (see MarketDataRetry), hosts that keep failing are not called for a while (see
+    CircuitBreaker).
+    """
+    retry = MarketDataRetry(total=settings.MARKET_DATA_RETRIES, backoff_factor=settings.MARKET_DATA_BACKOFF,
+                            status_forcelist=[429, 500, 502, 503, 504],
+                            # The OpenFIGI mapping requests are POSTs, but they do not change anything
+                            allowed_methods=['GET', 'POST'], raise_on_status=False)
+    adapter = MarketDataAdapter(timeout=settings.MARKET_DATA_TIMEOUT,
+                                failure_threshold=settings.MARKET_DATA_CIRCUIT_FAILURE_THRESHOLD,
+                                reset_timeout=settings.MARKET_DATA_CIRCUIT_RESET_TIMEOUT,
+                                pool_maxsize=settings.MARKET_DATA_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+market_data_session = create_market_data_session()
+
+
+@timed_stage('parse')
+def check_and_convert_csv_headers(csv_file: IO[bytes]) -> pd.DataFrame:
     """
     The degiro app may export the headers in a different language that may break this script depending on app lanuage.
     This functions checks if the headers are correct (Dutch) If they are not they convert the headers to Dutch if the
     length of the headers is the same.
 
+    The file is parsed straight from the (binary) file object, with explicit types and only the columns that are
+    used by the analyzer. The dates in the 'Datum' column are parsed while reading.
+
     Raises a ValueError if the CSV file headers are neither matching nor have
-    the same column count as the expected headers.
+    the same column count as the expected headers, or if a date or number can not be parsed.
 
     Args:
-        csv_file (IO[str]): The input CSV file.
+        csv_file (IO[bytes]): The input CSV file.
 
     Returns:
         pd.DataFrame: A DataFrame with standardized headers.
     """
+    headers = pd.read_csv(csv_file, nrows=0, encoding='utf-8').columns
+    csv_file.seek(0)
 
-    csv_data = csv_file.read().decode('utf-8')
-    df = pd.read_csv(io.StringIO(csv_data))
-
-    expected_headers = ("Datum,Tijd,Product,ISIN,Beurs,Uitvoeringsplaats,Aantal,Koers,,Lokale waarde,,Waarde,,"
-                        "Wisselkoers,Transactiekosten en/of,,Totaal,,Order ID")
-    expected_headers_list = expected_headers.split(',')
-
-    if ','.join(df.columns) == expected_headers:
-        return df
-    elif len(df.columns) == len(expected_headers_list):
-        df.columns = expected_headers_list
-        return df
-    else:
+    if len(headers) != len(csv_column_names):
         raise ValueError(
             "The CSV file headers are not as expected and their count does not match the expected headers.")
 
+    # The headers in the file are replaced by the (Dutch) names in csv_column_names, whatever language they are in
+    try:
+        df = pd.read_csv(csv_file, header=0, names=csv_column_names, usecols=list(csv_column_dtypes),
+                         dtype={column: dtype for column, dtype in csv_column_dtypes.items() if column != 'Datum'},
+                         parse_dates=['Datum'], date_format='%d-%m-%Y', encoding='utf-8')
+    except ValueError as e:
+        # E.g. an 'Aantal' that is not a whole number
+        raise ValueError(f"The CSV file contains invalid values: {e}")
+
+    # Dates that do not match the format leave the column unparsed rather than raising
+    if not pd.api.types.is_datetime64_any_dtype(df['Datum']) or df['Datum'].isna().any():
+        raise ValueError("The CSV file contains missing or invalid dates, expected dates like 31-12-2023")
+    return df
+
 
-def isin_to_ticker(openfigi_apikey: str, isin: str) -> Optional[str]:
+def openfigi_max_jobs_per_request(openfigi_apikey: str) -> int:
     """
-    Converts to ISIN code from the CSV file to a ticket. It openfigi has an api that can do exactly this
+    OpenFIGI accepts up to 100 mapping jobs per request with an API key and 10 without one.
+    """
+    return 100 if openfigi_apikey else 10
+
+
+def openfigi_chunks(openfigi_apikey: str, isins: Iterable[str]) -> List[List[str]]:
+    """
+    :return: the unique ISINs split in chunks that fit in a single mapping request
+    """
+    isins = list(dict.fromkeys(isins))
+    chunk_size = openfigi_max_jobs_per_request(openfigi_apikey)
+    return [isins[chunk_start:chunk_start + chunk_size] for chunk_start in range(0, len(isins), chunk_size)]
+
+
+def openfigi_headers(openfigi_apikey: str) -> Dict[str, str]:
+    return {'Content-Type': 'text/json', 'openfigi-apikey': openfigi_apikey}
+
+
+def openfigi_mapping_payload(isins: List[str]) -> str:
+    return json.dumps([{'idType': 'ID_ISIN', 'idValue': isin} for isin in isins])
+
+
+def tickers_from_openfigi_mapping(isins: List[str], job_results: List[dict]) -> Dict[str, Optional[str]]:
+    """
+    :param isins: the ISINs of a mapping request
+    :param job_results: the answer of OpenFIGI, one entry per job in the same order as the jobs
+    :return: dictionary with the isin as key and the ticker (or None when OpenFIGI does not know the ISIN) as value
+    """
+    tickers = {}
+    for isin, job_result in zip(isins, job_results):
+        if 'data' in job_result:
+            tickers[isin] = job_result['data'][0].get('ticker', None)
+        elif 'warning' in job_result:
+            tickers[isin] = None
+    return tickers
+
+
+def fetch_tickers_from_openfigi(openfigi_apikey: str, isins: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Asks OpenFIGI for the tickers belonging to a number of ISINs, using as few requests as the API allows.
+    :param openfigi_apikey: optional, used to bypass rate limits
+    :param isins: the isin codes from the csv file
+    :return: dictionary with the isin as key and the ticker (or None when OpenFIGI does not know the ISIN) as value.
+    ISINs that are missing from the dictionary could not be looked up (rate limited, OpenFIGI down, ...)
+    """
+    tickers = {}
+    for chunk in openfigi_chunks(openfigi_apikey, isins):
+        open_figi_rate_limiter.acquire()
+        try:
+            with external_call('openfigi'):
+                response = market_data_session.post(open_figi_mapping_url, headers=openfigi_headers(openfigi_apikey),
+                                                    data=openfigi_mapping_payload(chunk))
+        except requests.RequestException:
+            # Still failing after the retries, or OpenFIGI is known to be down
+            continue
+        open_figi_rate_limiter.update_from_headers(response.headers)
+
+        if response.status_code != 200:
+            external_call_failed('openfigi')
+            continue
+        tickers.update(tickers_from_openfigi_mapping(chunk, response.json()))
+
+    return tickers
+
+
+@timed_stage('resolve')
+def cached_isins_to_tickers(openfigi_apikey: str, isins: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Converts all ISINs of an upload to tickers at once. The TickerMapping table is consulted first, the ISINs without
+    a fresh mapping are looked up at OpenFIGI in bulk. Both found tickers and ISINs unknown to OpenFIGI are stored
+    (the latter with a shorter TTL, see settings.TICKER_CACHE_NEGATIVE_TTL). Failed requests are not cached so they
+    are retried on the next upload. Concurrent callers missing the same ISINs look them up only once, see
+    SingleFlight.
     :param openfigi_apikey: optional, used to bypass rate limits
-    :param isin: the isin code from the csv file
-    :return: string containing the ticker or none
+    :param isins: the isin codes from the csv file
+    :return: dictionary with the isin as key and the ticker or None as value
     """
-    url = "https://api.openfigi.com/v2/mapping"
-    headers = {'Content-Type': 'text/json', 'openfigi-apikey': openfigi_apikey}
-    payload = json.dumps([{'idType': 'ID_ISIN', 'idValue': isin}])
-    response = requests.post(url, headers=headers, data=payload)
-    if response.status_code == 200:
-        data = response.json()
-        return data[0]['data'][0].get('ticker', None) if 'data' in data[0] else None
-    return None
+    isins = list(dict.fromkeys(isins))
+    tickers, mappings = fresh_cached_tickers(isins)
+    missing_isins = [isin for isin in isins if isin not in tickers]
+    if missing_isins:
+        with openfigi_flight.flight(missing_isins):
+            # Other callers may have looked up some of the ISINs while this one waited for them
+            looked_up_tickers, mappings = fresh_cached_tickers(missing_isins, count_lookups=False)
+            tickers.update(looked_up_tickers)
+            missing_isins = [isin for isin in missing_isins if isin not in looked_up_tickers]
+            if missing_isins:
+                fetched_tickers = fetch_tickers_from_openfigi(openfigi_apikey, missing_isins)
+                tickers.update(store_fetched_tickers(missing_isins, fetched_tickers, mappings))
+    return tickers
 
 
-def fetch_yearly_stock_prices(ticker: str, unique_years: List[int]) -> Dict[int, Dict[str, Union[float, None]]]:
+def fresh_cached_tickers(isins: List[str], count_lookups: bool = True) -> Tuple[Dict[str, Optional[str]],
+                                                                              Dict[str, TickerMapping]]:
+    """
+    :param isins: unique isin codes
+    :param count_lookups: whether to count the lookups in the ticker cache, not done when checking again
+    :return: tuple of the tickers of the ISINs that have a fresh mapping and all mappings held for the ISINs
     """
-    Function that takes in the unique years in which the data for stocks should be collected.
-    It then returns a dictionary that has the years as keys and the start, mid, Q1 end, Q3 end, and close prices
-    of that stock for the year.
+    mappings = {mapping.isin: mapping for mapping in TickerMapping.objects.filter(isin__in=isins)}
+    tickers = {isin: mapping.ticker for isin, mapping in mappings.items() if mapping.is_fresh()}
+    if count_lookups:
+        count_cache_lookups('ticker', hits=len(tickers), misses=len(isins) - len(tickers))
+    return tickers, mappings
+
+
+def store_fetched_tickers(missing_isins: List[str], fetched_tickers: Dict[str, Optional[str]],
+                          mappings: Dict[str, TickerMapping]) -> Dict[str, Optional[str]]:
+    """
+    Stores the tickers fetched from OpenFIGI for the ISINs without a fresh mapping.
+    :param missing_isins: the ISINs without a fresh mapping
+    :param fetched_tickers: what OpenFIGI answered, see fetch_tickers_from_openfigi
+    :param mappings: all mappings held for the ISINs, see fresh_cached_tickers
+    :return: the ticker of every missing ISIN
+    """
+    now = timezone.now()
+    TickerMapping.objects.bulk_create(
+        [TickerMapping(isin=isin, ticker=ticker, fetched_at=now) for isin, ticker in fetched_tickers.items()],
+        update_conflicts=True, unique_fields=['isin'], update_fields=['ticker', 'fetched_at'])
+
+    tickers = dict(fetched_tickers)
+    # Rather serve a stale mapping than nothing at all
+    for isin in missing_isins:
+        if isin not in tickers:
+            tickers[isin] = mappings[isin].ticker if isin in mappings else None
+    return tickers
+
+
+def download_close_prices(ticker: str, start: date, end: date) -> pd.Series:
+    """
+    Downloads the daily closes of a ticker from Yahoo Finance.
+    Ticker.history is used rather than yf.download, since the latter keeps its results in a module level dictionary
+    and can not be called from multiple threads at once.
     :param ticker: ticker + exchange code (VUSA.AS)
+    :param start: first day to download
+    :param end: day after the last day to download
+    :return: Series with the close per day, empty if Yahoo Finance has no data
+    """
+    with external_call('yahoo'):
+        data = yf.Ticker(ticker, session=market_data_session).history(
+            start=start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d'), auto_adjust=False, actions=False,
+            timeout=settings.MARKET_DATA_TIMEOUT)
+    if data.empty:
+        return pd.Series(dtype=float)
+
+    close = data['Close'].dropna()
+    close.index = close.index.tz_localize(None)
+    return close
+
+
+def download_close_prices_bulk(tickers: List[str], start: date, end: date) -> Dict[str, pd.Series]:
+    """
+    Downloads the daily closes of a number of tickers from Yahoo Finance in one go.
+    :param tickers: tickers + exchange codes (VUSA.AS)
+    :param start: first day to download
+    :param end: day after the last day to download
+    :return: dictionary with the ticker as key and a Series with the close per day as value, tickers Yahoo Finance
+    has no data for are left out
+    """
+    with yf_download_lock, external_call('yahoo'):
+        data = yf.download(tickers, start=start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d'), threads=True,
+                           session=market_data_session, timeout=settings.MARKET_DATA_TIMEOUT)
+    if data.empty:
+        return {}
+
+    closes = data['Close']
+    if isinstance(closes, pd.Series):  # yfinance only returns a column per ticker when there are multiple tickers
+        closes = closes.to_frame(tickers[0])
+
+    closes_per_ticker = {}
+    for ticker in tickers:
+        if ticker in closes:
+            ticker_closes = closes[ticker].dropna()
+            if not ticker_closes.empty:
+                closes_per_ticker[ticker] = ticker_closes
+    return closes_per_ticker
+
+
+def download_close_prices_per_ticker(tickers: List[str], start: date, end: date) -> Dict[str, pd.Series]:
+    """
+    Same as download_close_prices_bulk, but downloads the tickers one by one. Unlike yf.download this can be used
+    from multiple threads at once.
+    """
+    closes_per_ticker = {ticker: download_close_prices(ticker, start, end) for ticker in tickers}
+    return {ticker: closes for ticker, closes in closes_per_ticker.items() if not closes.empty}
+
+
+def missing_price_ranges(coverage: Optional[PriceHistoryCoverage], start: date, end: date) -> List[Tuple[date, date]]:
+    """
+    :param coverage: the range of prices held for a ticker, None if nothing is held yet
+    :param start: first day that is needed
+    :param end: day after the last day that is needed
+    :return: list of [start, end) ranges that have to be downloaded to hold all prices between start and end
+    """
+    if coverage is None:
+        return [(start, end)]
+
+    missing_ranges = []
+    if start < coverage.start:
+        missing_ranges.append((start, coverage.start))
+    if end > coverage.end:
+        missing_ranges.append((coverage.end, end))
+    return missing_ranges
+
+
+def store_close_prices(ticker: str, closes: pd.Series, start: date, end: date):
+    """
+    Stores the closes downloaded for the range [start, end) and extends the coverage of the ticker with that range.
+    Days after the last close may just not be published yet, so the coverage only extends up to the last close and
+    those days are downloaded again next time.
+    Every statement is a write, so the transaction takes the write lock up front. On SQLite a transaction that reads
+    first and writes later fails right away when another thread is writing, instead of waiting for its turn.
+    """
+    with transaction.atomic():
+        PriceHistory.objects.bulk_create(
+            [PriceHistory(ticker=ticker, date=day.date(), close=close) for day, close in closes.items()],
+            update_conflicts=True, unique_fields=['ticker', 'date'], update_fields=['close'])
+
+        extended = {'start': Least('start', Value(start)), 'updated_at': timezone.now()}
+        if not closes.empty:
+            covered_end = min(end, closes.index[-1].date() + timedelta(days=1))
+            extended['end'] = Greatest('end', Value(covered_end))
+        if not PriceHistoryCoverage.objects.filter(ticker=ticker).update(**extended) and not closes.empty:
+            PriceHistoryCoverage.objects.create(ticker=ticker, start=start, end=covered_end)
+
+
+def read_price_histories(tickers: List[str], start: date, end: date) -> Dict[str, pd.DataFrame]:
+    prices = pd.DataFrame.from_records(
+        PriceHistory.objects.filter(ticker__in=tickers, date__gte=start, date__lt=end).order_by('ticker', 'date')
+        .values_list('ticker', 'date', 'close'), columns=['ticker', 'Date', 'Close'])
+    prices['Date'] = pd.to_datetime(prices['Date'])
+
+    price_histories = {ticker: ticker_prices.set_index('Date')[['Close']].astype(float)
+                       for ticker, ticker_prices in prices.groupby('ticker')}
+    for ticker in tickers:
+        if ticker not in price_histories:
+            price_histories[ticker] = pd.DataFrame({'Close': pd.Series(dtype=float)},
+                                                   index=pd.DatetimeIndex([], name='Date'))
+    return price_histories
+
+
+@timed_stage('fetch')
+def fetch_price_histories(tickers: List[str], start: date, end: date,
+                          download=download_close_prices_bulk) -> Dict[str, pd.DataFrame]:
+    """
+    Returns the daily closes of a number of tickers between start and end. Closes that were downloaded before are read
+    from the PriceHistory table, only the days that are not held yet (usually just the last few days) are downloaded.
+    Tickers that miss the same range of days are downloaded together. Concurrent callers missing days of the same
+    tickers wait for each other and only download the days that are still missing then, see SingleFlight.
+    :param tickers: tickers + exchange codes (VUSA.AS)
+    :param start: first day to return
+    :param end: day after the last day to return
+    :param download: function used to download the missing closes, see download_close_prices_bulk
+    :return: dictionary with the ticker as key and a DataFrame with a 'Close' column indexed by date as value. The
+    DataFrame is empty if Yahoo Finance has no data for the ticker
+    """
+    tickers = list(dict.fromkeys(tickers))
+    coverages, tickers_per_range = missing_price_ranges_per_ticker(tickers, start, end)
+    missing_tickers = {ticker for range_tickers in tickers_per_range.values() for ticker in range_tickers}
+    tickers_to_download = [ticker for ticker in tickers if ticker in missing_tickers]
+    count_cache_lookups('price', hits=len(tickers) - len(tickers_to_download), misses=len(tickers_to_download))
+
+    if tickers_to_download:
+        with yahoo_flight.flight(tickers_to_download):
+            # Other callers may have downloaded some of the days while this one waited for them
+            coverages, tickers_per_range = missing_price_ranges_per_ticker(tickers_to_download, start, end)
+
+            # No transaction is held during the download, the closes of every ticker are stored in a short one of
+            # their own
+            for (range_start, range_end), range_tickers in tickers_per_range.items():
+                closes_per_ticker = download(range_tickers, range_start, range_end)
+                for ticker in range_tickers:
+                    closes = closes_per_ticker.get(ticker, pd.Series(dtype=float))
+                    # Nothing to store for a ticker without data, like most exchanges that are probed for a new product
+                    if not closes.empty or ticker in coverages:
+                        store_close_prices(ticker, closes, range_start, range_end)
+
+    return read_price_histories(tickers, start, end)
+
+
+def missing_price_ranges_per_ticker(tickers: List[str], start: date, end: date) -> Tuple[
+        Dict[str, PriceHistoryCoverage], Dict[Tuple[date, date], List[str]]]:
+    """
+    :return: tuple of the coverages held for the tickers and the tickers that miss a range of days per range, see
+    missing_price_ranges
+    """
+    coverages = {coverage.ticker: coverage for coverage in PriceHistoryCoverage.objects.filter(ticker__in=tickers)}
+    tickers_per_range = {}
+    for ticker in tickers:
+        for missing_range in missing_price_ranges(coverages.get(ticker), start, end):
+            tickers_per_range.setdefault(missing_range, []).append(ticker)
+    return coverages, tickers_per_range
+
+
+def fetch_price_history(ticker: str, start: date, end: date) -> pd.DataFrame:
+    """
+    Same as fetch_price_histories for a single ticker. Safe to use from multiple threads at once.
+    :param ticker: ticker + exchange code (VUSA.AS)
+    :param start: first day to return
+    :param end: day after the last day to return
+    :return: DataFrame with a 'Close' column indexed by date, empty if Yahoo Finance has no data for the ticker
+    """
+    return fetch_price_histories([ticker], start, end, download=download_close_prices_per_ticker)[ticker]
+
+
+def price_history_range(unique_years: List[int]) -> Tuple[date, date]:
+    """
+    :param unique_years: list containing integers of the years to be fetched
+    :return: the [start, end) range of days to fetch prices for
+    """
+    return date(min(unique_years), 1, 1), min(date(max(unique_years), 12, 31), date.today())
+
+
+class PriceIndex:
+    """
+    The daily closes of a ticker as a sorted array of dates and an array of closes. Looking up the closes at any
+    number of dates takes a single binary search (np.searchsorted) over the dates, rather than slicing a DataFrame
+    per date.
+    """
+
+    def __init__(self, price_history: pd.DataFrame):
+        """
+        :param price_history: DataFrame with a 'Close' column indexed by date, see fetch_price_histories
+        """
+        self.dates = price_history.index.to_numpy(dtype='datetime64[ns]')
+        self.closes = price_history['Close'].to_numpy(dtype=float)
+
+    @property
+    def empty(self) -> bool:
+        return len(self.dates) == 0
+
+    def _closes_at(self, positions: np.ndarray, found: np.ndarray) -> np.ndarray:
+        closes = np.full(len(positions), np.nan)
+        closes[found] = self.closes[positions[found]]
+        return closes
+
+    def closes_on_or_before(self, dates) -> np.ndarray:
+        """
+        :param dates: dates in any order
+        :return: per date the last close on or before it, NaN if there is no close before the date
+        """
+        positions = np.searchsorted(self.dates, pd.DatetimeIndex(dates).to_numpy(), side='right') - 1
+        return self._closes_at(positions, positions >= 0)
+
+    def first_and_last_closes(self, starts, ends) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param starts: first day of every range
+        :param ends: last day of every range
+        :return: per range the first and the last close within the range, NaN if there are no closes in the range
+        """
+        first = np.searchsorted(self.dates, pd.DatetimeIndex(starts).to_numpy(), side='left')
+        last = np.searchsorted(self.dates, pd.DatetimeIndex(ends).to_numpy(), side='right') - 1
+        found = last >= first
+        return self._closes_at(first, found), self._closes_at(last, found)
+
+
+# Days of the year the worth is reported at besides the start and the end of the year, see calculate_yearly_worth
+yearly_checkpoints = {'mid_price': (6, 30), 'Q1_end': (3, 1), 'Q3_end': (10, 1)}
+
+
+@timed_stage('compute')
+def yearly_prices_from_history(price_index: PriceIndex,
+                               unique_years: List[int]) -> Dict[int, Dict[str, Union[float, None]]]:
+    """
+    Picks the start, mid, Q1 end, Q3 end, and close prices per year from the daily closes of a stock. The start and
+    close prices are the first and last close within the year. The checkpoint prices are the last close on or before
+    the checkpoint, so a checkpoint that falls on a weekend or holiday gets the close of the trading day before it.
+    Checkpoints that are still in the future have no price.
+    :param price_index: the daily closes of the stock
     :param unique_years: list containing integers of the years to be fetched
     :return: A dictionary containing a dictionary that returns the open, mid, Q1 end, Q3 end, and
-    close prices for a given year
+    close prices for a given year. Years without any close are left out
     """
+    if price_index.empty:
+        return {}
+
+    start_prices, end_prices = price_index.first_and_last_closes(
+        [date(year, 1, 1) for year in unique_years], [date(year, 12, 31) for year in unique_years])
+
+    today = date.today()
+    checkpoint_prices = {}
+    for name, (month, day) in yearly_checkpoints.items():
+        checkpoints = [date(year, month, day) for year in unique_years]
+        prices = price_index.closes_on_or_before(checkpoints)
+        checkpoint_prices[name] = [price if checkpoint <= today and not np.isnan(price) else None
+                                   for checkpoint, price in zip(checkpoints, prices)]
+
     yearly_prices = {}
-    start_date = f"{min(unique_years)}-01-01"
-    end_date = f"{max(unique_years)}-12-31"
+    for position, year in enumerate(unique_years):
+        if np.isnan(start_prices[position]):
+            continue
+        yearly_prices[year] = {
+            'start_price': start_prices[position],
+            'mid_price': checkpoint_prices['mid_price'][position],
+            'Q1_end': checkpoint_prices['Q1_end'][position],
+            'Q3_end': checkpoint_prices['Q3_end'][position],
+            'end_price': end_prices[position],
+        }
+    return yearly_prices
+
+
+def candidate_exchange_codes(exchanges: Iterable[str]) -> List[str]:
+    """
+    Orders the Yahoo Finance suffixes to try for a product: the exchanges the product was traded on according to the
+    CSV come first (most used first), followed by the remaining default exchange codes.
+    :param exchanges: values of the Beurs and Uitvoeringsplaats columns for a product
+    :return: list of Yahoo Finance suffixes
+    """
+    suffixes = pd.Series([degiro_exchange_to_yahoo_suffix.get(exchange) for exchange in exchanges], dtype=object)
+    hinted_codes = list(suffixes.dropna().value_counts(sort=True).index)
+    return list(dict.fromkeys(hinted_codes + default_exchange_codes))
 
-    if pd.to_datetime(end_date) > pd.to_datetime(date.today()):
-        end_date = date.today().strftime('%Y-%m-%d')
 
-    data = yf.download(ticker, start=start_date, end=end_date, threads=True)
+def probe_exchange(ticker: str, exchange_code: str, start: date, end: date) -> pd.DataFrame:
+    try:
+        return fetch_price_history(f"{ticker}.{exchange_code}", start, end)
+    finally:
+        # Probes run in their own threads, which would otherwise each keep a database connection open
+        connection.close()
 
-    if data.empty:
-        return yearly_prices
 
-    for year in unique_years:
-        year_data = data.loc[f"{year}-01-01":f"{year}-12-31"]
+@timed_stage('fetch')
+def find_listing(ticker: str, unique_years: List[int],
+                 exchange_codes: List[str]) -> Tuple[Optional[str], pd.DataFrame]:
+    """
+    Finds an exchange Yahoo Finance has price data for. The most likely exchange is tried first, the others only when
+    it has no data. Those are tried at the same time, and the most likely of them that has data wins.
+    :param ticker: ticker without exchange code (VUSA)
+    :param unique_years: list containing integers of the years to be fetched
+    :param exchange_codes: Yahoo Finance suffixes to try, most likely first
+    :return: tuple of the exchange code and the daily closes between the start of the first and the end of the last
+    year (see fetch_price_history), (None, empty DataFrame) if no exchange has data for the ticker
+    """
+    if not exchange_codes:
+        return None, empty_price_history()
 
-        if not year_data.empty:
-            start_price = year_data.iloc[0]['Close']
+    start, end = price_history_range(unique_years)
+    # Analyses of the same new product at the same time probe its exchanges once, the exchanges without data are not
+    # cached so the flight of fetch_price_histories would not stop the others from probing them again
+    return listing_flight.share(f"{ticker} {start} {end} {' '.join(exchange_codes)}",
+                                probe_exchanges, ticker, exchange_codes, start, end)
 
-            mid_price = year_data.loc[f"{year}-06-30":f"{year}-06-30"]['Close']
-            mid_price = mid_price.iloc[0] if not mid_price.empty else None
 
-            q1_end_price = year_data.loc[f"{year}-03-01":f"{year}-03-01"]['Close']
-            q1_end_price = q1_end_price.iloc[0] if not q1_end_price.empty else None
+def empty_price_history() -> pd.DataFrame:
+    return pd.DataFrame({'Close': pd.Series(dtype=float)}, index=pd.DatetimeIndex([], name='Date'))
 
-            q3_end_price = year_data.loc[f"{year}-10-01":f"{year}-10-01"]['Close']
-            q3_end_price = q3_end_price.iloc[0] if not q3_end_price.empty else None
 
-            end_price = year_data.iloc[-1]['Close']
+def probe_exchanges(ticker: str, exchange_codes: List[str], start: date,
+                    end: date) -> Tuple[Optional[str], pd.DataFrame]:
+    # The most likely exchange (usually the one the CSV names) nearly always has the prices, so the others are only
+    # probed when it has not.
+    price_history = fetch_price_history(f"{ticker}.{exchange_codes[0]}", start, end)
+    if not price_history.empty:
+        return exchange_codes[0], price_history
+    if len(exchange_codes) == 1:
+        return None, price_history
 
-            yearly_prices[year] = {
-                'start_price': start_price,
-                'mid_price': mid_price,
-                'Q1_end': q1_end_price,
-                'Q3_end': q3_end_price,
-                'end_price': end_price
-            }
+    executor = ThreadPoolExecutor(max_workers=len(exchange_codes) - 1)
+    try:
+        probes = [(exchange_code, submit_with_context(executor, probe_exchange, ticker, exchange_code, start, end))
+                  for exchange_code in exchange_codes[1:]]
+        # The results are taken in order of likelihood rather than of arrival, so the same exchange wins every time
+        for exchange_code, probe in probes:
+            price_history = probe.result()
+            if not price_history.empty:
+                return exchange_code, price_history
+    finally:
+        # The probes of less likely exchanges are not waited for, their results are simply ignored
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    return yearly_prices
+    return None, empty_price_history()
+
+
+@timed_stage('db')
+def remembered_exchange_codes(isins: Iterable[str]) -> Dict[str, str]:
+    """
+    :param isins: the isin codes from the csv file
+    :return: dictionary with the isin as key and the exchange code that had price data the last time as value
+    """
+    return dict(TickerMapping.objects.filter(isin__in=list(isins), exchange_code__isnull=False)
+                .values_list('isin', 'exchange_code'))
+
+
+@timed_stage('db')
+def remembered_currencies(isins: Iterable[str]) -> Dict[str, str]:
+    """
+    :param isins: the isin codes from the csv file
+    :return: dictionary with the isin as key and the currency of the listing of its remembered exchange code as value,
+    isins whose currency is not known yet are left out
+    """
+    return dict(TickerMapping.objects.filter(isin__in=list(isins), exchange_code__isnull=False,
+                                             currency__isnull=False).values_list('isin', 'currency'))
+
+
+@timed_stage('db')
+def remember_exchange_code(isin: str, exchange_code: str, currency: Optional[str]):
+    TickerMapping.objects.filter(isin=isin).update(exchange_code=exchange_code, currency=currency)
+
+
+@timed_stage('fetch')
+def fetch_listing_currency(listing: str) -> Optional[str]:
+    """
+    Asks Yahoo Finance which currency a listing is quoted in.
+    :param listing: ticker + exchange code (VUSA.L)
+    :return: the currency as Yahoo Finance reports it (GBp for prices in pence), None if it could not be fetched
+    """
+    try:
+        with external_call('yahoo'):
+            metadata = yf.Ticker(listing, session=market_data_session).get_history_metadata()
+    except Exception:
+        logger.warning("Could not fetch the currency of %s", listing, exc_info=True)
+        return None
+    return (metadata or {}).get('currency') or None
@@ -1,3 +1,1184 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from unittest import mock, skipIf
 
-# Create your tests here.
+import httpx
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .analyze_portfolio import calculate_multi_year_gain, calculate_stock_aggregates, calculate_yearly_holdings
+from .async_analysis import create_market_data_client, fetch_tickers_from_openfigi_async, post_market_data
+from .benchmarks.providers import synthetic_market_data
+from .benchmarks.synthetic import generate_degiro_csv, synthetic_price_history, synthetic_ticker
+from .cache_warming import forget_ticker_usage, hot_tickers, record_ticker_usage, refresh_ticker_mappings, \
+    warm_caches
+from .exchange_rates import listing_currency, exchange_rate_index, convert_price_index, rate_indexes, \
+    load_exchange_rates_file, MissingExchangeRates
+from .instrumentation import MetricsRegistry, collect_metrics, timed_stage
+from .ledger import ledger_dataframe, transaction_keys, update_ledger
+from .management.commands.load_test import UploadMix, latency_percentiles
+from .renderers import AnalysisResultRenderer, to_columnar
+from .models import AnalysisJob, ExchangeRate, Portfolio, PriceHistoryCoverage, TickerMapping, TickerUsage
+from .result_cache import cached_multi_year_gain, result_cache_key, streamed_multi_year_gain
+from .stockdata_fetchers import CircuitOpen, PriceIndex, SingleFlight, cached_isins_to_tickers, \
+    check_and_convert_csv_headers, create_market_data_session, fetch_price_histories, fetch_tickers_from_openfigi, \
+    probe_exchanges, yearly_checkpoints, yearly_prices_from_history, fcntl
+from .uploads import UploadSizeLimitHandler, UploadTooLarge, open_uploaded_csv
+from .views import ndjson_lines
+from .worth_series import calculate_worth_series, downsample_lttb, series_dates
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.server.answer(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.requests += 1
+        status, delay = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        time.sleep(delay)
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer:
+    """
+    Local HTTP server that answers the requests with the given (status, delay in seconds) responses in turn, and with
+    200 once they have all been used. The body of a response is answer(body of the request).
+    """
+
+    def __init__(self, responses: List[Tuple[int, float]], answer=lambda body: b'[]'):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.responses = list(responses)
+        self.server.answer = answer
+        self.server.requests = 0
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v3/mapping"
+
+    @property
+    def requests(self) -> int:
+        return self.server.requests
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@override_settings(MARKET_DATA_RETRIES=0, MARKET_DATA_CIRCUIT_FAILURE_THRESHOLD=2,
+                   MARKET_DATA_CIRCUIT_RESET_TIMEOUT=0.2)
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.session = create_market_data_session()
+
+    def post(self, url: str) -> int:
+        return self.session.post(url, timeout=5).status_code
+
+    def test_opens_after_consecutive_failures(self):
+        with StubServer([(500, 0), (503, 0)]) as server:
+            self.assertEqual(self.post(server.url), 500)
+            self.assertEqual(self.post(server.url), 503)
+            with self.assertRaises(CircuitOpen):
+                self.post(server.url)
+            self.assertEqual(server.requests, 2)
+
+    def test_rate_limiting_after_the_retries_counts_as_failure(self):
+        with StubServer([(429, 0), (429, 0)]) as server:
+            self.post(server.url)
+            self.post(server.url)
+            with self.assertRaises(CircuitOpen):
+                self.post(server.url)
+
+    def test_successful_trial_closes_the_circuit(self):
+        with StubServer([(500, 0), (500, 0)]) as server:
+            self.post(server.url)
+            self.post(server.url)
+            time.sleep(0.25)
+            self.assertEqual(self.post(server.url), 200)
+            self.assertEqual(self.post(server.url), 200)
+
+    def test_failed_trial_opens_the_circuit_again(self):
+        with StubServer([(500, 0), (500, 0), (500, 0)]) as server:
+            self.post(server.url)
+            self.post(server.url)
+            time.sleep(0.25)
+            self.assertEqual(self.post(server.url), 500)
+            with self.assertRaises(CircuitOpen):
+                self.post(server.url)
+            self.assertEqual(server.requests, 3)
+
+    def test_cancelled_async_trial_does_not_keep_the_circuit_open(self):
+        async def cancelled_trial(url: str):
+            async with create_market_data_client() as client:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(post_market_data(client, url), timeout=0.1)
+
+        async def trial(url: str) -> int:
+            async with create_market_data_client() as client:
+                return (await post_market_data(client, url)).status_code
+
+        with StubServer([(500, 0), (500, 0), (200, 1)]) as server, \
+                mock.patch('portfolio_analyzer.async_analysis.market_data_session', self.session):
+            self.post(server.url)
+            self.post(server.url)
+            time.sleep(0.25)
+            asyncio.run(cancelled_trial(server.url))
+            # The next call is let through as the trial and closes the circuit
+            self.assertEqual(asyncio.run(trial(server.url)), 200)
+            self.assertEqual(self.post(server.url), 200)
+
+
+class AsyncMarketDataClientTests(SimpleTestCase):
+    def test_client_is_closed_after_the_lookups(self):
+        clients = []
+
+        def tracked_client() -> httpx.AsyncClient:
+            clients.append(create_market_data_client())
+            return clients[-1]
+
+        with StubServer([]) as server, \
+                mock.patch('portfolio_analyzer.async_analysis.open_figi_mapping_url', server.url), \
+                mock.patch('portfolio_analyzer.async_analysis.create_market_data_client', tracked_client):
+            asyncio.run(fetch_tickers_from_openfigi_async('api-key', [f"NL000000000{i}" for i in range(250)]))
+            self.assertEqual(server.requests, 3)
+        self.assertEqual(len(clients), 1)
+        self.assertTrue(clients[0].is_closed)
+
+
+class ListingCurrencyTests(TransactionTestCase):
+    def setUp(self):
+        rate_indexes.clear()
+
+    def test_exchanges_with_a_single_currency_are_not_looked_up(self):
+        with mock.patch('portfolio_analyzer.exchange_rates.fetch_listing_currency') as fetch_listing_currency:
+            self.assertEqual(listing_currency('VUSA.AS', 'AS'), 'EUR')
+        fetch_listing_currency.assert_not_called()
+
+    def test_other_listings_use_the_currency_yahoo_reports(self):
+        with mock.patch('portfolio_analyzer.exchange_rates.fetch_listing_currency', return_value='GBp'):
+            self.assertEqual(listing_currency('VUSA.L', 'L'), 'GBp')
+
+    def test_missing_rates_are_looked_up_again(self):
+        self.assertIsNone(exchange_rate_index('USD'))
+        ExchangeRate.objects.create(currency='USD', date=date(2020, 1, 2), rate=1.25)
+        self.assertIsNotNone(exchange_rate_index('USD'))
+
+    def test_prices_in_pence_are_converted_to_euro(self):
+        ExchangeRate.objects.create(currency='GBP', date=date(2020, 1, 2), rate=0.8)
+        price_index = PriceIndex(pd.DataFrame({'Close': [200.0]}, index=pd.DatetimeIndex(['2020-01-03'], name='Date')))
+        self.assertAlmostEqual(convert_price_index(price_index, 'GBp').closes[0], 2.5)
+
+    def test_closes_are_converted_with_the_rate_of_their_day(self):
+        ExchangeRate.objects.bulk_create([ExchangeRate(currency='USD', date=date(2020, 1, 3), rate=1.25),
+                                          ExchangeRate(currency='USD', date=date(2020, 1, 7), rate=2.0)])
+        price_index = PriceIndex(pd.DataFrame({'Close': [10.0, 10.0, 10.0, 10.0]}, index=pd.DatetimeIndex(
+            ['2020-01-02', '2020-01-03', '2020-01-06', '2020-01-07'], name='Date')))
+        converted = convert_price_index(price_index, 'USD')
+        # The close from before the first rate is left out, the 6th has no rate of its own
+        np.testing.assert_array_equal(converted.dates, price_index.dates[1:])
+        np.testing.assert_array_almost_equal(converted.closes, [8.0, 8.0, 5.0])
+
+    def test_closes_in_euro_are_not_converted(self):
+        price_index = PriceIndex(pd.DataFrame({'Close': [10.0]}, index=pd.DatetimeIndex(['2020-01-02'], name='Date')))
+        self.assertIs(convert_price_index(price_index, 'EUR'), price_index)
+
+    def test_currency_without_rates_is_reported(self):
+        price_index = PriceIndex(pd.DataFrame({'Close': [10.0]}, index=pd.DatetimeIndex(['2020-01-02'], name='Date')))
+        with self.assertRaisesMessage(MissingExchangeRates, "No exchange rates for JPY"):
+            convert_price_index(price_index, 'JPY')
+
+    def test_ecb_reference_rates_are_loaded(self):
+        ecb_csv = (b"Date,USD,JPY,CYP,\n"
+                   b"2020-01-03,1.1147,121.20,N/A,\n"
+                   b"2020-01-02,1.1193,121.75,N/A,\n")
+        self.assertEqual(load_exchange_rates_file(io.BytesIO(ecb_csv)), 4)
+        self.assertEqual(ExchangeRate.objects.get(currency='USD', date=date(2020, 1, 3)).rate, 1.1147)
+        self.assertFalse(ExchangeRate.objects.filter(currency='CYP').exists())
+
+        # Loading a newer file replaces the rates and the rates that were already read
+        exchange_rate_index('USD')
+        load_exchange_rates_file(io.BytesIO(b"Date,USD,\n2020-01-03,1.2,\n"))
+        self.assertEqual(exchange_rate_index('USD').closes.tolist(), [1.1193, 1.2])
+
+    def test_analysis_converts_with_the_remembered_currency_of_the_listing(self):
+        ExchangeRate.objects.create(currency='GBP', date=date(1999, 1, 4), rate=0.8)
+        csv_data = generate_degiro_csv(products=2, transactions=30, years=2, exchange_code='L')
+
+        def analyze(currency: str) -> dict:
+            with synthetic_market_data(exchange_code='L'), \
+                    mock.patch('portfolio_analyzer.exchange_rates.fetch_listing_currency',
+                               return_value=currency) as fetch_listing_currency:
+                results = {stock['stock_name']: stock for stock in
+                           calculate_multi_year_gain(io.BytesIO(csv_data))['results']}
+            return results, fetch_listing_currency.call_count
+
+        in_pence, lookups = analyze('GBp')
+        self.assertEqual(lookups, 2)
+        self.assertEqual(set(TickerMapping.objects.values_list('exchange_code', 'currency')), {('L', 'GBp')})
+        # The second analysis uses the remembered currency
+        self.assertEqual(analyze('GBp'), (in_pence, 0))
+
+        TickerMapping.objects.update(currency=None)
+        in_euro, _ = analyze('EUR')
+        for stock, result in in_pence.items():
+            self.assertAlmostEqual(result['final_worth'], in_euro[stock]['final_worth'] / 100 / 0.8, delta=0.01)
+
+    def test_portfolio_without_any_convertible_stock_reports_the_errors(self):
+        csv_data = generate_degiro_csv(products=2, transactions=10, years=2, exchange_code='L')
+        with synthetic_market_data(exchange_code='L'), \
+                mock.patch('portfolio_analyzer.exchange_rates.fetch_listing_currency', return_value='GBp'):
+            result = calculate_multi_year_gain(io.BytesIO(csv_data))
+        self.assertEqual(len(result['results']), 2)
+        for stock in result['results']:
+            self.assertIn("No exchange rates for GBP", stock['error'])
+        self.assertEqual(result['summary']['total_gain_percentage'], 0)
+        self.assertEqual(result['summary']['total_worth'], 0)
+
+
+def with_first_transaction_field(csv_data: bytes, position: int, value: str) -> bytes:
+    """
+    :return: the CSV with a field of its first transaction replaced
+    """
+    lines = csv_data.decode().splitlines()
+    fields = lines[1].split(',')
+    fields[position] = value
+    lines[1] = ','.join(fields)
+    return '\n'.join(lines).encode()
+
+
+class UploadValidationTests(TestCase):
+    csv_data = generate_degiro_csv(products=2, transactions=10, years=2)
+
+    def post_csv(self, csv_data: bytes, file_name: str = 'Transactions.csv'):
+        return self.client.post('/calculate_multi_year_gain/',
+                                {'csv_file': SimpleUploadedFile(file_name, csv_data)})
+
+    def assert_rejected(self, response, message: str):
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(message, response.json()['error'])
+
+    def test_invalid_date_is_rejected(self):
+        self.assert_rejected(self.post_csv(with_first_transaction_field(self.csv_data, 0, '2024-13-01')),
+                             "invalid dates")
+
+    def test_missing_date_is_rejected(self):
+        self.assert_rejected(self.post_csv(with_first_transaction_field(self.csv_data, 0, '')), "invalid dates")
+
+    def test_quantity_that_is_not_a_whole_number_is_rejected(self):
+        self.assert_rejected(self.post_csv(with_first_transaction_field(self.csv_data, 6, '1.5')), "invalid values")
+
+    def test_other_file_types_are_rejected(self):
+        self.assert_rejected(self.post_csv(self.csv_data, 'Transactions.xlsx'), "Invalid file type")
+
+    def test_corrupt_archive_is_rejected(self):
+        compressed = gzip.compress(self.csv_data)
+        # Flipping bytes of the compressed data breaks its checksum or the data itself
+        corrupt = compressed[:len(compressed) // 2] + bytes(b ^ 0xFF for b in compressed[len(compressed) // 2:])
+        self.assert_rejected(self.post_csv(corrupt, 'Transactions.csv.gz'), "could not be read")
+
+    def test_corrupt_archive_is_rejected_before_a_job_is_queued(self):
+        compressed = gzip.compress(self.csv_data)
+        response = self.client.post('/analysis_jobs/', {'csv_file': SimpleUploadedFile(
+            'Transactions.csv.gz', compressed[:len(compressed) // 2])})
+        self.assert_rejected(response, "could not be read")
+        self.assertFalse(AnalysisJob.objects.exists())
+
+
+class StaleAnalysisJobTests(TestCase):
+    def poll(self, job: AnalysisJob) -> dict:
+        return self.client.get(f'/analysis_jobs/{job.id}/').json()
+
+    def test_job_without_heartbeat_is_reported_as_failed(self):
+        job = AnalysisJob.objects.create(status=AnalysisJob.RUNNING,
+                                         heartbeat_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(self.poll(job)['status'], AnalysisJob.FAILED)
+        self.assertEqual(AnalysisJob.objects.get(id=job.id).status, AnalysisJob.FAILED)
+
+    def test_job_with_recent_heartbeat_keeps_running(self):
+        job = AnalysisJob.objects.create(status=AnalysisJob.RUNNING)
+        self.assertEqual(self.poll(job)['status'], AnalysisJob.RUNNING)
+
+    def test_finished_job_is_left_alone(self):
+        job = AnalysisJob.objects.create(status=AnalysisJob.DONE, result={'results': []},
+                                         heartbeat_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(self.poll(job)['status'], AnalysisJob.DONE)
+
+
+class ProbeExchangesTests(SimpleTestCase):
+    start, end = date(2020, 1, 1), date(2021, 1, 1)
+
+    def probe(self, listings: dict, exchange_codes: list):
+        """
+        :param listings: per listing with data the seconds its download takes
+        :return: what probe_exchanges returns and the listings that were downloaded
+        """
+        downloaded = []
+
+        def fetch_price_history(listing, start, end):
+            downloaded.append(listing)
+            if listing not in listings:
+                return pd.DataFrame({'Close': pd.Series(dtype=float)})
+            time.sleep(listings[listing])
+            return pd.DataFrame({'Close': [1.0]}, index=pd.DatetimeIndex(['2020-01-02'], name='Date'))
+
+        with mock.patch('portfolio_analyzer.stockdata_fetchers.fetch_price_history', fetch_price_history):
+            return probe_exchanges('VUSA', exchange_codes, self.start, self.end), downloaded
+
+    def test_only_the_most_likely_exchange_is_probed_when_it_has_data(self):
+        (exchange_code, _), downloaded = self.probe({'VUSA.AS': 0, 'VUSA.L': 0}, ['AS', 'DE', 'L'])
+        self.assertEqual(exchange_code, 'AS')
+        self.assertEqual(downloaded, ['VUSA.AS'])
+
+    def test_most_likely_exchange_with_data_wins_over_the_fastest(self):
+        (exchange_code, _), _ = self.probe({'VUSA.DE': 0.2, 'VUSA.L': 0}, ['AS', 'DE', 'L'])
+        self.assertEqual(exchange_code, 'DE')
+
+    def test_no_exchange_with_data(self):
+        (exchange_code, price_history), downloaded = self.probe({}, ['AS', 'DE', 'L'])
+        self.assertIsNone(exchange_code)
+        self.assertTrue(price_history.empty)
+        self.assertEqual(sorted(downloaded), ['VUSA.AS', 'VUSA.DE', 'VUSA.L'])
+
+
+class InstrumentationTests(SimpleTestCase):
+    def test_nested_stages_are_counted_once(self):
+        @timed_stage('fetch')
+        def fetch():
+            time.sleep(0.02)
+
+        @timed_stage('compute')
+        def compute():
+            fetch()
+            time.sleep(0.02)
+
+        with self.assertLogs('portfolio_analyzer', 'INFO') as logs, collect_metrics('test') as metrics:
+            compute()
+            fetch()
+        self.assertEqual(set(metrics.stages), {'compute', 'fetch'})
+        self.assertGreaterEqual(metrics.stages['compute'], 0.04)
+        self.assertLess(metrics.stages['fetch'], 0.04)
+        self.assertEqual(json.loads(logs.records[0].getMessage())['operation'], 'test')
+
+    def test_stages_outside_an_analysis_are_not_timed(self):
+        @timed_stage('fetch')
+        def fetch() -> int:
+            return 1
+
+        self.assertEqual(fetch(), 1)
+
+    def test_registry_renders_the_prometheus_text_format(self):
+        registry = MetricsRegistry()
+        registry.increment('external_calls_total', service='yahoo')
+        registry.increment('external_calls_total', 2, service='yahoo')
+        registry.observe('request_duration_seconds', 0.3, operation='Calculate "all"')
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE portfolio_analyzer_external_calls_total counter', lines)
+        self.assertIn('portfolio_analyzer_external_calls_total{service="yahoo"} 3', lines)
+        # Quotes in label values are escaped, the buckets are cumulative
+        operation = 'operation="Calculate \\"all\\""'
+        self.assertIn(f'portfolio_analyzer_request_duration_seconds_bucket{{{operation},le="0.25"}} 0', lines)
+        self.assertIn(f'portfolio_analyzer_request_duration_seconds_bucket{{{operation},le="0.5"}} 1', lines)
+        self.assertIn(f'portfolio_analyzer_request_duration_seconds_bucket{{{operation},le="+Inf"}} 1', lines)
+        self.assertIn(f'portfolio_analyzer_request_duration_seconds_count{{{operation}}} 1', lines)
+
+
+class MetricsViewTests(TestCase):
+    def test_hidden_when_not_enabled(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_served_when_enabled(self):
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    def test_served_to_staff(self):
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+
+@override_settings(SINGLE_FLIGHT_LOCK_DIR=None)
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flight = SingleFlight('test')
+
+    def test_concurrent_calls_share_one_result(self):
+        calls = []
+        started = threading.Event()
+
+        def fetch(key: str) -> str:
+            calls.append(key)
+            started.set()
+            time.sleep(0.2)
+            return f"{key}-result"
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            leader = executor.submit(self.flight.share, 'key', fetch, 'key')
+            started.wait()
+            followers = [executor.submit(self.flight.share, 'key', fetch, 'key') for _ in range(3)]
+            results = [leader.result()] + [follower.result() for follower in followers]
+
+        self.assertEqual(calls, ['key'])
+        self.assertEqual(results, ['key-result'] * 4)
+        self.assertEqual(self.flight.calls, {})
+
+    def test_waiting_callers_get_the_exception(self):
+        started = threading.Event()
+
+        def fetch():
+            started.set()
+            time.sleep(0.2)
+            raise ValueError("Yahoo is down")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(self.flight.share, 'key', fetch)
+            started.wait()
+            follower = executor.submit(self.flight.share, 'key', fetch)
+            for future in (leader, follower):
+                with self.assertRaises(ValueError):
+                    future.result()
+        self.assertEqual(self.flight.calls, {})
+
+    def run_flights(self, key_sets: List[List[str]]) -> int:
+        """
+        Runs a flight of every key set at the same time
+        :return: the largest number of flights that held their keys at the same time
+        """
+        running = max_running = 0
+        lock = threading.Lock()
+
+        def fly(keys: List[str]):
+            nonlocal running, max_running
+            with self.flight.flight(keys):
+                with lock:
+                    running += 1
+                    max_running = max(max_running, running)
+                time.sleep(0.1)
+                with lock:
+                    running -= 1
+
+        with ThreadPoolExecutor(max_workers=len(key_sets)) as executor:
+            list(executor.map(fly, key_sets))
+        return max_running
+
+    def test_flights_of_overlapping_keys_wait_for_each_other(self):
+        self.assertEqual(self.run_flights([['a', 'b'], ['b', 'c'], ['c', 'a']]), 1)
+        self.assertEqual(self.flight.key_locks, {})
+
+    def test_flights_of_other_keys_run_at_the_same_time(self):
+        self.assertEqual(self.run_flights([['a'], ['b'], ['c']]), 3)
+
+    @skipIf(fcntl is None, "Lock files need fcntl")
+    def test_flight_waits_for_the_lock_file_of_another_process(self):
+        with tempfile.TemporaryDirectory() as lock_dir, override_settings(SINGLE_FLIGHT_LOCK_DIR=lock_dir):
+            entered = threading.Event()
+
+            def fly():
+                with self.flight.flight(['key']):
+                    entered.set()
+
+            # Another process holding the lock, flock locks of separately opened files exclude each other
+            lock_path = os.path.join(lock_dir, f"test-{hashlib.sha1(b'key').hexdigest()}.lock")
+            with open(lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                thread = threading.Thread(target=fly)
+                thread.start()
+                self.assertFalse(entered.wait(0.2))
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            thread.join(timeout=5)
+            self.assertTrue(entered.is_set())
+
+
+class LedgerTests(TestCase):
+    csv_data = generate_degiro_csv(products=3, transactions=30, years=3)
+
+    def setUp(self):
+        self.portfolio = Portfolio.objects.create()
+
+    @staticmethod
+    def parse(csv_data: bytes) -> pd.DataFrame:
+        return check_and_convert_csv_headers(io.BytesIO(csv_data))
+
+    def test_identical_parts_of_an_order_get_their_own_key(self):
+        lines = self.csv_data.decode().splitlines()
+        # An order filled in two identical parts
+        df = self.parse('\n'.join(lines[:2] + lines[1:]).encode())
+        keys = transaction_keys(df)
+        self.assertTrue(keys.is_unique)
+        self.assertEqual(keys[0].rsplit('/', 1)[0], keys[1].rsplit('/', 1)[0])
+
+    def test_keys_do_not_depend_on_the_export(self):
+        lines = self.csv_data.decode().splitlines()
+        reordered = self.parse('\r\n'.join(lines[:1] + lines[:0:-1]).encode())
+        self.assertEqual(set(transaction_keys(reordered)), set(transaction_keys(self.parse(self.csv_data))))
+
+    def test_same_export_adds_nothing(self):
+        df = self.parse(self.csv_data)
+        self.assertEqual(set(update_ledger(self.portfolio, df)), set(df['Product']))
+        self.assertEqual(update_ledger(self.portfolio, df), {})
+        self.assertEqual(self.portfolio.transactions.count(), len(df))
+
+    def test_only_new_transactions_are_added(self):
+        df = self.parse(self.csv_data)
+        update_ledger(self.portfolio, df.iloc[1:])
+        newest = df.iloc[0]
+        self.assertEqual(update_ledger(self.portfolio, df), {newest['Product']: newest['Datum'].year})
+        self.assertEqual(self.portfolio.transactions.count(), len(df))
+
+    def test_ledger_holds_the_transactions_of_the_uploads(self):
+        df = self.parse(self.csv_data)
+        update_ledger(self.portfolio, df)
+        ledger_df = ledger_dataframe(self.portfolio)
+        self.assertEqual(dict(ledger_df.dtypes), dict(df[ledger_df.columns].dtypes))
+        self.assertEqual(sorted(transaction_keys(ledger_df)), sorted(transaction_keys(df)))
+
+
+class ResultCacheTests(SimpleTestCase):
+    csv_data = generate_degiro_csv(products=2, transactions=10, years=2)
+    result = {'results': [{'stock_name': 'SYNTHETIC PRODUCT 1'}], 'summary': {'final_worth': 100.0}}
+
+    def setUp(self):
+        self.cache = LocMemCache('test-results', {})
+        self.cache.clear()
+        patcher = mock.patch('portfolio_analyzer.result_cache.result_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def key(self, csv_data: bytes, resolution=None, points=None) -> str:
+        return result_cache_key(io.BytesIO(csv_data), resolution, points)
+
+    def test_key_only_depends_on_the_transactions(self):
+        lines = self.csv_data.decode().splitlines()
+        # The header in another language and Windows line endings
+        other_export = '\r\n'.join([lines[0].replace('Datum', 'Date')] + lines[1:]).encode()
+        self.assertEqual(self.key(other_export), self.key(self.csv_data))
+        self.assertNotEqual(self.key(with_first_transaction_field(self.csv_data, 6, '1')), self.key(self.csv_data))
+
+    def test_key_includes_the_resolution(self):
+        keys = {self.key(self.csv_data), self.key(self.csv_data, 'daily', None), self.key(self.csv_data, 'daily', 100),
+                self.key(self.csv_data, 'weekly', 100)}
+        self.assertEqual(len(keys), 4)
+
+    def test_file_is_rewound_after_hashing(self):
+        csv_file = io.BytesIO(self.csv_data)
+        result_cache_key(csv_file, None, None)
+        self.assertEqual(csv_file.read(), self.csv_data)
+
+    def test_configured_cache_evicts_the_least_recently_used_result(self):
+        cache = caches.create_connection('analysis_results')
+        cache.clear()
+        self.addCleanup(cache.clear)
+        max_entries = settings.CACHES['analysis_results']['OPTIONS']['MAX_ENTRIES']
+        for i in range(max_entries):
+            cache.set(f"result-{i}", i)
+        # Reading the oldest result makes the second oldest the least recently used one
+        self.assertEqual(cache.get('result-0'), 0)
+
+        cache.set('result-new', -1)
+        self.assertIsNone(cache.get('result-1'))
+        self.assertEqual(cache.get('result-0'), 0)
+        self.assertEqual(cache.get('result-2'), 2)
+        self.assertEqual(cache.get('result-new'), -1)
+
+    def test_repeated_upload_is_served_from_the_cache(self):
+        with mock.patch('portfolio_analyzer.result_cache.calculate_multi_year_gain',
+                        return_value=self.result) as calculate:
+            self.assertEqual(cached_multi_year_gain(io.BytesIO(self.csv_data)), self.result)
+            self.assertEqual(cached_multi_year_gain(io.BytesIO(self.csv_data)), self.result)
+            cached_multi_year_gain(io.BytesIO(self.csv_data), resolution='weekly')
+        self.assertEqual(calculate.call_count, 2)
+
+    def test_streamed_result_is_cached_once_complete(self):
+        records = [('result', self.result['results'][0]), ('summary', self.result['summary'])]
+        with mock.patch('portfolio_analyzer.result_cache.stream_multi_year_gain', return_value=iter(records)):
+            stream = streamed_multi_year_gain(io.BytesIO(self.csv_data))
+            next(stream)
+            self.assertIsNone(self.cache.get(self.key(self.csv_data)))
+            self.assertEqual(list(stream), records[1:])
+        self.assertEqual(self.cache.get(self.key(self.csv_data)), self.result)
+        self.assertEqual(list(streamed_multi_year_gain(io.BytesIO(self.csv_data))), records)
+
+
+class PriceIndexTests(SimpleTestCase):
+    # Closes on the business days of 2021 and 2023, none in 2022
+    dates = pd.bdate_range('2021-01-04', '2021-12-31').union(pd.bdate_range('2023-01-02', '2023-12-29'))
+    price_index = PriceIndex(pd.DataFrame({'Close': np.arange(len(dates), dtype=float)},
+                                          index=dates.rename('Date')))
+
+    def close(self, day: str) -> float:
+        return float(self.dates.get_loc(pd.Timestamp(day)))
+
+    def test_closes_on_or_before_takes_the_last_trading_day(self):
+        closes = self.price_index.closes_on_or_before(['2021-07-04', '2020-06-30', '2021-06-30', '2022-06-30'])
+        # A Sunday, a date before the first close, a trading day and a date without closes in the year
+        np.testing.assert_array_equal(closes, [self.close('2021-07-02'), np.nan, self.close('2021-06-30'),
+                                               self.close('2021-12-31')])
+
+    def test_first_and_last_closes_of_ranges(self):
+        first, last = self.price_index.first_and_last_closes(['2021-01-01', '2022-01-01'], ['2021-12-31', '2022-12-31'])
+        np.testing.assert_array_equal(first, [self.close('2021-01-04'), np.nan])
+        np.testing.assert_array_equal(last, [self.close('2021-12-31'), np.nan])
+
+    def test_yearly_prices(self):
+        yearly_prices = yearly_prices_from_history(self.price_index, [2021, 2022, 2023])
+        self.assertEqual(list(yearly_prices), [2021, 2023])
+        self.assertEqual(yearly_prices[2021], {
+            'start_price': self.close('2021-01-04'),
+            # 2021-10-01 is a Friday, 2021-06-30 a Wednesday and 2021-03-01 a Monday
+            'mid_price': self.close('2021-06-30'),
+            'Q1_end': self.close('2021-03-01'),
+            'Q3_end': self.close('2021-10-01'),
+            'end_price': self.close('2021-12-31'),
+        })
+        # 2023-07-01 is a Saturday
+        self.assertEqual(yearly_prices[2023]['mid_price'], self.close('2023-06-30'))
+
+    def test_future_checkpoints_have_no_price(self):
+        today = date.today()
+        dates = pd.bdate_range(date(today.year, 1, 1), today)
+        price_index = PriceIndex(pd.DataFrame({'Close': 1.0}, index=dates.rename('Date')))
+        yearly_prices = yearly_prices_from_history(price_index, [today.year])[today.year]
+        for name, (month, day) in yearly_checkpoints.items():
+            self.assertEqual(yearly_prices[name] is None, date(today.year, month, day) > today)
+
+    def test_empty_history(self):
+        self.assertEqual(yearly_prices_from_history(PriceIndex(pd.DataFrame({'Close': []}, index=pd.DatetimeIndex([]))),
+                                                    [2021]), {})
+
+
+class WorthSeriesTests(SimpleTestCase):
+    def test_downsampling_keeps_the_ends_and_the_peaks(self):
+        dates = pd.bdate_range('2020-01-01', periods=1000)
+        values = np.full(1000, 100)
+        values[[250, 600]] = [1000, -500]
+        downsampled = downsample_lttb(pd.Series(values, index=dates), 50)
+        self.assertEqual(len(downsampled), 50)
+        self.assertTrue(downsampled.index.is_monotonic_increasing)
+        for position in (0, 250, 600, 999):
+            self.assertIn(dates[position], downsampled.index)
+
+    def test_short_series_are_not_downsampled(self):
+        series = pd.Series([1, 2, 3], index=pd.bdate_range('2020-01-01', periods=3))
+        self.assertIs(downsample_lttb(series, 3), series)
+        self.assertIs(downsample_lttb(series, 2), series)
+
+    def test_series_dates_end_today(self):
+        dates = series_dates(pd.Timestamp('2020-01-01'), 'monthly')
+        self.assertEqual(dates[0], pd.Timestamp('2020-01-31'))
+        self.assertEqual(dates[-1], pd.Timestamp(date.today()))
+        with self.assertRaises(ValueError):
+            series_dates(pd.Timestamp('2020-01-01'), 'hourly')
+
+    def test_worth_uses_the_holdings_and_close_as_of_every_date(self):
+        stock_df = pd.DataFrame({'Datum': pd.to_datetime(['2021-01-06', '2021-01-04']), 'Aantal': [5, 10]})
+        # No closes on the 5th
+        price_index = PriceIndex(pd.DataFrame({'Close': [10.0, 12.5, 20.0]},
+                                              index=pd.DatetimeIndex(['2021-01-04', '2021-01-06', '2021-01-07'])))
+        worth = calculate_worth_series(stock_df, price_index, pd.bdate_range('2021-01-01', '2021-01-07'))
+        self.assertEqual(worth.to_dict(), {pd.Timestamp('2021-01-04'): 100, pd.Timestamp('2021-01-05'): 100,
+                                           pd.Timestamp('2021-01-06'): 187, pd.Timestamp('2021-01-07'): 300})
+
+
+def zipped(files: Dict[str, bytes]) -> bytes:
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in files.items():
+            zip_file.writestr(name, data)
+    return archive.getvalue()
+
+
+class UploadTests(TestCase):
+    csv_data = generate_degiro_csv(products=2, transactions=10, years=2)
+
+    def open(self, file_name: str, data: bytes) -> bytes:
+        return open_uploaded_csv(SimpleUploadedFile(file_name, data)).read()
+
+    def test_compressed_exports_are_decompressed(self):
+        self.assertEqual(self.open('Transactions.CSV.GZ', gzip.compress(self.csv_data)), self.csv_data)
+        self.assertEqual(self.open('Transactions.zip', zipped({'export/Transactions.csv': self.csv_data,
+                                                               'README.txt': b'DeGiro'})), self.csv_data)
+
+    def test_compressed_export_parses_like_the_csv(self):
+        csv_file = open_uploaded_csv(SimpleUploadedFile('Transactions.csv.gz', gzip.compress(self.csv_data)))
+        pd.testing.assert_frame_equal(check_and_convert_csv_headers(csv_file),
+                                      check_and_convert_csv_headers(io.BytesIO(self.csv_data)))
+
+    def test_zip_needs_a_single_csv(self):
+        for files in ({'a.csv': self.csv_data, 'b.csv': self.csv_data}, {'Transactions.txt': self.csv_data}):
+            with self.assertRaisesMessage(ValueError, "single .csv file"):
+                self.open('Transactions.zip', zipped(files))
+        with self.assertRaisesMessage(ValueError, "Invalid zip file"):
+            self.open('Transactions.zip', b'not a zip file')
+
+    @override_settings(MAX_UPLOAD_SIZE=100_000)
+    def test_exports_may_not_decompress_to_more_than_the_limit(self):
+        bomb = gzip.compress(self.csv_data + b'0' * 200_000)
+        self.assertLess(len(bomb), 100_000)
+        with self.assertRaises(UploadTooLarge):
+            self.open('Transactions.csv.gz', bomb)
+
+    @override_settings(MAX_UPLOAD_SIZE=1000)
+    def test_handler_stops_files_larger_than_the_limit(self):
+        handler = UploadSizeLimitHandler()
+        self.assertEqual(handler.receive_data_chunk(b'0' * 600, 0), b'0' * 600)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'0' * 600, 600)
+        with self.assertRaises(UploadTooLarge):
+            handler.upload_complete()
+
+    @override_settings(MAX_UPLOAD_SIZE=1000)
+    def test_large_upload_is_rejected(self):
+        response = self.client.post('/calculate_multi_year_gain/',
+                                    {'csv_file': SimpleUploadedFile('Transactions.csv', self.csv_data)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "File size too large")
+
+
+@override_settings(SINGLE_FLIGHT_LOCK_DIR=None)
+class TickerCacheTests(TestCase):
+    def lookup(self, isins: List[str], fetched_tickers: Dict[str, Optional[str]]):
+        """
+        :param fetched_tickers: what OpenFIGI answers
+        :return: tuple of the tickers and the ISINs that were looked up at OpenFIGI
+        """
+        with mock.patch('portfolio_analyzer.stockdata_fetchers.fetch_tickers_from_openfigi',
+                        return_value=fetched_tickers) as fetch_tickers:
+            tickers = cached_isins_to_tickers('', isins)
+        return tickers, fetch_tickers.call_args[0][1] if fetch_tickers.called else []
+
+    def test_fresh_mappings_are_not_looked_up_again(self):
+        isins = ['IE00B3XXRP09', 'US0378331005']
+        tickers = {'IE00B3XXRP09': 'VUSA', 'US0378331005': 'AAPL'}
+        self.assertEqual(self.lookup(isins, tickers), (tickers, isins))
+        self.assertEqual(self.lookup(isins + isins, {}), (tickers, []))
+
+    def test_unknown_isins_are_cached_for_a_shorter_time(self):
+        self.lookup(['IE00B3XXRP09', 'XS0000000000'], {'IE00B3XXRP09': 'VUSA', 'XS0000000000': None})
+        self.assertEqual(self.lookup(['XS0000000000'], {}), ({'XS0000000000': None}, []))
+
+        TickerMapping.objects.update(fetched_at=timezone.now() - settings.TICKER_CACHE_NEGATIVE_TTL)
+        self.assertEqual(self.lookup(['IE00B3XXRP09', 'XS0000000000'], {'XS0000000000': None})[1], ['XS0000000000'])
+
+    def test_failed_lookups_are_retried_and_served_stale(self):
+        self.assertEqual(self.lookup(['IE00B3XXRP09'], {}), ({'IE00B3XXRP09': None}, ['IE00B3XXRP09']))
+        self.assertFalse(TickerMapping.objects.exists())
+
+        self.lookup(['IE00B3XXRP09'], {'IE00B3XXRP09': 'VUSA'})
+        TickerMapping.objects.update(fetched_at=timezone.now() - settings.TICKER_CACHE_TTL)
+        self.assertEqual(self.lookup(['IE00B3XXRP09'], {}), ({'IE00B3XXRP09': 'VUSA'}, ['IE00B3XXRP09']))
+
+
+def openfigi_answer(body: bytes) -> bytes:
+    """
+    Answers a mapping request like OpenFIGI, ISINs starting with XS are unknown
+    """
+    return json.dumps([{'warning': 'No identifier found.'} if job['idValue'].startswith('XS') else
+                       {'data': [{'ticker': f"T{job['idValue'][-4:]}"}]} for job in json.loads(body)]).encode()
+
+
+@override_settings(MARKET_DATA_RETRIES=0)
+class OpenFigiBatchTests(SimpleTestCase):
+    isins = [f"NL000000{number:04d}" for number in range(25)] + ['XS0000000001']
+
+    def fetch(self, server: StubServer, api_key: str) -> Dict[str, Optional[str]]:
+        with mock.patch('portfolio_analyzer.stockdata_fetchers.open_figi_mapping_url', server.url), \
+                mock.patch('portfolio_analyzer.stockdata_fetchers.market_data_session', create_market_data_session()):
+            return fetch_tickers_from_openfigi(api_key, self.isins + self.isins)
+
+    def test_isins_are_mapped_in_as_few_requests_as_allowed(self):
+        for api_key, requests in (('', 3), ('api-key', 1)):
+            with StubServer([], answer=openfigi_answer) as server:
+                tickers = self.fetch(server, api_key)
+                self.assertEqual(server.requests, requests)
+            self.assertEqual(len(tickers), len(self.isins))
+            self.assertEqual(tickers['NL0000000012'], 'T0012')
+            self.assertIsNone(tickers['XS0000000001'])
+
+    def test_isins_of_failed_requests_are_left_out(self):
+        with StubServer([(200, 0), (503, 0)], answer=openfigi_answer) as server:
+            tickers = self.fetch(server, '')
+        self.assertEqual(sorted(tickers), self.isins[:10] + self.isins[20:])
+
+
+@override_settings(SINGLE_FLIGHT_LOCK_DIR=None)
+class PriceHistoryStoreTests(TestCase):
+    def setUp(self):
+        self.downloads = []
+
+    def download(self, tickers: List[str], start: date, end: date) -> Dict[str, pd.Series]:
+        """
+        Yahoo Finance with a close of 1.0 on every business day, and no data for tickers starting with NODATA
+        """
+        self.downloads.append((tickers, start, end))
+        return {ticker: pd.Series(1.0, index=pd.bdate_range(start, end - timedelta(days=1)))
+                for ticker in tickers if not ticker.startswith('NODATA')}
+
+    def fetch(self, tickers: List[str], start: date, end: date) -> Dict[str, pd.DataFrame]:
+        self.downloads.clear()
+        return fetch_price_histories(tickers, start, end, download=self.download)
+
+    def test_only_missing_days_are_downloaded(self):
+        histories = self.fetch(['VUSA.AS'], date(2021, 1, 1), date(2021, 7, 1))
+        self.assertEqual(len(histories['VUSA.AS']), len(pd.bdate_range('2021-01-01', '2021-06-30')))
+        self.assertEqual(self.downloads, [(['VUSA.AS'], date(2021, 1, 1), date(2021, 7, 1))])
+
+        self.fetch(['VUSA.AS'], date(2021, 3, 1), date(2021, 4, 1))
+        self.assertEqual(self.downloads, [])
+
+        histories = self.fetch(['VUSA.AS'], date(2020, 7, 1), date(2022, 1, 1))
+        self.assertEqual(self.downloads, [(['VUSA.AS'], date(2020, 7, 1), date(2021, 1, 1)),
+                                          (['VUSA.AS'], date(2021, 7, 1), date(2022, 1, 1))])
+        self.assertEqual(len(histories['VUSA.AS']), len(pd.bdate_range('2020-07-01', '2021-12-31')))
+
+    def test_days_after_the_last_close_are_downloaded_again(self):
+        # 2021-01-09 and 10 are a weekend, the closes of those days may just not be published yet
+        self.fetch(['VUSA.AS'], date(2021, 1, 4), date(2021, 1, 11))
+        self.assertEqual(PriceHistoryCoverage.objects.get(ticker='VUSA.AS').end, date(2021, 1, 9))
+        self.fetch(['VUSA.AS'], date(2021, 1, 4), date(2021, 1, 11))
+        self.assertEqual(self.downloads, [(['VUSA.AS'], date(2021, 1, 9), date(2021, 1, 11))])
+
+    def test_tickers_missing_the_same_days_are_downloaded_together(self):
+        self.fetch(['VUSA.AS'], date(2021, 1, 1), date(2021, 7, 1))
+        self.fetch(['VUSA.AS', 'IWDA.AS', 'NODATA.AS'], date(2021, 1, 1), date(2021, 7, 1))
+        self.assertEqual(self.downloads, [(['IWDA.AS', 'NODATA.AS'], date(2021, 1, 1), date(2021, 7, 1))])
+
+    def test_tickers_without_data_are_not_stored(self):
+        histories = self.fetch(['NODATA.AS'], date(2021, 1, 1), date(2021, 7, 1))
+        self.assertTrue(histories['NODATA.AS'].empty)
+        self.assertFalse(PriceHistoryCoverage.objects.exists())
+
+
+class YearlyHoldingsTests(SimpleTestCase):
+    def test_years_without_transactions_carry_the_holdings(self):
+        stock_df = pd.DataFrame({'Datum': pd.to_datetime(['2022-05-02', '2020-03-02', '2020-01-06']),
+                                 'Aantal': [-4, 5, 5], 'Waarde': [600.0, -550.0, -500.0]})
+        holdings = calculate_yearly_holdings(stock_df, [2020, 2021, 2022, 2023])
+        self.assertEqual(holdings.to_dict('index'), {
+            2020: {'stocks_at_start_of_year': 0, 'stocks_at_end_of_year': 10, 'cash_flow': -1050.0},
+            2021: {'stocks_at_start_of_year': 10, 'stocks_at_end_of_year': 10, 'cash_flow': 0.0},
+            2022: {'stocks_at_start_of_year': 10, 'stocks_at_end_of_year': 6, 'cash_flow': 600.0},
+            2023: {'stocks_at_start_of_year': 6, 'stocks_at_end_of_year': 6, 'cash_flow': 0.0},
+        })
+
+    def test_holdings_match_filtering_per_year(self):
+        df = check_and_convert_csv_headers(io.BytesIO(generate_degiro_csv(products=5, transactions=300, years=6)))
+        for _, stock_df in df.groupby('Product', observed=True):
+            years = list(range(stock_df['Datum'].dt.year.min(), date.today().year + 1))
+            holdings = calculate_yearly_holdings(stock_df, years)
+            for year in years:
+                year_df = stock_df[stock_df['Datum'].dt.year == year]
+                self.assertEqual(holdings.loc[year, 'stocks_at_start_of_year'],
+                                 stock_df[stock_df['Datum'].dt.year < year]['Aantal'].sum())
+                self.assertEqual(holdings.loc[year, 'stocks_at_end_of_year'],
+                                 stock_df[stock_df['Datum'].dt.year <= year]['Aantal'].sum())
+                self.assertEqual(holdings.loc[year, 'cash_flow'], year_df['Waarde'].sum())
+
+
+class StockAggregatesTests(SimpleTestCase):
+    def test_aggregates_match_filtering_per_product(self):
+        df = check_and_convert_csv_headers(io.BytesIO(generate_degiro_csv(products=8, transactions=400, years=5)))
+        aggregates = calculate_stock_aggregates(df)
+        self.assertEqual(set(aggregates), set(df['Product']))
+        for product, product_aggregates in aggregates.items():
+            stock_df = df[df['Product'] == product]
+            self.assertEqual(product_aggregates, {
+                'stocks_owned': stock_df['Aantal'].sum(),
+                'total_invested': stock_df[stock_df['Waarde'] < 0]['Waarde'].sum() * -1,
+                'positive_cash_flow': stock_df[stock_df['Waarde'] > 0]['Waarde'].sum(),
+                'realized_gain': round(stock_df[stock_df['Aantal'] < 0]['Waarde'].sum(), 3),
+            })
+
+    def test_products_that_were_never_sold_have_no_realized_gain(self):
+        df = pd.DataFrame({'Product': ['A', 'A', 'B'], 'Aantal': [10, -5, 3], 'Waarde': [-100.0, 80.0, -30.0]})
+        aggregates = calculate_stock_aggregates(df)
+        self.assertEqual(aggregates['A']['realized_gain'], 80.0)
+        self.assertEqual(aggregates['B'], {'stocks_owned': 3, 'total_invested': 30.0, 'positive_cash_flow': 0.0,
+                                           'realized_gain': 0.0})
+
+
+class AnalysisResultRendererTests(SimpleTestCase):
+    def test_numpy_values_and_integer_keys_are_rendered(self):
+        data = {'stocks': np.int64(3), 'worth': np.float64(1.5), 'closes': np.array([1.0, 2.5]),
+                'yearly_gains': {2020: Decimal('0.25')}, 'missing': None}
+        self.assertEqual(json.loads(AnalysisResultRenderer().render(data)),
+                         {'stocks': 3, 'worth': 1.5, 'closes': [1.0, 2.5], 'yearly_gains': {'2020': 0.25},
+                          'missing': None})
+
+    def test_columnar_results_hold_the_series_as_arrays(self):
+        gains = {'virtual_gain_value': 10.0, 'virtual_gain_percentage': 1.0}
+        data = {'results': [{'stock_name': 'A', 'yearly_worth': {1609502400: 100, 1641038400: 120},
+                             'yearly_gains': {2021: gains}}],
+                'summary': {'yearly_worths_whole_portfolio': {1609502400: 100}, 'total_worth': 120}}
+        columnar = to_columnar(data)
+        self.assertEqual(columnar['results'][0]['yearly_worth'],
+                         {'timestamps': [1609502400, 1641038400], 'values': [100, 120]})
+        self.assertEqual(columnar['results'][0]['yearly_gains'],
+                         {'years': [2021], 'virtual_gain_value': [10.0], 'virtual_gain_percentage': [1.0]})
+        self.assertEqual(columnar['summary'], {'yearly_worths_whole_portfolio': {'timestamps': [1609502400],
+                                                                                 'values': [100]},
+                                               'total_worth': 120})
+        # The results themselves are left unchanged
+        self.assertEqual(data['results'][0]['yearly_gains'], {2021: gains})
+
+
+@override_settings(SINGLE_FLIGHT_LOCK_DIR=None)
+class AnalysisEndpointTests(TransactionTestCase):
+    csv_data = generate_degiro_csv(products=3, transactions=40, years=3)
+
+    def setUp(self):
+        self.result_cache = LocMemCache('test-endpoint-results', {})
+        self.result_cache.clear()
+        patcher = mock.patch('portfolio_analyzer.result_cache.result_cache', self.result_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, path: str, **extra):
+        with synthetic_market_data():
+            return self.client.post(path, {'csv_file': SimpleUploadedFile('Transactions.csv', self.csv_data)}, **extra)
+
+    def test_columnar_format(self):
+        results = self.post('/calculate_multi_year_gain/').json()
+        columnar = self.post('/calculate_multi_year_gain/?format=columnar').json()
+        self.assertEqual(len(columnar['results']), 3)
+        for stock, columnar_stock in zip(results['results'], columnar['results']):
+            self.assertEqual(columnar_stock['yearly_worth']['values'], list(stock['yearly_worth'].values()))
+            self.assertEqual(columnar_stock['yearly_gains']['years'], [int(year) for year in stock['yearly_gains']])
+
+    def stream(self) -> List[dict]:
+        with synthetic_market_data():
+            response = self.client.post('/calculate_multi_year_gain_stream/',
+                                        {'csv_file': SimpleUploadedFile('Transactions.csv', self.csv_data)})
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_stream_has_a_line_per_stock_and_the_summary(self):
+        lines = self.stream()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(list(lines[-1]), ['summary'])
+        # Streamed again from the result cache
+        self.assertEqual(self.stream(), lines)
+
+        self.result_cache.clear()
+        results = self.post('/calculate_multi_year_gain/').json()
+        self.assertEqual(lines[:-1], results['results'])
+        self.assertEqual(lines[-1]['summary'], results['summary'])
+
+    def test_async_endpoint_gives_the_same_results(self):
+        with synthetic_market_data() as market_data:
+            response = self.client.post('/calculate_multi_year_gain_async/',
+                                        {'csv_file': SimpleUploadedFile('Transactions.csv', self.csv_data)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(market_data.calls['openfigi'], 1)
+        # Analyzed again instead of served from the result cache
+        self.result_cache.clear()
+        self.assertEqual(response.json()['results'], self.post('/calculate_multi_year_gain/').json()['results'])
+
+    def run_job(self, csv_data: bytes) -> dict:
+        with synthetic_market_data():
+            response = self.client.post('/analysis_jobs/',
+                                        {'csv_file': SimpleUploadedFile('Transactions.csv', csv_data)})
+            self.assertEqual(response.status_code, 202)
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline:
+                job = self.client.get(response.json()['status_url']).json()
+                if job['status'] in (AnalysisJob.DONE, AnalysisJob.FAILED):
+                    return job
+                time.sleep(0.05)
+        self.fail("The analysis job did not finish")
+
+    def test_job_reports_its_progress_and_result(self):
+        job = self.run_job(self.csv_data)
+        self.assertEqual(job['status'], AnalysisJob.DONE)
+        self.assertEqual(job['progress'], {'stocks_total': 3, 'stocks_resolved': 3, 'stocks_priced': 3,
+                                           'stocks_computed': 3})
+        self.assertEqual(job['result']['results'], self.post('/calculate_multi_year_gain/').json()['results'])
+
+    def test_invalid_export_fails_the_job(self):
+        job = self.run_job(with_first_transaction_field(self.csv_data, 0, '2024-13-01'))
+        self.assertEqual(job['status'], AnalysisJob.FAILED)
+        self.assertIn("invalid dates", job['error'])
+
+    def test_error_during_the_stream_is_the_last_line(self):
+        def records():
+            yield 'result', {'stock_name': 'A'}
+            raise ValueError("Unable to find the currency of A.L")
+
+        self.assertEqual(list(ndjson_lines(records())),
+                         [b'{"stock_name":"A"}\n', b'{"error":"Unable to find the currency of A.L"}\n'])
+
+    def test_response_is_compressed_for_clients_that_accept_gzip(self):
+        response = self.post('/calculate_multi_year_gain/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['results'],
+                         self.post('/calculate_multi_year_gain/').json()['results'])
+
+
+class CacheWarmingTests(TransactionTestCase):
+    def test_most_used_recent_listings_are_hot(self):
+        record_ticker_usage({'VUSA.AS': 'IE00B3XXRP09', 'AAPL': 'US0378331005'})
+        record_ticker_usage({'AAPL': 'US0378331005', 'IWDA.AS': 'IE00B4L5Y983'})
+        record_ticker_usage({'AAPL': 'US0378331005'})
+        TickerUsage.objects.filter(ticker='IWDA.AS').update(date=timezone.localdate() - timedelta(days=7))
+
+        self.assertEqual(TickerUsage.objects.get(ticker='AAPL').request_count, 3)
+        self.assertEqual(hot_tickers(days=7, limit=10), {'AAPL': 'US0378331005', 'VUSA.AS': 'IE00B3XXRP09'})
+        self.assertEqual(list(hot_tickers(days=7, limit=1)), ['AAPL'])
+
+    def test_listings_are_ranked_by_their_recent_use(self):
+        today = timezone.localdate()
+        TickerUsage.objects.bulk_create([
+            # Used heavily months ago and once yesterday
+            TickerUsage(ticker='AAPL', isin='US0378331005', date=today - timedelta(days=90), request_count=1000),
+            TickerUsage(ticker='AAPL', isin='US0378331005', date=today - timedelta(days=1), request_count=1),
+            # Used heavily this week
+            TickerUsage(ticker='VUSA.AS', isin='IE00B3XXRP09', date=today - timedelta(days=3), request_count=20),
+            TickerUsage(ticker='VUSA.AS', isin='IE00B3XXRP09', date=today, request_count=10)])
+
+        self.assertEqual(list(hot_tickers(days=7, limit=10)), ['VUSA.AS', 'AAPL'])
+        self.assertEqual(list(hot_tickers(days=365, limit=10)), ['AAPL', 'VUSA.AS'])
+
+    def test_usage_before_the_window_is_forgotten(self):
+        today = timezone.localdate()
+        TickerUsage.objects.bulk_create([
+            TickerUsage(ticker='AAPL', isin='US0378331005', date=today - timedelta(days=7), request_count=5),
+            TickerUsage(ticker='AAPL', isin='US0378331005', date=today - timedelta(days=6), request_count=1)])
+        self.assertEqual(forget_ticker_usage(days=7), 1)
+        self.assertEqual(list(TickerUsage.objects.values_list('request_count', flat=True)), [1])
+
+    def test_only_expiring_mappings_are_refreshed(self):
+        now = timezone.now()
+        TickerMapping.objects.bulk_create([
+            TickerMapping(isin='IE00B3XXRP09', ticker='VUSA', fetched_at=now),
+            TickerMapping(isin='US0378331005', ticker='AAPL', fetched_at=now - settings.TICKER_CACHE_TTL)])
+        with mock.patch('portfolio_analyzer.cache_warming.fetch_tickers_from_openfigi',
+                        return_value={'US0378331005': 'AAPL', 'IE00B4L5Y983': 'IWDA'}) as fetch_tickers:
+            refreshed = refresh_ticker_mappings(['IE00B3XXRP09', 'US0378331005', 'IE00B4L5Y983'])
+        self.assertEqual(fetch_tickers.call_args[0][1], ['US0378331005', 'IE00B4L5Y983'])
+        self.assertEqual(refreshed, 2)
+        self.assertTrue(TickerMapping.objects.get(isin='US0378331005').is_fresh())
+
+    def test_failed_listings_are_counted(self):
+        record_ticker_usage({'VUSA.AS': 'IE00B3XXRP09', 'FAIL.AS': 'IE00B4L5Y983'})
+
+        def fetch_price_history(ticker: str, start: date, end: date):
+            if ticker == 'FAIL.AS':
+                raise ConnectionError("Yahoo Finance is down")
+            self.assertEqual((start, end), (date(date.today().year, 1, 1), date.today() + timedelta(days=1)))
+
+        with mock.patch('portfolio_analyzer.cache_warming.fetch_tickers_from_openfigi', return_value={}), \
+                mock.patch('portfolio_analyzer.cache_warming.fetch_price_history', fetch_price_history), \
+                self.assertLogs('portfolio_analyzer.cache_warming', 'ERROR'):
+            self.assertEqual(warm_caches(days=7, limit=10, workers=2), {'tickers': 2, 'mappings': 0, 'failed': 1})
+
+
+@override_settings(SINGLE_FLIGHT_LOCK_DIR=None)
+class AnalyzeBatchTests(TransactionTestCase):
+    def test_every_export_gets_a_record(self):
+        # The command quiets the log of the analyses
+        logger = logging.getLogger('portfolio_analyzer')
+        self.addCleanup(logger.setLevel, logger.level)
+
+        with tempfile.TemporaryDirectory() as directory:
+            for seed in (1, 2):
+                with open(os.path.join(directory, f"export-{seed}.csv"), 'wb') as f:
+                    f.write(generate_degiro_csv(products=2, transactions=20, years=2, seed=seed))
+            with open(os.path.join(directory, 'broken.csv'), 'wb') as f:
+                f.write(b'not an export')
+            output = os.path.join(directory, 'results.jsonl')
+
+            # The worker processes are forked, so they use the synthetic market data as well
+            with synthetic_market_data():
+                call_command('analyze_batch', directory, output=output, workers=2, stdout=io.StringIO())
+            with open(output) as f:
+                records = {os.path.basename(record['file']): record for record in map(json.loads, f)}
+
+        self.assertEqual(set(records), {'export-1.csv', 'export-2.csv', 'broken.csv'})
+        self.assertEqual(records['broken.csv']['status'], 'error')
+        for name in ('export-1.csv', 'export-2.csv'):
+            self.assertEqual(records[name]['status'], 'ok')
+            self.assertEqual(len(records[name]['result']['results']), 2)
+
+
+class SyntheticExportTests(SimpleTestCase):
+    def test_same_seed_gives_the_same_export(self):
+        self.assertEqual(generate_degiro_csv(products=5, transactions=50, seed=3),
+                         generate_degiro_csv(products=5, transactions=50, seed=3))
+        self.assertNotEqual(generate_degiro_csv(products=5, transactions=50, seed=3),
+                            generate_degiro_csv(products=5, transactions=50, seed=4))
+
+    def test_export_is_a_valid_degiro_export(self):
+        df = check_and_convert_csv_headers(io.BytesIO(generate_degiro_csv(products=5, transactions=200, years=3)))
+        self.assertEqual(len(df), 200)
+        self.assertLessEqual(df['Product'].nunique(), 5)
+        self.assertTrue(df['Datum'].is_monotonic_decreasing)
+        self.assertGreaterEqual(df['Datum'].min(), pd.Timestamp(date.today() - timedelta(days=3 * 365)))
+        # Sales never exceed the stocks held
+        held = df.iloc[::-1].groupby('Product', observed=True)['Aantal'].cumsum()
+        self.assertGreaterEqual(held.min(), 0)
+
+    def test_trades_are_made_at_the_synthetic_close(self):
+        df = check_and_convert_csv_headers(io.BytesIO(generate_degiro_csv(products=2, transactions=10)))
+        for _, transaction in df.iterrows():
+            close = synthetic_price_history(f"{synthetic_ticker(transaction['ISIN'])}.AS")[transaction['Datum']]
+            self.assertAlmostEqual(-transaction['Waarde'], transaction['Aantal'] * close, delta=0.01)
+
+
+class LoadTestMixTests(SimpleTestCase):
+    def test_uploads_are_unique_unless_repeated(self):
+        csv_data = generate_degiro_csv(products=2, transactions=10)
+        mix = UploadMix([('small', csv_data, 1)], repeat_fraction=0, seed=0)
+        uploads = [mix.next()[1] for _ in range(3)]
+        self.assertEqual(len(set(uploads)), 3)
+        # Only the order IDs differ, so every upload hashes to another result cache key
+        transactions = check_and_convert_csv_headers(io.BytesIO(csv_data)).drop(columns='Order ID')
+        for upload in uploads:
+            pd.testing.assert_frame_equal(
+                check_and_convert_csv_headers(io.BytesIO(upload)).drop(columns='Order ID'), transactions)
+            self.assertNotEqual(result_cache_key(io.BytesIO(upload), None, None),
+                                result_cache_key(io.BytesIO(csv_data), None, None))
+
+        mix = UploadMix([('small', csv_data, 1)], repeat_fraction=1, seed=0)
+        self.assertEqual(mix.next(), ('small', csv_data))
+
+    def test_scenarios_are_drawn_by_weight(self):
+        mix = UploadMix([('never', b'', 0), ('always', b'', 1)], repeat_fraction=0, seed=0)
+        self.assertEqual({mix.next()[0] for _ in range(20)}, {'always'})
+
+    def test_latency_percentiles(self):
+        percentiles = latency_percentiles([i / 1000 for i in range(1, 101)])
+        self.assertEqual(percentiles['max'], 100)
+        self.assertAlmostEqual(percentiles['mean'], 50.5)
+        self.assertAlmostEqual(percentiles['p50'], 50.5)
+        self.assertLess(percentiles['p95'], percentiles['p99'])
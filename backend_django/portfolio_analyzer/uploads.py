@@ -0,0 +1,108 @@
+import gzip
+import io
+import zipfile
+import zlib
+from typing import IO
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+
+class UploadTooLarge(ValueError):
+    def __init__(self):
+        super().__init__("File size too large")
+
+
+class UploadSizeLimitHandler(FileUploadHandler):
+    """
+    Counts the bytes of every uploaded file while they are received and stops the upload as soon as a file is larger
+    than settings.MAX_UPLOAD_SIZE, whatever size the request claims to have. It is the first of FILE_UPLOAD_HANDLERS,
+    so it sees the chunks before the handlers that store them. Reading the files of the request (request.FILES or
+    request.data) raises UploadTooLarge once the files that were stored so far are closed.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.too_large = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.MAX_UPLOAD_SIZE:
+            self.too_large = True
+            raise StopUpload(connection_reset=False)
+        return raw_data
+
+    def file_complete(self, file_size):
+        # The next handler returns the file
+        return None
+
+    def upload_complete(self):
+        if self.too_large:
+            raise UploadTooLarge()
+
+
+class DecompressedFile(io.RawIOBase):
+    """
+    Reads a decompressing file object (GzipFile or a member of a ZipFile) and raises a ValueError when it
+    decompresses to more than settings.MAX_UPLOAD_SIZE bytes or turns out to be corrupt, so pandas reports those
+    exports as invalid instead of filling the memory or failing with an OSError.
+    """
+
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        try:
+            data = self.file.read(len(buffer))
+        except (OSError, EOFError, zlib.error, zipfile.BadZipFile) as e:
+            raise ValueError(f"The compressed file could not be read: {e}")
+        if self.file.tell() > settings.MAX_UPLOAD_SIZE:
+            raise UploadTooLarge()
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # Decompressed files can only seek by decompressing again, which is fine for rewinding
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_uploaded_csv(uploaded_file) -> IO[bytes]:
+    """
+    Opens the CSV of an uploaded export, which may be compressed as .csv.gz or as a .zip file with a single CSV in it.
+    Compressed exports are decompressed on the fly while they are read, they are never decompressed in memory.
+    Raises a ValueError if the file has another extension or the zip file does not contain a single CSV.
+    :param uploaded_file: the uploaded file, either kept in memory or spooled to a temporary file by Django
+    :return: binary file object with the CSV
+    """
+    file_name = uploaded_file.name.lower()
+    if file_name.endswith('.csv'):
+        return uploaded_file
+
+    if file_name.endswith('.csv.gz'):
+        csv_file = gzip.GzipFile(fileobj=uploaded_file, mode='rb')
+    elif file_name.endswith('.zip'):
+        try:
+            archive = zipfile.ZipFile(uploaded_file)
+        except zipfile.BadZipFile:
+            raise ValueError("Invalid zip file")
+        members = [member for member in archive.infolist()
+                   if not member.is_dir() and member.filename.lower().endswith('.csv')]
+        if len(members) != 1:
+            raise ValueError("The zip file has to contain a single .csv file")
+        csv_file = archive.open(members[0])
+    else:
+        raise ValueError("Invalid file type: Only .csv, .csv.gz and .zip files are allowed")
+
+    return io.BufferedReader(DecompressedFile(csv_file))
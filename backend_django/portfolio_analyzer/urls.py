@@ -1,9 +1,19 @@
 from django.urls import path
-from .views import CalculateMultiYearGainView  # Import your view
+from .views import CalculateMultiYearGainView, StreamMultiYearGainView, AsyncCalculateMultiYearGainView, \
+    AnalysisJobView, AnalysisJobDetailView, PortfolioView, MetricsView  # Import your view
 
 app_name = 'portfolio_analyzer'
 
 urlpatterns = [
     path('calculate_multi_year_gain/', CalculateMultiYearGainView.as_view(), name='calculate-multi-year-gain'),
+    path('calculate_multi_year_gain_stream/', StreamMultiYearGainView.as_view(),
+         name='calculate-multi-year-gain-stream'),
+    path('calculate_multi_year_gain_async/', AsyncCalculateMultiYearGainView.as_view(),
+         name='calculate-multi-year-gain-async'),
+    path('analysis_jobs/', AnalysisJobView.as_view(), name='analysis-job'),
+    path('analysis_jobs/<uuid:job_id>/', AnalysisJobDetailView.as_view(), name='analysis-job-detail'),
+    path('portfolios/', PortfolioView.as_view(), name='portfolio'),
+    path('portfolios/<uuid:portfolio_id>/', PortfolioView.as_view(), name='portfolio-detail'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     # ... other URL patterns ...
 ]
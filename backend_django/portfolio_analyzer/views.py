@@ -1,30 +1,261 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from .analyze_portfolio import calculate_multi_year_gain
-import os
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from .instrumentation import InstrumentedViewMixin, registry, collect_metrics
+from .jobs import submit_analysis_job, fail_stale_job
+from .ledger import analyze_portfolio_upload
+from .models import AnalysisJob, Portfolio
+from .renderers import AnalysisResultRenderer, ColumnarAnalysisResultRenderer
+from .result_cache import cached_multi_year_gain, cached_multi_year_gain_async, streamed_multi_year_gain
+from .uploads import open_uploaded_csv
+from .worth_series import series_frequencies
+import zlib
 
 
-class CalculateMultiYearGainView(APIView):
+def get_uploaded_csv(request):
+    """
+    Returns the uploaded CSV file of a request.
+    Raises a ValueError if there is no file, it is too large or it is not a (compressed) CSV file.
+    """
+    return validate_uploaded_csv(request.data.get('csv_file', None))
 
-    def post(self, request, *args, **kwargs):
-        try:
-            csv_file = request.data.get('csv_file', None)
-            if csv_file is None:
-                raise ValueError("CSV file missing")
 
-            # Check if the uploaded file has the '.csv' extension
-            file_name = csv_file.name  # This should get the uploaded file name
-            file_extension = os.path.splitext(file_name)[1]  # Split the filename and take the extension
+def validate_uploaded_csv(csv_file):
+    """
+    Returns the CSV of an uploaded file, decompressed while it is read when the export was uploaded as .csv.gz or
+    .zip (see open_uploaded_csv).
+    Raises a ValueError if there is no file or it is not a (compressed) CSV file.
+    """
+    if csv_file is None:
+        raise ValueError("CSV file missing")
+
+    return open_uploaded_csv(csv_file)
+
 
-            if file_extension.lower() != '.csv':
-                raise ValueError("Invalid file type: Only .csv files are allowed")
+def get_worth_series_options(query_params) -> dict:
+    """
+    Reads the optional resolution ('daily', 'weekly' or 'monthly') and maximum number of points of the worth series
+    from the query string.
+    Raises a ValueError if they are invalid.
+    """
+    resolution = query_params.get('resolution')
+    points = query_params.get('points')
+    if resolution is not None and resolution not in series_frequencies:
+        raise ValueError(f"Invalid resolution: expected one of {', '.join(series_frequencies)}")
+    if points is not None:
+        if resolution is None:
+            raise ValueError("points can only be given together with a resolution")
+        if not points.isdigit() or int(points) < 3:
+            raise ValueError("Invalid points: expected a number of at least 3")
+        points = int(points)
+    return {'resolution': resolution, 'points': points}
+
+
+class CalculateMultiYearGainView(InstrumentedViewMixin, APIView):
+    # ?format=columnar renders the series as arrays, see ColumnarAnalysisResultRenderer
+    renderer_classes = [AnalysisResultRenderer, ColumnarAnalysisResultRenderer]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            csv_file = get_uploaded_csv(request)
+            worth_series_options = get_worth_series_options(request.query_params)
 
             # Your existing logic here
-            results = calculate_multi_year_gain(csv_file)
+            results = cached_multi_year_gain(csv_file, **worth_series_options)
             return Response(results, status=status.HTTP_200_OK)
 
         except ValueError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({"error": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class StreamMultiYearGainView(InstrumentedViewMixin, APIView):
+    """
+    Streaming variant of CalculateMultiYearGainView. Responds with newline-delimited JSON: a line with the result of
+    every stock as soon as it is calculated, followed by a line with {"summary": ...}. An error after the first line
+    can not change the status anymore and is reported as a last line with {"error": ...}.
+    The metrics of the request only cover the reading of the export, the analysis itself is collected as the
+    operation StreamMultiYearGainView.stream once the stream ends.
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            csv_file = get_uploaded_csv(request)
+            worth_series_options = get_worth_series_options(request.query_params)
+            records = streamed_multi_year_gain(csv_file, **worth_series_options)
+
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"error": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return ndjson_response(request, ndjson_lines(metered_records(f"{type(self).__name__}.stream", records)))
+
+
+def metered_records(operation: str, records):
+    with collect_metrics(operation):
+        yield from records
+
+
+def ndjson_lines(records):
+    """
+    :param records: ('result', result of a stock) and ('summary', summary) records, see stream_transactions
+    :return: the lines of the records in newline-delimited JSON
+    """
+    renderer = AnalysisResultRenderer()
+    try:
+        for record_type, record in records:
+            yield renderer.render(record if record_type == 'result' else {record_type: record}) + b'\n'
+    except ValueError as e:
+        yield renderer.render({"error": str(e)}) + b'\n'
+    except Exception as e:
+        yield renderer.render({"error": "Internal server error"}) + b'\n'
+
+
+def ndjson_response(request, lines) -> StreamingHttpResponse:
+    """
+    Streams newline-delimited JSON, compressed when the client accepts gzip. GZipMiddleware would hold the lines back
+    until it has a block of compressed data, so every line is flushed from the compressor as soon as it is written.
+    """
+    if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response = StreamingHttpResponse(gzip_lines(lines), content_type='application/x-ndjson')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    # Keeps proxies like nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def gzip_lines(lines):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        yield compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncCalculateMultiYearGainView(InstrumentedViewMixin, View):
+    """
+    Async variant of CalculateMultiYearGainView. When served by the ASGI application (degiro_portfolio_api.asgi, e.g.
+    with the uvicorn workers of gunicorn.conf.py) an analysis does not hold a thread while it waits for OpenFIGI and
+    Yahoo Finance, so a process can analyze many uploads at the same time, see portfolio_analyzer.async_analysis.
+    Served by the WSGI application it runs on the thread of the request like the sync view, and has no benefit over it.
+    DRF views can not be async, so the response is rendered by the renderer of the format in the query string directly.
+    """
+
+    async def post(self, request, *args, **kwargs):
+        renderer = ColumnarAnalysisResultRenderer() if request.GET.get('format') == 'columnar' \
+            else AnalysisResultRenderer()
+        try:
+            csv_file = validate_uploaded_csv(request.FILES.get('csv_file', None))
+            worth_series_options = get_worth_series_options(request.GET)
+
+            results = await cached_multi_year_gain_async(csv_file, **worth_series_options)
+            return json_response(renderer, results, status=status.HTTP_200_OK)
+
+        except ValueError as e:
+            return json_response(renderer, {"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return json_response(renderer, {"error": "Internal server error"},
+                                 status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def json_response(renderer, data, status: int) -> HttpResponse:
+    return HttpResponse(renderer.render(data), status=status, content_type=renderer.media_type)
+
+
+class AnalysisJobView(APIView):
+    """
+    Queues the analysis of an uploaded CSV and returns immediately with the id of the job.
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            csv_file = get_uploaded_csv(request)
+            # Compressed exports are decompressed while they are read, which raises a ValueError when they are corrupt
+            job = submit_analysis_job(csv_file.read())
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': reverse('portfolio_analyzer:analysis-job-detail', kwargs={'job_id': job.id}),
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class AnalysisJobDetailView(APIView):
+    """
+    Reports the progress of an analysis job and, once it is done, its result.
+    """
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = AnalysisJob.objects.filter(id=job_id).first()
+        if job is None:
+            return Response({"error": "Analysis job not found"}, status=status.HTTP_404_NOT_FOUND)
+        job = fail_stale_job(job)
+
+        response = {
+            'job_id': job.id,
+            'status': job.status,
+            'progress': {
+                'stocks_total': job.stocks_total,
+                'stocks_resolved': job.stocks_resolved,
+                'stocks_priced': job.stocks_priced,
+                'stocks_computed': job.stocks_computed,
+            },
+        }
+        if job.status == AnalysisJob.DONE:
+            response['result'] = job.result
+        elif job.status == AnalysisJob.FAILED:
+            response['error'] = job.error
+        return Response(response, status=status.HTTP_200_OK)
+
+
+class PortfolioView(InstrumentedViewMixin, APIView):
+    """
+    Analyzes an upload as part of a stored portfolio. Posting without a portfolio id creates a new portfolio, posting
+    to an existing portfolio merges the upload into its transactions and only recalculates what changed.
+    """
+    renderer_classes = [AnalysisResultRenderer, ColumnarAnalysisResultRenderer]
+
+    def post(self, request, portfolio_id=None, *args, **kwargs):
+        portfolio = None
+        if portfolio_id is not None:
+            portfolio = Portfolio.objects.filter(id=portfolio_id).first()
+            if portfolio is None:
+                return Response({"error": "Portfolio not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            csv_file = get_uploaded_csv(request)
+            if portfolio is None:
+                portfolio = Portfolio.objects.create()
+            results = analyze_portfolio_upload(portfolio, csv_file)
+            return Response({'portfolio_id': portfolio.id, **results}, status=status.HTTP_200_OK)
+
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"error": "Internal server error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class MetricsView(APIView):
+    """
+    Exposes the counters and timings of this process (see portfolio_analyzer.instrumentation) in the Prometheus text
+    format. Only to staff users, unless settings.METRICS_ENABLED opens it to the scrapers of the private network.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS_ENABLED and not request.user.is_staff:
+            return Response({"error": "Not found"}, status=status.HTTP_404_NOT_FOUND)
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
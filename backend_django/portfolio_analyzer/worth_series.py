@@ -0,0 +1,98 @@
+from datetime import date
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import timed_stage
+from .stockdata_fetchers import PriceIndex
+
+# Dates at which the worth is calculated per resolution: business days, Fridays and the last business day of a month
+series_frequencies = {'daily': 'B', 'weekly': 'W-FRI', 'monthly': 'BM'}
+
+
+def series_dates(first_day: pd.Timestamp, resolution: str) -> pd.DatetimeIndex:
+    """
+    :param first_day: first day of the series, usually the day of the first transaction
+    :param resolution: 'daily', 'weekly' or 'monthly'
+    :return: the dates from first_day up to and including today at the given resolution
+    """
+    if resolution not in series_frequencies:
+        raise ValueError(f"Invalid resolution '{resolution}', expected one of {', '.join(series_frequencies)}")
+    today = pd.Timestamp(date.today())
+    return pd.date_range(first_day, today, freq=series_frequencies[resolution]).union(pd.DatetimeIndex([today]))
+
+
+@timed_stage('compute')
+def calculate_worth_series(stock_df: pd.DataFrame, price_index: PriceIndex, dates: pd.DatetimeIndex) -> pd.Series:
+    """
+    Calculates the worth of a stock at every date from the first transaction on. The number of stocks held and the
+    price at a date are both looked up as of that date (the last transaction and the last close on or before it), so
+    dates that are not trading days get the close of the last trading day.
+    :param stock_df: CSV file contents for a specific stock in dataframe format
+    :param price_index: the daily closes of the stock
+    :param dates: dates to calculate the worth at, see series_dates
+    :return: Series with the worth (truncated to whole euros, like calculate_yearly_worth) indexed by date. Dates
+    before the first close are left out
+    """
+    stocks_held = stock_df.groupby('Datum')['Aantal'].sum().cumsum().rename('stocks').rename_axis('Date')
+    worth = pd.DataFrame({'Date': dates[dates >= stocks_held.index[0]]})
+    worth = pd.merge_asof(worth, stocks_held.reset_index(), on='Date')
+    worth['Close'] = price_index.closes_on_or_before(worth['Date'])
+    worth = worth.dropna(subset=['Close']).set_index('Date')
+    return (worth['stocks'] * worth['Close']).astype('int64')
+
+
+@timed_stage('summarize')
+def total_worth_series(worth_series: List[pd.Series]) -> pd.Series:
+    """
+    Adds up the worth series of all stocks, a stock counts as 0 at the dates its series does not have.
+    """
+    if not worth_series:
+        return pd.Series(dtype='int64')
+    return pd.concat(worth_series, axis=1).fillna(0).sum(axis=1).astype('int64')
+
+
+@timed_stage('summarize')
+def downsample_lttb(series: pd.Series, points: int) -> pd.Series:
+    """
+    Reduces a series to the given number of points with the Largest-Triangle-Three-Buckets algorithm, which keeps
+    the peaks and dips that make up the shape of a chart. The first and last points are always kept, every bucket of
+    points in between is represented by the point that forms the largest triangle with the point picked for the
+    previous bucket and the average of the next bucket.
+    :param series: series indexed by date
+    :param points: number of points to keep, at least 3
+    :return: the selected points of the series
+    """
+    length = len(series)
+    if points >= length or points < 3:
+        return series
+
+    x = series.index.asi8.astype(float)
+    y = series.to_numpy(dtype=float)
+    # points - 2 buckets between the first and the last point
+    edges = np.linspace(1, length - 1, points - 1).astype(int)
+
+    selected = [0]
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_x, next_y = x[end:edges[bucket + 2]].mean(), y[end:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        previous = selected[-1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end]) * (next_y - y[previous]))
+        selected.append(start + int(areas.argmax()))
+    selected.append(length - 1)
+    return series.iloc[selected]
+
+
+def series_to_timestamps(series: pd.Series) -> Dict[int, int]:
+    """
+    :return: dictionary with the timestamp of noon (UTC) of every date as key and the worth as value, the same format
+    as calculate_yearly_worth
+    """
+    timestamps = (series.index + pd.Timedelta(hours=12)).asi8 // 10 ** 9
+    return dict(zip(timestamps.tolist(), series.tolist()))